@@ -283,9 +283,10 @@ async def extract_professor_speech(
 				# 各話者の声紋を抽出して照合
 				best_match_speaker = None
 
+				segments_by_speaker = diarization.rows_by_speaker(segments)
 				for speaker_info in statistics["speakers"]:
 					speaker_id = speaker_info["speaker_id"]
-					speaker_segments = diarization.filter_segments_by_speaker(segments, speaker_id)
+					speaker_segments = segments_by_speaker.get(speaker_id, [])
 
 					# 最初の3セグメントから声紋を抽出（代表的な声紋を取得）
 					speaker_embeddings = []
@@ -1,12 +1,16 @@
-from fastapi import FastAPI, HTTPException, Depends, Header, UploadFile, File
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import contextlib
 import json
 import pathlib
 import re
 import os
+import time
 import requests
 import jwt
 import base64
@@ -15,9 +19,17 @@ from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from supabase import create_client, Client
 import chardet
 
+from .utils.metrics import METRICS_ENABLED, REGISTRY, REQUEST_SECONDS, begin_request, record_fallback, server_timing, span
+from .utils.map_reduce_summary import SUMMARY_MAP_REDUCE_THRESHOLD, condense as condense_sections
+from .utils.model_router import ModelRouterError, RequestCancelled, get_model_router
+from .utils.prompt_registry import get_prompt_registry
+from .utils.rate_limit import RateLimitTimeout, get_openai_limiter
+from .utils.single_flight import SINGLE_FLIGHT_ENABLED, flight_key, get_single_flight
+from .utils.summary_compression import GAP_MARKER, SUMMARY_COMPRESSION_BUDGET, SUMMARY_COMPRESSION_ENABLED, compress_for_summary
+from .utils.token_budget import PROMPT_REF_RESERVE_TOKENS, PROMPT_REF_TOKEN_BUDGET, count_tokens, input_token_budget, pack_refs, truncate_to_tokens
+
 ROOT = pathlib.Path(__file__).resolve().parents[1]
 SAMPLE_PATH = ROOT / "data" / "sample_comments.json"
-PROMPTS_DIR = ROOT / "prompts"
 
 # --- simple .env loader (no external deps)
 def _load_local_env():
@@ -73,6 +85,24 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def record_timings(request: Request, call_next):
+	"""処理段階ごとの所要時間を Server-Timing ヘッダーで返し、リクエストの所要時間を記録する"""
+	if not METRICS_ENABLED:
+		return await call_next(request)
+	timings = begin_request()
+	started = time.perf_counter()
+	response = await call_next(request)
+	elapsed = time.perf_counter() - started
+
+	# パスではなくルートのテンプレートで集計する（/references/{reference_id} など）
+	route = getattr(request.scope.get("route"), "path", "unmatched")
+	REQUEST_SECONDS.observe(elapsed, method=request.method, route=route, status=response.status_code)
+	timings.append(("total", elapsed))
+	response.headers["Server-Timing"] = server_timing(timings)
+	return response
+
+
 # ===========================================
 # データ暗号化・復号化機能
 # ===========================================
@@ -476,6 +506,83 @@ def jaccard(a: List[str], b: List[str]) -> float:
 	return len(set_a & set_b) / max(1, len(set_a | set_b))
 
 
+def search_refs_by_embedding(query_embedding: List[float], doc_type: str, k: int = 5) -> List[str]:
+	"""
+	Embeddingでknowledge_baseをベクトル検索し、参照例のテキストを返す
+
+	Args:
+		query_embedding: クエリ（レポート本文）のEmbedding
+		doc_type: レポート種別（reflection or final）
+		k: 取得件数
+
+	Returns:
+		参照例のテキストリスト
+	"""
+	# Supabaseでベクトル検索（クエリと同じモデルのEmbeddingだけを対象にする）
+	from .utils.embedding import EMBEDDING_MODEL
+	params = {
+		"query_embedding": query_embedding,
+		"match_count": k * 2,  # type フィルタ前に多めに取得
+		"filter_model": EMBEDDING_MODEL
+	}
+	try:
+		result = supabase.rpc("search_knowledge_by_embedding", params).execute()
+	except Exception as e:
+		# 06_filter_search_by_embedding_model.sql が未実行（filter_model 引数のない関数）
+		if "PGRST202" not in str(e):
+			raise
+		print("⚠️ search_knowledge_by_embedding が filter_model に未対応です。06_filter_search_by_embedding_model.sql を実行してください")
+		params.pop("filter_model")
+		result = supabase.rpc("search_knowledge_by_embedding", params).execute()
+
+	# レポート種別でフィルタ（同じタイプ + 「その他」を含める）
+	# 注: 「その他」は教授の一般的な思考・講義内容などで、全てのレポートタイプで参考になる
+	target_type = "reflection" if doc_type == "reflection" else "final"
+	filtered = [
+		item for item in result.data
+		if item.get("type") == target_type or item.get("type") == "other"
+	]
+
+	# 上位k件のテキストを返す
+	return [item["text"] for item in filtered[:k]]
+
+
+def retrieve_refs_fallback(text: str, doc_type: str, k: int = 5) -> List[str]:
+	"""Embedding検索が使えない場合のフォールバック（同じタイプ + 「その他」を含める）
+
+	ローカルEmbedding（文字n-gramのTF-IDF）で類似度順に並べます。
+	NumPyが使えない環境では従来のJaccard検索を使います。
+	"""
+	samples = load_samples()
+	target_type = "reflection" if doc_type == "reflection" else "final"
+	candidates = [
+		s for s in samples
+		if s.get("type") == target_type or s.get("type") == "other"
+	]
+
+	try:
+		from .utils.local_embedding import rank_by_similarity
+		texts = [c.get("text", "") for c in candidates]
+		return [texts[i] for _, i in rank_by_similarity(text, texts, k)]
+	except ImportError:
+		pass
+
+	toks = tokenize(text)
+	scored = sorted(((jaccard(toks, tokenize(c.get("text", ""))), c.get("text", "")) for c in candidates), reverse=True)
+	return [t for _, t in scored[:k]]
+
+
+def retrieve_refs_local(text: str, doc_type: str, k: int = 5) -> List[str]:
+	"""EMBEDDING_BACKEND=local のときの参照例検索
+
+	knowledge_base に保存されたEmbeddingはOpenAIのベクトル空間なので、ローカルEmbeddingの
+	クエリを search_knowledge_by_embedding に渡しても比較になりません（次元数が違えばRPCが失敗）。
+	RPCは使わず、参照例をローカルEmbeddingで類似度順に並べます。
+	"""
+	with span("retrieval_local"):
+		return retrieve_refs_fallback(text, doc_type, k)
+
+
 def retrieve_refs(text: str, doc_type: str, k: int = 5) -> List[str]:
 	"""
 	Embeddingベースで参照例を検索（Phase 2版）
@@ -488,49 +595,69 @@ def retrieve_refs(text: str, doc_type: str, k: int = 5) -> List[str]:
 	Returns:
 		参照例のテキストリスト
 	"""
+	from .utils.embedding import EMBEDDING_BACKEND
+	if EMBEDDING_BACKEND == "local":
+		return retrieve_refs_local(text, doc_type, k)
+
 	try:
 		# Embedding生成
 		from .utils.embedding import generate_embedding
-		query_embedding = generate_embedding(text)
+		with span("embedding"):
+			query_embedding = generate_embedding(text)
+		with span("supabase_rpc"):
+			return search_refs_by_embedding(query_embedding, doc_type, k)
+
+	except Exception as e:
+		# エラー時はJaccard検索にフォールバック
+		print(f"⚠️ Embedding検索エラー ({e.__class__.__name__}), ローカル検索にフォールバック")
+		record_fallback("retrieval")
+		with span("retrieval_fallback"):
+			return retrieve_refs_fallback(text, doc_type, k)
 
-		# Supabaseでベクトル検索
-		result = supabase.rpc(
-			"search_knowledge_by_embedding",
-			{
-				"query_embedding": query_embedding,
-				"match_count": k * 2  # type フィルタ前に多めに取得
-			}
-		).execute()
-
-		# レポート種別でフィルタ（同じタイプ + 「その他」を含める）
-		# 注: 「その他」は教授の一般的な思考・講義内容などで、全てのレポートタイプで参考になる
-		target_type = "reflection" if doc_type == "reflection" else "final"
-		filtered = [
-			item for item in result.data
-			if item.get("type") == target_type or item.get("type") == "other"
-		]
 
-		# 上位k件のテキストを返す
-		return [item["text"] for item in filtered[:k]]
+async def retrieve_refs_async(text: str, doc_type: str, k: int = 5) -> List[str]:
+	"""
+	retrieve_refs の非同期版
+
+	Embeddingは他のリクエストとまとめてバッチ送信し（マイクロバッチ）、
+	Supabaseの検索はスレッドで実行してイベントループを塞がないようにします。
+	"""
+	from .utils.embedding import EMBEDDING_BACKEND
+	if EMBEDDING_BACKEND == "local":
+		return await asyncio.to_thread(retrieve_refs_local, text, doc_type, k)
+
+	try:
+		from .utils.embedding_coalescer import generate_embedding_async
+		with span("embedding"):
+			query_embedding = await generate_embedding_async(text)
+		with span("supabase_rpc"):
+			return await asyncio.to_thread(search_refs_by_embedding, query_embedding, doc_type, k)
 
 	except Exception as e:
-		# エラー時はJaccard検索にフォールバック
-		print(f"⚠️ Embedding検索エラー ({e.__class__.__name__}), Jaccard検索を使用")
-		# フォールバック: 既存のJaccard検索（同じタイプ + 「その他」を含める）
-		samples = load_samples()
-		toks = tokenize(text)
-		target_type = "reflection" if doc_type == "reflection" else "final"
-		candidates = [
-			s for s in samples
-			if s.get("type") == target_type or s.get("type") == "other"
-		]
-		scored = sorted(((jaccard(toks, tokenize(c.get("text", ""))), c.get("text", "")) for c in candidates), reverse=True)
-		return [t for _, t in scored[:k]]
+		print(f"⚠️ Embedding検索エラー ({e.__class__.__name__}), ローカル検索にフォールバック")
+		record_fallback("retrieval")
+		with span("retrieval_fallback"):
+			return retrieve_refs_fallback(text, doc_type, k)
+
+
+def comment_prompt_name(doc_type: str) -> str:
+	return "reflection" if doc_type == "reflection" else "final"
+
+
+def summary_prompt_name(doc_type: str) -> str:
+	return "summary_final" if doc_type == "final" else "summary_reflection"
 
 
 def load_prompt(doc_type: str) -> str:
-	file = "reflection.txt" if doc_type == "reflection" else "final.txt"
-	return (PROMPTS_DIR / file).read_text(encoding="utf-8")
+	# テンプレートはレジストリが1回だけ読み込み、ファイル更新時のみ読み直す
+	return get_prompt_registry().get(comment_prompt_name(doc_type)).source
+
+
+def prompt_version(doc_type: str) -> str:
+	"""コメント生成・要約で使うプロンプト一式のバージョン"""
+	return get_prompt_registry().version([
+		"comment_system", comment_prompt_name(doc_type), "summary_system", summary_prompt_name(doc_type)
+	])
 
 
 def build_comment(req: GenerateRequest) -> GenerateResponse:
@@ -670,77 +797,197 @@ def generate_reflection_draft(text: str, refs: List[str], scores: Dict[str, any]
 	])
 
 
-# 要約機能: 3形式（エグゼクティブサマリー、箇条書き、構造化）
-def call_openai_summary(prompt: str, system_prompt: str = None, use_fallback: bool = True) -> Tuple[Optional[str], Optional[str]]:
-	"""要約生成用のOpenAI API呼び出し
+def _usage_tokens(data: Dict) -> Optional[int]:
+	"""Chat Completionsのレスポンスから実際の使用トークン数を取り出す"""
+	return (data.get("usage") or {}).get("total_tokens")
 
-	注: 要約生成には高性能なgpt-4oを使用します。
-	gpt-4oが利用できない場合は自動的にgpt-4o-miniにフォールバックします。
+
+# 要約の最大出力トークン数（詳細な要約のために十分な数を確保）
+SUMMARY_MAX_TOKENS = 2000
+
+
+def chat_request_body(model: str, messages: List[Dict[str, str]], max_tokens: int) -> Dict:
+	"""Chat Completionsのリクエスト本文（同期呼び出しとBatch APIで共通）"""
+	return {
+		"model": model,
+		"messages": messages,
+		"temperature": 0.3,  # コメント・要約とも低いtemperatureで一貫性を保つ
+		"max_tokens": max_tokens,
+	}
+
+
+def read_chat_stream(resp: requests.Response, cancelled: Callable[[], bool]) -> Dict:
 	"""
-	if not OPENAI_API_KEY:
-		return None, "APIキーが設定されていません"
+	Chat Completionsのストリーミング応答（SSE）を読み、通常の応答と同じ形の辞書にまとめる
 
+	チャンクごとに cancelled() を確認し、打ち切られたら RequestCancelled を送出します
+	（呼び出し側が応答を閉じると接続が切れ、OpenAI側の生成も止まります）。
+	"""
+	content: List[str] = []
+	usage = None
+	for line in resp.iter_lines(chunk_size=None, decode_unicode=True):
+		if cancelled():
+			raise RequestCancelled("hedged request cancelled")
+		if not line or not line.startswith("data: "):
+			continue
+		payload = line[len("data: "):]
+		if payload == "[DONE]":
+			break
+		chunk = json.loads(payload)
+		for choice in chunk.get("choices") or []:
+			content.append((choice.get("delta") or {}).get("content") or "")
+		usage = chunk.get("usage") or usage
+	return {"choices": [{"message": {"content": "".join(content)}}], "usage": usage}
+
+
+def summary_models(model: str = None, use_fallback: bool = True, input_tokens: int = None) -> List[str]:
+	"""要約に使うモデルの候補（呼び出す順）"""
 	# 環境変数で要約用モデルを指定可能（デフォルトはgpt-4o）
-	summary_model = os.environ.get("SUMMARY_MODEL", "gpt-4o")
+	summary_model = model or os.environ.get("SUMMARY_MODEL", "gpt-4o")
 
 	# 試行するモデルのリスト（gpt-4o → gpt-4o-miniの順）
 	models_to_try = [summary_model]
 	if use_fallback and summary_model == "gpt-4o":
-		models_to_try.append("gpt-4o-mini")  # フォールバック用
+		models_to_try.append("gpt-4o-mini")  # フォールバック・ヘッジ用
+	return get_model_router().route(models_to_try, input_tokens)
 
-	last_error = None
 
-	for model in models_to_try:
-		try:
-			messages = []
-			if system_prompt:
-				messages.append({"role": "system", "content": system_prompt})
-			messages.append({"role": "user", "content": prompt})
+# 要約機能: 3形式（エグゼクティブサマリー、箇条書き、構造化）
+def call_openai_summary(prompt: str, system_prompt: str = None, use_fallback: bool = True, model: str = None, input_tokens: int = None) -> Tuple[Optional[str], Optional[str]]:
+	"""要約生成用のOpenAI API呼び出し
 
-			resp = requests.post(
-				"https://api.openai.com/v1/chat/completions",
-				headers={"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"},
-				json={
-					"model": model,
-					"messages": messages,
-					"temperature": 0.3,  # 要約は低いtemperatureで一貫性を保つ
-					"max_tokens": 2000,  # 詳細な要約のために十分なトークン数を確保
-				},
-				timeout=60 if model == "gpt-4o" else 30,
-			)
-			resp.raise_for_status()
-			data = resp.json()
-			content = data.get("choices", [{}])[0].get("message", {}).get("content")
+	注: 要約生成には高性能なgpt-4oを使用します。
+	gpt-4oの応答が直近のp95より遅い場合はgpt-4o-miniにも同じリクエストを送り（ヘッジ）、
+	先に返った方を使います。gpt-4oが失敗した場合はすぐにgpt-4o-miniを呼びます。
+	input_tokens（レポートの長さ）が短い場合は最初からgpt-4o-miniを使います。
+	model を指定した場合はそのモデルを使います（map-reduceのセクション要約など）。
+	"""
+	if not OPENAI_API_KEY:
+		return None, "APIキーが設定されていません"
 
-			# 成功した場合、使用したモデルをログに記録（デバッグ用）
-			if model != summary_model:
-				print(f"[INFO] Fallback to {model} for summary generation")
+	summary_model = model or os.environ.get("SUMMARY_MODEL", "gpt-4o")
+	router = get_model_router()
+	models_to_try = summary_models(model, use_fallback, input_tokens)
+	timeouts = {m: 60 if m == "gpt-4o" else 30 for m in models_to_try}
 
-			return content, None
+	messages = []
+	if system_prompt:
+		messages.append({"role": "system", "content": system_prompt})
+	messages.append({"role": "user", "content": prompt})
 
-		except requests.exceptions.Timeout:
-			last_error = f"タイムアウト: {model}での接続がタイムアウトしました"
-			if model == models_to_try[-1]:  # 最後のモデルでもエラー
-				return None, last_error
-			# 次のモデルを試行
-			continue
+	reserve_tokens = sum(count_tokens(m["content"]) for m in messages) + SUMMARY_MAX_TOKENS
 
-		except requests.exceptions.RequestException as e:
-			last_error = f"APIエラー ({model}): {str(e)}"
-			if model == models_to_try[-1]:  # 最後のモデルでもエラー
-				return None, last_error
-			# 次のモデルを試行
-			print(f"[WARNING] Failed with {model}, trying fallback model...")
-			continue
+	def attempt(model: str, session: requests.Session) -> Optional[str]:
+		def send() -> Dict:
+			# ヘッジで負けたときにチャンクの合間で打ち切れるよう、ストリーミングで受け取る
+			body = {**chat_request_body(model, messages, SUMMARY_MAX_TOKENS), "stream": True, "stream_options": {"include_usage": True}}
+			with session.post(
+				"https://api.openai.com/v1/chat/completions",
+				headers={"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"},
+				json=body,
+				timeout=timeouts[model],
+				stream=True,
+			) as resp:
+				resp.raise_for_status()
+				return read_chat_stream(resp, session.cancelled.is_set)
+
+		# レート制御（429はRetry-Afterに従ってリトライ）
+		data = get_openai_limiter().call(
+			model, reserve_tokens, send, used_tokens=_usage_tokens, cancelled=session.cancelled.is_set
+		)
+		return data.get("choices", [{}])[0].get("message", {}).get("content")
 
-		except Exception as e:
-			last_error = f"予期しないエラー ({model}): {str(e)}"
-			if model == models_to_try[-1]:  # 最後のモデルでもエラー
-				return None, last_error
-			# 次のモデルを試行
-			continue
+	try:
+		used_model, content = router.call(attempt, models_to_try, timeouts)
+	except ModelRouterError as e:
+		if isinstance(e.cause, RateLimitTimeout):
+			return None, f"レート制限: 混雑のため{e.model}に時間内に送信できませんでした"
+		if isinstance(e.cause, requests.exceptions.Timeout):
+			return None, f"タイムアウト: {e.model}での接続がタイムアウトしました"
+		if isinstance(e.cause, requests.exceptions.RequestException):
+			return None, f"APIエラー ({e.model}): {str(e.cause)}"
+		return None, f"予期しないエラー ({e.model}): {str(e.cause)}"
+
+	# 既定と異なるモデルを使った場合はログに記録（デバッグ用）
+	if used_model != summary_model:
+		print(f"[INFO] {used_model} used for summary generation")
+	if used_model != models_to_try[0]:
+		# ヘッジ・失敗で2つ目のモデルの結果を使った
+		record_fallback("summary_model")
+
+	return content, None
+
+
+def build_summary_input(text: str, map_reduce: bool = True) -> str:
+	"""要約プロンプトに差し込む本文を作る（長い文書は map-reduce のメモ、または重要な文の抜粋にする）
+	Args:
+		text: レポート本文
+		map_reduce: False の場合、閾値を超える文書もLLMを呼ばずに抜粋で済ませる（Batch API用）
+	"""
+	if count_tokens(text) > SUMMARY_MAP_REDUCE_THRESHOLD:
+		if map_reduce:
+			# 1回のプロンプトに収まらない文書: セクションごとに安価なモデルで要約し（map）、そのメモをまとめる（reduce）
+			condensed = condense_sections(
+				text,
+				lambda prompt, system, model: call_openai_summary(prompt, system, use_fallback=False, model=model)
+			)
+			print(f"🧩 map-reduce要約: {condensed['sections']}セクション（キャッシュ {condensed['cached']}件, {condensed['levels']}段）")
+			return f"（長い文書のため、{condensed['sections']}個のパートに分けて要約したメモです。メモ全体を1つのレポートとして要約してください）\n{condensed['text']}"
+		budget = SUMMARY_MAP_REDUCE_THRESHOLD
+	elif SUMMARY_COMPRESSION_ENABLED:
+		budget = SUMMARY_COMPRESSION_BUDGET
+	else:
+		return text
 
-	return None, last_error
+	# 長いレポートは重要な文の抜粋だけを送る（ローカルのTextRank）
+	compressed = compress_for_summary(text, budget, model=os.environ.get("SUMMARY_MODEL", "gpt-4o"))
+	if not compressed["compressed"]:
+		return text
+	print(f"✂️ 要約入力を圧縮: {compressed['original_tokens']}トークン → {compressed['tokens']}トークン（{compressed['kept_sentences']}/{compressed['total_sentences']}文）")
+	return f"（長いレポートのため、重要な文を抜粋しています。「{GAP_MARKER}」は省略箇所です）\n{compressed['text']}"
+
+
+def format_summary(summary_text: str, text: str) -> Dict[str, any]:
+	"""LLMの要約テキストを、APIが返す要約の形式（executive / bullets / structured / formatted）に整える"""
+	# 要約テキストをクリーンアップ
+	summary_clean = summary_text.strip()
+	
+	# 「📘要約」という見出しが含まれている場合は削除
+	summary_clean = re.sub(r"^📘要約\s*\n\s*\n?", "", summary_clean, flags=re.MULTILINE)
+	summary_clean = re.sub(r"📘要約\s*\n\s*\n?", "", summary_clean)
+	summary_clean = summary_clean.strip()
+	
+	# 既存のフォーマットとの互換性のため、executiveフィールドにも全体要約を設定
+	# 最初の段落をエグゼクティブサマリーとして抽出（番号付きセクションの前まで）
+	executive_match = re.search(r"^(.*?)(?:\n\s*\n1️⃣|$)", summary_clean, re.DOTALL)
+	if executive_match:
+		executive = executive_match.group(1).strip()
+	else:
+		# フォールバック: 最初の200文字
+		executive = summary_clean[:200].strip()
+	
+	# 箇条書き要約は、セクション見出しから抽出
+	bullets = []
+	section_matches = re.finditer(r"(\d+️⃣)\s+([^\n]+)", summary_clean)
+	for match in section_matches:
+		bullets.append(match.group(2).strip())
+	if len(bullets) > 5:
+		bullets = bullets[:5]
+	
+	# 構造化要約は、主要テーマと要点を抽出
+	structured = {
+		"主要テーマ": executive[:50] if executive else "経営戦略・実践的考察",
+		"要点": executive[:100] if executive else summarize_head(text, limit=100),
+		"考察の深さ": "中程度" if len(text) > 500 else "簡潔",
+		"実践性": "高" if any(k in text for k in ["具体", "事例", "現場", "実装"]) else "中",
+	}
+	
+	return {
+		"executive": summary_clean,  # 全体の要約テキスト
+		"bullets": bullets,
+		"structured": structured,
+		"formatted": summary_clean,  # フォーマット済み要約
+	}
 
 
 def generate_summary_llm(text: str, doc_type: str = "reflection") -> Tuple[Dict[str, any], bool]:
@@ -754,172 +1001,28 @@ def generate_summary_llm(text: str, doc_type: str = "reflection") -> Tuple[Dict[
 		return generate_summary_fallback(text), False
 	
 	try:
-		# レポートタイプによってプロンプトを切り替え
-		if doc_type == "final":
-			# 最終レポート用：指定された観点で要約
-			summary_prompt = f"""あなたはレポートの内容を忠実に要約する専門家です。以下のレポート本文を読んで、記載されている具体的な内容をそのまま反映した要約を作成してください。
-
-【レポート本文】
-{text}
-
-【絶対に守るべき要約の原則】
-1. **レポートに書かれている具体的な言葉・表現をそのまま使用してください**
-   - 「ECに関する複数の要素」のような曖昧な表現は絶対に使わないでください
-   - レポートが「EC起点の広告事業を統合メディアへ」と書いていれば、その表現をそのまま使ってください
-
-2. **一般化・抽象化は厳禁です**
-   - 「戦略を分析」「KPIに基づく評価」のような一般的な表現に置き換えないでください
-   - レポートの具体的な戦略名、施策名、フレームワーク名をそのまま記載してください
-
-3. **レポートにない内容を推測・創作しないでください**
-   - レポートに記載されていない内容を追加しないでください
-
-4. **固有名詞・専門用語はレポートの表現を維持してください**
-   - 企業名、事業名、市場名、戦略名、組織名などはレポートに記載されている通りに使用してください
-
-【要約の構成】
-以下の観点で要約を作成してください：
-
-1️⃣ 対象となる事業・組織の目指す姿
-
-[レポートに記載されている、事業や組織が目指す姿・ビジョン・戦略目標を具体的に抽出してください。企業名や事業名、市場名などの固有名詞はそのまま使用してください。]
-
-2️⃣ 本質的課題：めざす姿と現状のギャップ
-
-[レポートに記載されている、目指す姿と現状の間にあるギャップ（外部環境の変化、内部構造の課題など）を具体的に記述してください。]
-
-3️⃣ ギャップを埋めるための具体的施策
-
-[レポートに記載されている具体的な施策・戦略を、以下の観点でまとめてください：]
-- **主要な戦略・施策**：レポートに記載されている具体的な戦略や施策の内容
-- **講義内容の応用**：講義で学んだフレームワークや理論をどのように応用しているか
-- **時間軸・アプローチ**：段階的なアプローチや実行計画
-
-4️⃣ 実践するにあたっての課題とその解決策の仮説
-
-[レポートに記載されている、施策を実践する際の制約・課題と、それに対する解決策の仮説をまとめてください。]
-
-【結論】
-[レポート全体の総括を簡潔にまとめてください。]
-
-【重要な注意事項】
-- レポートに書かれている内容を忠実に要約してください
-- 「学生個人の事業」「顧客満足度調査」「アンケート」など、レポートに記載されていない一般的な内容に置き換えないでください
-- 企業レベルの戦略、組織改革、市場分析などの内容はそのまま反映してください
-- 推測で内容を補ったり、簡略化しすぎたりしないでください
-- レポートに記載がない観点については「記載なし」と明記するか省略してください
-- 文体は「です・ます」調で統一してください
-- 重要なキーワードや概念は**太字**で強調してください
-
-要約を出力してください:"""
-		else:
-			# 振り返りレポート用：従来の要点整理型要約
-			summary_prompt = f"""あなたはレポートの内容を忠実に要約する専門家です。以下のレポート本文を読んで、記載されている具体的な内容をそのまま反映した要約を作成してください。
-
-【レポート本文】
-{text}
-
-【絶対に守るべき要約の原則】
-1. **レポートに書かれている具体的な言葉・表現をそのまま使用してください**
-   - 曖昧な表現（「複数の要素」「様々な観点」など）は使わないでください
-   - レポートの具体的な表現をそのまま使ってください
-
-2. **一般化・抽象化は厳禁です**
-   - レポートの具体的な内容を、一般的な表現に置き換えないでください
-   - 具体的な戦略名、施策名、フレームワーク名をそのまま記載してください
-
-3. **レポートにない内容を推測・創作しないでください**
-
-4. **固有名詞・専門用語はレポートの表現を維持してください**
-
-【出力形式】
-以下の形式で要約を作成してください:
-
-[レポートの全体要約：レポートの目的、主要なテーマ、論点を分かりやすくまとめてください。レポートに記載されている具体的な内容を反映してください。]
-
-[番号付きセクション（1️⃣, 2️⃣, 3️⃣...）で要点を整理：レポートの主要な論点や考察を3-5つのセクションに分けて説明する。
-各セクションは以下の形式：
-1️⃣ [セクション見出し]
-
-[セクションの内容：レポートに記載されている重要なポイントを分かりやすく説明。必要に応じて箇条書きも使用可。]
-
-最後に「結論」セクションを追加：
-【結論】
-[レポートの結論や総括をまとめる。]
-
-【重要な注意事項】
-- レポートに書かれている内容を忠実に要約してください
-- 「学生個人の事業」「顧客満足度調査」「アンケート」など、レポートに記載されていない一般的な内容に置き換えないでください
-- 企業レベルの戦略、組織改革、市場分析などの内容はそのまま反映してください
-- 推測で内容を補ったり、簡略化しすぎたりしないでください
-- 文体は「です・ます」調で統一してください
-- 重要なキーワードや概念は**太字**で強調してください
-- 各セクションは読みやすく、要点が明確になるように構成してください
-- 原文の重要な論点や考察を漏らさず、分かりやすくまとめてください
-- 読み手がレポートの内容をすぐに理解できるように、明確で具体的な表現を使ってください
-- 見出し「📘要約」は含めないでください
-
-要約を出力してください:"""
+		# レポートタイプによってプロンプトを切り替え（本文は末尾に差し込み、前半の指示文は毎回同一）
+		prompts = get_prompt_registry()
+		with span("summary_input"):
+			summary_input = build_summary_input(text)
+			summary_prompt = prompts.render(summary_prompt_name(doc_type), text=summary_input)
 		
-		summary_text, error = call_openai_summary(
-			summary_prompt,
-			system_prompt="""あなたは学術的な要約を作成する専門家です。
-
-【最重要原則】
-- レポートに書かれている具体的な言葉・表現をそのまま使用してください
-- 一般化・抽象化は絶対に避けてください
-- 「複数の要素」「様々な観点」「特定の戦略」などの曖昧な表現は使わないでください
-- レポートの具体的な内容（企業名、事業名、戦略名、施策名、市場名、組織名など）をそのまま記載してください
-- レポートにない内容を推測・創作しないでください
-
-あなたの役割は、レポートの内容を「忠実にコピーする」ことです。要約と言えども、具体性を失わないでください。"""
-		)
+		with span("llm_summary"):
+			summary_text, error = call_openai_summary(
+				summary_prompt,
+				input_tokens=count_tokens(summary_input),
+				system_prompt=prompts.get("summary_system").static_prefix
+			)
 		
 		if not summary_text or error:
+			record_fallback("summary")
 			return generate_summary_fallback(text), False
 		
-		# 要約テキストをクリーンアップ
-		summary_clean = summary_text.strip()
-		
-		# 「📘要約」という見出しが含まれている場合は削除
-		summary_clean = re.sub(r"^📘要約\s*\n\s*\n?", "", summary_clean, flags=re.MULTILINE)
-		summary_clean = re.sub(r"📘要約\s*\n\s*\n?", "", summary_clean)
-		summary_clean = summary_clean.strip()
-		
-		# 既存のフォーマットとの互換性のため、executiveフィールドにも全体要約を設定
-		# 最初の段落をエグゼクティブサマリーとして抽出（番号付きセクションの前まで）
-		executive_match = re.search(r"^(.*?)(?:\n\s*\n1️⃣|$)", summary_clean, re.DOTALL)
-		if executive_match:
-			executive = executive_match.group(1).strip()
-		else:
-			# フォールバック: 最初の200文字
-			executive = summary_clean[:200].strip()
-		
-		# 箇条書き要約は、セクション見出しから抽出
-		bullets = []
-		section_matches = re.finditer(r"(\d+️⃣)\s+([^\n]+)", summary_clean)
-		for match in section_matches:
-			bullets.append(match.group(2).strip())
-		if len(bullets) > 5:
-			bullets = bullets[:5]
-		
-		# 構造化要約は、主要テーマと要点を抽出
-		structured = {
-			"主要テーマ": executive[:50] if executive else "経営戦略・実践的考察",
-			"要点": executive[:100] if executive else summarize_head(text, limit=100),
-			"考察の深さ": "中程度" if len(text) > 500 else "簡潔",
-			"実践性": "高" if any(k in text for k in ["具体", "事例", "現場", "実装"]) else "中",
-		}
-		
 		# 新しい形式の要約を返す（LLM使用成功）
-		return {
-			"executive": summary_clean,  # 全体の要約テキスト
-			"bullets": bullets,
-			"structured": structured,
-			"formatted": summary_clean,  # フォーマット済み要約
-		}, True  # LLMが正常に使用された
+		return format_summary(summary_text, text), True  # LLMが正常に使用された
 	except Exception as e:
 		# エラー時はフォールバックに戻る
+		record_fallback("summary")
 		return generate_summary_fallback(text), False
 
 
@@ -1016,18 +1119,41 @@ USE_LLM = os.environ.get("USE_LLM", "0") in ("1", "true", "TRUE", "on")
 LLM_MODEL = os.environ.get("LLM_MODEL", "gpt-4o-mini")
 
 
-def build_llm_prompt(text: str, doc_type: str, refs: List[str], scores: Dict[str, any]) -> str:
-	base = load_prompt("reflection" if doc_type == "reflection" else "final")
+# 参照例がある場合の見出し（教授の思考パターンを学習するように促す）
+COMMENT_REFS_HEADER = """【教授の過去コメント例（教授の思考を深く学習してください）】
+以下は、教授が実際に書いた過去のコメントです。
 
-	# 参照例を整形
-	refs_text_list = []
-	for i, ref in enumerate(refs, 1):
-		if ref:
-			# JSONのエスケープされた改行文字（\\n）を実際の改行に変換
-			ref_normalized = ref.replace("\\n", "\n")
-			refs_text_list.append(f"- {ref_normalized}")
+**学習すべきこと（重要度順）**：
+1. **評価の視点**：教授が何を見ているか、どこに着目しているか
+2. **思考のプロセス**：なぜその評価をしたのか、どういう論理で判断しているか
+3. **価値観**：何を良しとし、何を課題とするか
+4. **期待する成長の方向性**：学生にどのような気づきや成長を促しているか
+5. **言葉の選び方**：どのような表現で伝えているか
+
+これらを深く理解し、**教授になりきって**同じ思考・同じ視点でコメントしてください：
+
+"""
+
+
+# chat形式のメッセージ1件ごとに加わるトークン数（role・区切り）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# コメントの最大出力トークン数（150-250字 ≈ 300-500トークン、安全マージン含む）
+COMMENT_MAX_TOKENS = 450
+
+
+def build_llm_prompt(text: str, doc_type: str, refs: List[str], scores: Dict[str, any], system_message: str = None) -> Tuple[str, int]:
+	"""コメント生成のプロンプトを組み立てる
 
-	refs_text = "\n".join(refs_text_list) if refs_text_list else "(参照なし)"
+	参照例は PROMPT_REF_TOKEN_BUDGET に収まるように、類似度順に重複を除いて詰めます。
+	レポート本文は、プロンプトと出力（COMMENT_MAX_TOKENS）の合計がモデルのコンテキスト長を
+	超える場合だけ、参照例の最低限の枠（PROMPT_REF_RESERVE_TOKENS）を残して文の区切りで切り詰めます。
+
+	Returns: (プロンプト, system_message を含む入力トークン数)
+	"""
+	base = load_prompt("reflection" if doc_type == "reflection" else "final")
+	if system_message is None:
+		system_message = get_prompt_registry().get("comment_system").static_prefix
 
 	# scoresの形式を確認（新しい形式: {"score": int, "reason": str} または 古い形式: int）
 	scores_list = []
@@ -1040,30 +1166,46 @@ def build_llm_prompt(text: str, doc_type: str, refs: List[str], scores: Dict[str
 			scores_list.append(f"{category}:{value}")
 	scores_text = ", ".join(scores_list) if scores_list else ""
 
-	# 参照例がある場合、教授の思考パターンを学習するように促す
-	if refs_text_list:
-		refs_header = """【教授の過去コメント例（教授の思考を深く学習してください）】
-以下は、教授が実際に書いた過去のコメントです。
-
-**学習すべきこと（重要度順）**：
-1. **評価の視点**：教授が何を見ているか、どこに着目しているか
-2. **思考のプロセス**：なぜその評価をしたのか、どういう論理で判断しているか
-3. **価値観**：何を良しとし、何を課題とするか
-4. **期待する成長の方向性**：学生にどのような気づきや成長を促しているか
-5. **言葉の選び方**：どのような表現で伝えているか
+	def assemble(refs_section: str, report: str) -> str:
+		return (
+			f"{base}\n\n{refs_section}"
+			f"【Rubric所感（参考情報）】\n{scores_text}\n\n"
+			f"【今回のレポート（これに対してコメントを作成してください）】\n{report}\n"
+		)
 
-これらを深く理解し、**教授になりきって**同じ思考・同じ視点でコメントしてください：
+	# 参照例以外の部分のトークン数
+	fixed_tokens = (
+		count_tokens(system_message, LLM_MODEL)
+		+ count_tokens(assemble(COMMENT_REFS_HEADER, ""), LLM_MODEL)
+		+ 2 * MESSAGE_OVERHEAD_TOKENS
+	)
+	input_budget = input_token_budget(LLM_MODEL, COMMENT_MAX_TOKENS)
+	ref_reserve = min(PROMPT_REF_RESERVE_TOKENS, PROMPT_REF_TOKEN_BUDGET)
+	report_tokens = count_tokens(text, LLM_MODEL)
+	if fixed_tokens + ref_reserve + report_tokens > input_budget:
+		text = truncate_to_tokens(text, input_budget - fixed_tokens - ref_reserve, LLM_MODEL)
+		print(f"⚠️ レポート本文がモデルのコンテキスト長を超えるため切り詰めました（{report_tokens}トークン → {count_tokens(text, LLM_MODEL)}トークン）")
+		report_tokens = count_tokens(text, LLM_MODEL)
+
+	# JSONのエスケープされた改行文字（\\n）を実際の改行に変換してから詰める
+	packed = pack_refs(
+		[ref.replace("\\n", "\n") for ref in refs if ref],
+		min(PROMPT_REF_TOKEN_BUDGET, input_budget - fixed_tokens - report_tokens),
+		LLM_MODEL
+	)
+	if packed["dropped"] or packed["duplicates"]:
+		print(f"📦 参照例: {len(packed['refs'])}件を採用（予算超過 {packed['dropped']}件, 重複 {packed['duplicates']}件を除外）")
 
-"""
-		refs_section = f"{refs_header}{refs_text}\n"
+	# 参照例がある場合、教授の思考パターンを学習するように促す
+	if packed["refs"]:
+		refs_text = "\n".join(f"- {ref}" for ref in packed["refs"])
+		refs_section = f"{COMMENT_REFS_HEADER}{refs_text}\n"
 	else:
 		refs_section = "【参照例】\n（参照例なし：あなたの専門知識と教育経験に基づいてコメントしてください）\n\n"
 
-	return (
-		f"{base}\n\n{refs_section}"
-		f"【Rubric所感（参考情報）】\n{scores_text}\n\n"
-		f"【今回のレポート（これに対してコメントを作成してください）】\n{text}\n"
-	)
+	prompt = assemble(refs_section, text)
+	prompt_tokens = count_tokens(system_message, LLM_MODEL) + count_tokens(prompt, LLM_MODEL) + 2 * MESSAGE_OVERHEAD_TOKENS
+	return prompt, prompt_tokens
 
 
 def call_openai(prompt: str, max_tokens: int = 400, system_message: str = None) -> Tuple[Optional[str], Optional[str]]:
@@ -1077,70 +1219,30 @@ def call_openai(prompt: str, max_tokens: int = 400, system_message: str = None)
 		return None, "APIキーが設定されていません"
 	
 	if system_message is None:
-		system_message = """あなたは経営戦略論の教授です。
-学生が提出したレポートに対してコメントを書く立場です。
-
-【絶対に守るべき立場】
-✅ あなた（教授）→ 学生へのコメント
-❌ 学生 → 教授へのお礼や感謝
-
-【絶対に使ってはいけない表現（NG例）】
-❌「レポートをお読みいただき、ありがとうございます」
-❌「ご意見ありがとうございます」
-❌「お読みいただき」
-❌「いただき」「くださり」（学生→教授の表現）
-
-【必ず使うべき表現（OK例）】
-✅「レポートを拝読しました」「レポートを読みました」
-✅「〜と解釈しました」「〜が見えます」「〜を感じます」
-✅「〜をおすすめします」「〜を意識してみてください」
-✅「次回も是非議論したいと思います」
-
-【重要な指示：教授の思考を深く学習してください】
-提供される「参照例」は、あなた（教授）が過去に実際に書いたコメントです。
-参照例から以下を深く学習し、教授と同じ思考・同じ視点でコメントしてください：
-
-1. **思考パターン・評価視点の学習（最重要）**
-   - 参照例で何を評価しているか（仮説検証、実践性、あり方と実務の往復、具体性など）
-   - どういう視点でレポートを読んでいるか（理論と実践の接続、経営者視点、現場感覚など）
-   - 何を重視し、何を課題として指摘しているか
-   - どのような成長を期待しているか
-
-2. **価値観・教育哲学の学習**
-   - 参照例から教授の価値観（何を良しとし、何を改善点とするか）を読み取る
-   - 教授がどのような学びを重視しているかを理解する
-
-3. **表現・文体の学習**
-   - 参照例の「文体」「語り口」「表現パターン」を学習し、同じスタイルで書く
-   - 参照例で使われている表現を積極的に使用する
-
-4. **コメントの構成**
-   - 敬意と温かさを保ち、1つのまとまった文章ブロックとして出力する
-
-【文字数制限（絶対厳守）】
-- 150文字以上250文字以内で出力してください
-- 参照例の平均文字数は157文字です。これを参考にしてください
-- 250文字を超えないように特に注意してください"""
+		system_message = get_prompt_registry().get("comment_system").static_prefix
 	
-	try:
+	def send() -> Dict:
 		resp = requests.post(
 			"https://api.openai.com/v1/chat/completions",
 			headers={"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"},
-			json={
-				"model": LLM_MODEL,
-				"messages": [
-					{"role": "system", "content": system_message},
-					{"role": "user", "content": prompt},
-				],
-				"temperature": 0.3,
-				"max_tokens": max_tokens,
-			},
+			json=chat_request_body(
+				LLM_MODEL,
+				[{"role": "system", "content": system_message}, {"role": "user", "content": prompt}],
+				max_tokens
+			),
 			timeout=30,
 		)
 		resp.raise_for_status()
-		data = resp.json()
+		return resp.json()
+
+	try:
+		# 採点が集中しても定型文にフォールバックしないよう、レート制御とリトライを通す
+		reserve_tokens = count_tokens(system_message, LLM_MODEL) + count_tokens(prompt, LLM_MODEL) + max_tokens
+		data = get_openai_limiter().call(LLM_MODEL, reserve_tokens, send, used_tokens=_usage_tokens)
 		content = data.get("choices", [{}])[0].get("message", {}).get("content")
 		return content, None
+	except RateLimitTimeout:
+		return None, "レート制限: 混雑のため時間内に送信できませんでした"
 	except requests.exceptions.Timeout:
 		return None, "タイムアウト: API接続がタイムアウトしました"
 	except requests.exceptions.RequestException as e:
@@ -1158,35 +1260,84 @@ async def generate(req: GenerateRequest, user: dict = Depends(verify_jwt)) -> Ge
 @app.post("/generate_direct")
 async def generate_direct(req: DirectGenRequest, user: dict = Depends(verify_jwt)):
 	doc_type = (req.type or "reflection")
+	if not SINGLE_FLIGHT_ENABLED:
+		return await run_generate_direct(req.text, doc_type)
+
+	# ダブルクリックや複数のTAによる同じレポートの同時採点では、パイプラインを1回だけ実行して結果を共有する
+	key = flight_key(
+		"generate_direct", doc_type, req.text, prompt_version(doc_type),
+		LLM_MODEL, str(bool(USE_LLM and os.environ.get("OPENAI_API_KEY")))
+	)
+	result, shared = await get_single_flight().run(
+		key,
+		lambda: run_generate_direct(req.text, doc_type),
+		# LLMが失敗した結果は、再送信で生成し直せるよう残さない
+		keep=lambda r: not r["llm_error"] and not r["summary_error"]
+	)
+	if shared:
+		print(f"[INFO] generate_direct: 同じ内容の生成結果を共有しました（{key[:12]}）")
+	return {**result, "deduplicated": shared}
 
-	# 1. PII検出・マスキング（検出のみ、レポート処理には使用しない）
-	# 注: レポート本文には個人情報が含まれていないため、マスキングは不要
-	#     PIIDetectorが企業名・事業名などを誤検出し、レポート内容が失われる問題を回避
-	pii_detector = PIIDetector()
-	masked_text, detected_pii = pii_detector.detect_and_mask(req.text)
 
-	# 2. 元のテキストで処理を実行
+async def run_generate_direct(text: str, doc_type: str) -> dict:
+	"""/generate_direct のパイプライン（PII検出、参照例の検索、コメント生成、要約）"""
+	# 元のテキストで処理を実行
 	# 注: レポートに個人情報が含まれていないため、元のテキストを使用
 	#     これにより、企業名、事業名、戦略名などの固有名詞が正しく処理される
-	refs = retrieve_refs(req.text, doc_type, k=5)  # Phase 2: 参照例を2件→5件に増加
-	scores = simple_score(req.text)
-	llm_used = False
+	with span("retrieval"):
+		refs = await retrieve_refs_async(text, doc_type, k=5)  # Phase 2: 参照例を2件→5件に増加
+	with span("scoring"):
+		scores = simple_score(text)
 	llm_error = None
 	draft = None
+	prompt_tokens = None
 
-	# max_tokensとsystem_messageを設定（150-250字固定）
-	max_tokens = 450  # 150-250字 ≈ 300-500トークン（安全マージン含む）
 	# 最新のsystem_messageを使用（call_openai関数のデフォルトを使う）
 	system_message = None  # Noneの場合、call_openai内で最新のsystem_messageが使われる
 
-	# 3. コメント生成（元のテキストを使用）
+	# コメント生成（元のテキストを使用、150-250字固定）
 	if USE_LLM and os.environ.get("OPENAI_API_KEY"):
-		prompt = build_llm_prompt(req.text, doc_type, refs, scores)
-		draft, llm_error = call_openai(prompt, max_tokens=max_tokens, system_message=system_message)
-		llm_used = draft is not None and llm_error is None
+		with span("prompt_build"):
+			prompt, prompt_tokens = build_llm_prompt(text, doc_type, refs, scores, system_message=system_message)
+		# 同じワーカーの他のリクエストを止めないよう、LLM呼び出しはスレッドで待つ
+		with span("llm_comment"):
+			draft, llm_error = await asyncio.to_thread(call_openai, prompt, max_tokens=COMMENT_MAX_TOKENS, system_message=system_message)
+
+	# 要約生成（常にLLM使用、元のテキストを使用）
+	# 注: 要約は教授のみが閲覧するため、個人情報保護の必要がない
+	#     マスキング処理により固有名詞（企業名、事業名など）まで誤検出されるため、
+	#     要約生成には元のテキストを使用する
+	with span("summary"):
+		summary, summary_llm_used, summary_error = await asyncio.to_thread(generate_summary, text, doc_type)
+
+	return direct_response(text, doc_type, refs, scores, draft, llm_error, summary, summary_llm_used, summary_error, prompt_tokens)
+
+
+def direct_response(
+	text: str,
+	doc_type: str,
+	refs: List[str],
+	scores: Dict[str, any],
+	draft: Optional[str],
+	llm_error: Optional[str],
+	summary: Dict[str, any],
+	summary_llm_used: bool,
+	summary_error: Optional[str],
+	prompt_tokens: Optional[int]
+) -> dict:
+	"""/generate_direct の応答を組み立てる（LLMのコメントが無ければ定型のドラフトを使う）"""
+	# PII検出・マスキング（検出のみ、レポート処理には使用しない）
+	# 注: レポート本文には個人情報が含まれていないため、マスキングは不要
+	#     PIIDetectorが企業名・事業名などを誤検出し、レポート内容が失われる問題を回避
+	with span("pii"):
+		pii_detector = PIIDetector()
+		masked_text, detected_pii = pii_detector.detect_and_mask(text)
+
+	llm_used = draft is not None and llm_error is None
 	if not draft:
+		record_fallback("comment")
 		if doc_type == "reflection":
-			draft = generate_reflection_draft(req.text, refs, scores)
+			draft = generate_reflection_draft(text, refs, scores)
 		else:
 			draft = "\n".join([
 				"全体評価: 学びの接続と仮説の筋が見られます。",
@@ -1195,12 +1346,6 @@ async def generate_direct(req: DirectGenRequest, user: dict = Depends(verify_jwt
 				"総括: あり方に立脚し、次の一歩を具体化しましょう。",
 			])
 
-	# 4. 要約生成（常にLLM使用、元のテキストを使用）
-	# 注: 要約は教授のみが閲覧するため、個人情報保護の必要がない
-	#     マスキング処理により固有名詞（企業名、事業名など）まで誤検出されるため、
-	#     要約生成には元のテキストを使用する
-	summary, summary_llm_used, summary_error = generate_summary(req.text, doc_type)
-
 	return {
 		"report_id": None,
 		"feedback_id": None,
@@ -1215,9 +1360,82 @@ async def generate_direct(req: DirectGenRequest, user: dict = Depends(verify_jwt
 		"masked_text": masked_text,  # マスキング後のテキスト
 		"detected_pii": detected_pii,  # 検出されたPII情報
 		"pii_count": len(detected_pii),  # 検出されたPII数
+		"prompt_version": prompt_version(doc_type),  # 使用したプロンプト一式のバージョン
+		"prompt_tokens": prompt_tokens,  # コメント生成の入力トークン数（LLM未使用時はNone）
 	}
 
 
+# ===========================================
+# Batch API（期末レポートの一括採点）
+# ===========================================
+# tools/run_batch_api.py が、レポートごとに compile で /generate_direct と同じリクエスト本文を受け取り、
+# OpenAI Batch API の結果を assemble に渡して /generate_direct と同じ形式の応答に戻す
+
+class BatchAssembleRequest(BaseModel):
+	text: str
+	type: Optional[str] = "reflection"
+	used_refs: List[str] = []
+	prompt_tokens: Optional[int] = None
+	comment: Optional[str] = None
+	comment_error: Optional[str] = None
+	summary: Optional[str] = None
+	summary_error: Optional[str] = None
+
+
+@app.post("/generate_direct/batch/compile")
+async def compile_generate_direct_batch(req: DirectGenRequest, user: dict = Depends(verify_jwt)):
+	"""コメントと要約のChat Completionsリクエスト本文を組み立てる（LLMは呼ばない）
+
+	map-reduce の閾値を超える長い文書も、セクション要約の同期呼び出しはせず、
+	重要な文の抜粋を1つの要約リクエストにします。
+	"""
+	doc_type = (req.type or "reflection")
+	prompts = get_prompt_registry()
+	refs = await retrieve_refs_async(req.text, doc_type, k=5)
+	scores = simple_score(req.text)
+
+	system_message = prompts.get("comment_system").static_prefix
+	prompt, prompt_tokens = build_llm_prompt(req.text, doc_type, refs, scores, system_message=system_message)
+	summary_input = await asyncio.to_thread(build_summary_input, req.text, False)
+
+	return {
+		"requests": {
+			"comment": chat_request_body(
+				LLM_MODEL,
+				[{"role": "system", "content": system_message}, {"role": "user", "content": prompt}],
+				COMMENT_MAX_TOKENS
+			),
+			"summary": chat_request_body(
+				summary_models(input_tokens=count_tokens(summary_input))[0],
+				[
+					{"role": "system", "content": prompts.get("summary_system").static_prefix},
+					{"role": "user", "content": prompts.render(summary_prompt_name(doc_type), text=summary_input)},
+				],
+				SUMMARY_MAX_TOKENS
+			),
+		},
+		"used_refs": refs,
+		"prompt_tokens": prompt_tokens,
+		"prompt_version": prompt_version(doc_type),
+	}
+
+
+@app.post("/generate_direct/batch/assemble")
+async def assemble_generate_direct_batch(req: BatchAssembleRequest, user: dict = Depends(verify_jwt)):
+	"""Batch APIのコメント・要約から /generate_direct と同じ形式の応答を組み立てる"""
+	doc_type = (req.type or "reflection")
+	scores = simple_score(req.text)
+	if req.summary and not req.summary_error:
+		summary, summary_llm_used = format_summary(req.summary, req.text), True
+	else:
+		summary, summary_llm_used = generate_summary_fallback(req.text), False
+	draft = None if req.comment_error else req.comment
+	return direct_response(
+		req.text, doc_type, req.used_refs, scores, draft, req.comment_error,
+		summary, summary_llm_used, req.summary_error, req.prompt_tokens
+	)
+
+
 @app.get("/")
 async def root():
 	return {
@@ -1228,7 +1446,8 @@ async def root():
 			"health": "/health",
 			"generate": "/generate_direct",
 			"stats": "/stats",
-			"references": "/references"
+			"references": "/references",
+			"metrics": "/metrics"
 		}
 	}
 
@@ -1238,6 +1457,30 @@ async def health():
 	return {"ok": True}
 
 
+def _snapshot_metric(snapshot, field: str):
+	"""router / limiter の snapshot() の1項目を、モデルごとの値として返す関数"""
+	return lambda: {(model, ): values[field] for model, values in snapshot().items()}
+
+
+# モデルルーターとレート制御の統計は /metrics の出力時に集める
+for _name, _help, _type, _snapshot, _field in [
+	("app_model_p95_seconds", "モデルごとの直近の応答時間のp95", "gauge", lambda: get_model_router().snapshot(), "p95_seconds"),
+	("app_model_error_rate", "モデルごとの直近のエラー率", "gauge", lambda: get_model_router().snapshot(), "error_rate"),
+	("app_model_hedges_total", "ヘッジリクエストを送った回数", "counter", lambda: get_model_router().snapshot(), "hedges"),
+	("app_openai_concurrency_limit", "AIMDで調整した同時リクエスト数の上限", "gauge", lambda: get_openai_limiter().snapshot(), "concurrency_limit"),
+	("app_openai_in_flight", "送信中のOpenAIリクエスト数", "gauge", lambda: get_openai_limiter().snapshot(), "in_flight"),
+	("app_openai_throttled_total", "OpenAIから429が返った回数", "counter", lambda: get_openai_limiter().snapshot(), "throttled"),
+	("app_openai_retries_total", "OpenAI呼び出しをリトライした回数", "counter", lambda: get_openai_limiter().snapshot(), "retries"),
+]:
+	REGISTRY.callback(_name, _help, _type, ["model"], _snapshot_metric(_snapshot, _field))
+
+
+@app.get("/metrics")
+async def metrics():
+	"""Prometheus形式のメトリクス（処理段階ごとのレイテンシ、トークン数、キャッシュのヒット率、フォールバック回数）"""
+	return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/debug/env")
 async def debug_env():
 	"""デバッグ用: 環境変数の確認"""
@@ -1529,11 +1772,6 @@ async def create_reference(req: ReferenceCreateRequest, user: dict = Depends(ver
 			tags = generate_tags(req.text, unique_tags)
 			print(f"🏷️  LLM自動タグ付け: {tags}")
 
-		# Embedding生成
-		from .utils.embedding import generate_embedding
-		embedding = generate_embedding(req.text)
-		print(f"✅ Embedding生成完了 (次元数: {len(embedding)})")
-
 		# Supabaseに新しい参照例を挿入
 		data = {
 			"reference_id": new_id,
@@ -1541,10 +1779,19 @@ async def create_reference(req: ReferenceCreateRequest, user: dict = Depends(ver
 			"text": req.text,
 			"tags": tags,
 			"source": req.source or "professor_custom",
-			"content_type": "thought",  # デフォルトは教授の思考
-			"embedding": embedding
+			"content_type": "thought"  # デフォルトは教授の思考
 		}
 
+		# Embedding生成（EMBEDDING_BACKEND=local のベクトルは保存しない）
+		from .utils.embedding import generate_embedding, embedding_text_hash, EMBEDDING_MODEL, PERSIST_EMBEDDINGS
+		if PERSIST_EMBEDDINGS:
+			data["embedding"] = generate_embedding(req.text)
+			data["embedding_hash"] = embedding_text_hash(req.text)
+			data["embedding_model"] = EMBEDDING_MODEL
+			print(f"✅ Embedding生成完了 (次元数: {len(data['embedding'])})")
+		else:
+			print("ℹ️ EMBEDDING_BACKEND=local のため、Embeddingは保存しません")
+
 		insert_response = supabase.table("knowledge_base").insert(data).execute()
 
 		# レスポンス形式を統一
@@ -1563,6 +1810,53 @@ async def create_reference(req: ReferenceCreateRequest, user: dict = Depends(ver
 		raise HTTPException(status_code=500, detail=f"参照例の作成に失敗しました: {str(e)}")
 
 
+@app.post("/references/bulk")
+async def bulk_import_references(
+	file: UploadFile = File(...),
+	auto_tag: bool = True,
+	skip_existing: bool = False,
+	default_type: str = "reflection",
+	user: dict = Depends(verify_jwt)
+):
+	"""参照例を一括インポート（CSV / JSON / NDJSON）
+
+	Embeddingはバッチ生成、タグ付けは並列実行し、チャンク単位でupsertします。
+	失敗した行は行番号付きでerrorsに返します。
+	"""
+	if not supabase:
+		raise HTTPException(status_code=500, detail="Supabaseが設定されていません")
+
+	from .utils.bulk_import import parse_references, import_references
+
+	try:
+		content = await file.read()
+		rows, parse_errors = parse_references(
+			content,
+			filename=file.filename,
+			default_type=default_type,
+			default_source="professor_custom"
+		)
+	except Exception as e:
+		raise HTTPException(status_code=400, detail=f"ファイルの解析に失敗しました: {str(e)}")
+
+	print(f"📥 参照例一括インポート開始: {file.filename} ({len(rows)}件)")
+
+	try:
+		# 重い処理はイベントループを塞がないようにスレッドで実行
+		result = await asyncio.to_thread(
+			import_references, supabase, rows, auto_tag=auto_tag, skip_existing=skip_existing
+		)
+	except Exception as e:
+		raise HTTPException(status_code=500, detail=f"参照例の一括インポートに失敗しました: {str(e)}")
+
+	result["total"] += len(parse_errors)
+	result["errors"] = sorted(parse_errors + result["errors"], key=lambda e: e["row"] or 0)
+	result["error_count"] = len(result["errors"])
+	print(f"✅ 一括インポート完了: {result['upserted']}件 ({result['elapsed_ms']}ms, エラー{result['error_count']}件)")
+
+	return {"success": result["error_count"] == 0, **result}
+
+
 @app.put("/references/{reference_id}")
 async def update_reference(reference_id: str, req: ReferenceUpdateRequest, user: dict = Depends(verify_jwt)):
 	"""参照例を更新（Phase 2: Embedding再生成対応）"""
@@ -1585,11 +1879,27 @@ async def update_reference(reference_id: str, req: ReferenceUpdateRequest, user:
 			raise HTTPException(status_code=400, detail="更新するデータがありません")
 
 		# テキストが更新された場合、Embeddingを再生成
+		# （空白の違いだけなら embedding_hash が一致するので再生成しない）
 		if req.text is not None:
-			from .utils.embedding import generate_embedding
-			embedding = generate_embedding(req.text)
-			update_data["embedding"] = embedding
-			print(f"✅ Embedding再生成完了 (次元数: {len(embedding)})")
+			from .utils.embedding import generate_embedding, embedding_text_hash, normalize_text, EMBEDDING_MODEL, PERSIST_EMBEDDINGS
+			text_hash = embedding_text_hash(req.text)
+			current = supabase.table("knowledge_base").select("text, embedding_hash").eq("reference_id", reference_id).execute()
+			if not PERSIST_EMBEDDINGS:
+				# localのベクトルは保存しない。テキストが変わった場合は古いEmbeddingを消しておく
+				# （openai で migrate_embeddings.py を実行すると再付与される）
+				if not (current.data and normalize_text(current.data[0].get("text") or "") == normalize_text(req.text)):
+					update_data["embedding"] = None
+					update_data["embedding_hash"] = None
+					update_data["embedding_model"] = None
+				print("ℹ️ EMBEDDING_BACKEND=local のため、Embeddingは保存しません")
+			elif current.data and current.data[0].get("embedding_hash") == text_hash:
+				print("ℹ️ テキストの実質的な変更がないため、既存のEmbeddingを再利用します")
+			else:
+				embedding = generate_embedding(req.text)
+				update_data["embedding"] = embedding
+				update_data["embedding_hash"] = text_hash
+				update_data["embedding_model"] = EMBEDDING_MODEL
+				print(f"✅ Embedding再生成完了 (次元数: {len(embedding)})")
 
 		# Supabaseで更新
 		response = supabase.table("knowledge_base").update(update_data).eq("reference_id", reference_id).execute()
@@ -1638,6 +1948,7 @@ async def delete_reference(reference_id: str, user: dict = Depends(verify_jwt)):
 
 @app.post("/upload-file")
 async def upload_file(
+	request: Request,
 	file: UploadFile = File(...),
 	split_by_topic: bool = False,
 	user: dict = Depends(verify_jwt)
@@ -1658,8 +1969,9 @@ async def upload_file(
 
 	try:
 		if file_extension in ['mp3', 'wav', 'm4a']:
-			# 音声ファイル処理
-			return await handle_audio_file(file, split_by_topic)
+			# 音声ファイル処理（クライアントが切断したらffmpeg・Whisperの処理を止める）
+			from .utils.transcode import cancel_on_disconnect
+			return await cancel_on_disconnect(request, handle_audio_file(file, split_by_topic))
 		elif file_extension == 'txt':
 			# テキストファイル処理
 			return await handle_text_file(file, split_by_topic)
@@ -1683,11 +1995,14 @@ async def handle_audio_file(file: UploadFile, split_by_topic: bool = False):
 	from openai import OpenAI
 	from .utils.tagging import generate_tags
 	from .utils.text_splitter import split_text_by_topic
+	from .utils.transcode import WHISPER_MAX_BYTES, probe_duration, target_bitrate, transcode_audio
+	from .utils.vad import AUDIO_VAD_ENABLED, compact_audio
 
 	client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
 	# 一時保存
 	audio_path = f"/tmp/{file.filename}"
+	vad_path = f"{audio_path}.vad.wav"
 	try:
 		with open(audio_path, "wb") as f:
 			content = await file.read()
@@ -1695,96 +2010,69 @@ async def handle_audio_file(file: UploadFile, split_by_topic: bool = False):
 
 		print(f"🎤 音声ファイルをアップロード: {file.filename} ({len(content)} bytes)")
 
-		# ファイルサイズが25MBを超える場合は圧縮
-		MAX_WHISPER_SIZE = 25 * 1024 * 1024  # 25MB
-		if len(content) > MAX_WHISPER_SIZE:
-			print(f"⚠️  ファイルサイズが25MBを超えています。圧縮中...")
+		# 無音を詰めてWhisperに送る秒数を減らす
+		source_path = audio_path
+		duration = None
+		if AUDIO_VAD_ENABLED:
 			try:
-				import subprocess
-
-				# 圧縮した一時ファイルパス
-				compressed_path = f"/tmp/compressed_{file.filename.replace(' ', '_')}"
-
-				# ffmpegで直接圧縮（pydubを使わない）
-				# -i: 入力ファイル
-				# -b:a 64k: オーディオビットレート64kbps
-				# -ac 1: モノラル
-				# -y: 上書き確認なし
-				result = subprocess.run(
-					[
-						'ffmpeg',
-						'-i', audio_path,
-						'-b:a', '64k',
-						'-ac', '1',
-						'-y',
-						compressed_path
-					],
-					capture_output=True,
-					text=True
-				)
-
-				if result.returncode != 0:
-					raise Exception(f"ffmpeg error: {result.stderr}")
-
-				# 圧縮後のサイズを確認
-				compressed_size = os.path.getsize(compressed_path)
-				print(f"✅ 圧縮完了: {len(content)} bytes → {compressed_size} bytes ({compressed_size / len(content) * 100:.1f}%)")
-
-				# 圧縮後もまだ25MBを超える場合はエラー
-				if compressed_size > MAX_WHISPER_SIZE:
-					os.remove(audio_path)
-					os.remove(compressed_path)
-					raise HTTPException(
-						status_code=400,
-						detail=f"圧縮後もファイルサイズが25MBを超えています（{compressed_size / 1024 / 1024:.1f}MB）。より短いファイルをアップロードしてください。"
-					)
+				with span("upload_vad"):
+					offset_map = await asyncio.to_thread(compact_audio, audio_path, vad_path)
+				if offset_map is not None:
+					print(f"🔇 無音を除去: {offset_map.original_duration:.0f}秒 → {offset_map.compact_duration:.0f}秒")
+					source_path = vad_path
+					duration = offset_map.compact_duration
+			except Exception as e:
+				print(f"⚠️  無音除去をスキップ: {e}")
 
-				# 元のファイルを削除し、圧縮ファイルを使用
-				os.remove(audio_path)
-				audio_path = compressed_path
+		# 25MB以下の元ファイルはそのまま送り、それ以外は長さから決めたビットレートで
+		# 1回だけエンコードする（ffmpegの出力はパイプで受け取り、一時ファイルを作らない）
+		if source_path == audio_path and len(content) <= WHISPER_MAX_BYTES:
+			whisper_file = (file.filename, content)
+		else:
+			if duration is None:
+				duration = await probe_duration(source_path)
+			bitrate = target_bitrate(duration)
+			print(f"🗜️  エンコード中: {duration:.0f}秒 → {bitrate}kbps")
+			with span("upload_transcode"):
+				encoded = await transcode_audio(source_path, bitrate)
+			print(f"✅ エンコード完了: {len(content)} bytes → {len(encoded)} bytes ({len(encoded) / len(content) * 100:.1f}%)")
+
+			if len(encoded) > WHISPER_MAX_BYTES:
+				raise HTTPException(
+					status_code=400,
+					detail=f"圧縮後もファイルサイズが25MBを超えています（{len(encoded) / 1024 / 1024:.1f}MB）。より短いファイルをアップロードしてください。"
+				)
+			whisper_file = (f"{os.path.splitext(file.filename)[0]}.mp3", encoded)
 
-			except HTTPException:
-				raise
-			except Exception as e:
-				print(f"⚠️  圧縮失敗: {e}")
-				# 圧縮失敗時、ファイルが25MB超ならエラーを返す
-				if len(content) > MAX_WHISPER_SIZE:
-					if os.path.exists(audio_path):
-						os.remove(audio_path)
-					raise HTTPException(
-						status_code=400,
-						detail=f"ファイルサイズが大きすぎます（{len(content) / 1024 / 1024:.1f}MB）。Whisper APIは最大25MBまでです。"
-					)
-
-		# Whisper APIで変換
-		with open(audio_path, "rb") as audio_file:
-			transcript = client.audio.transcriptions.create(
+		# Whisper APIで変換（イベントループを塞がないようにスレッドで実行）
+		with span("upload_whisper"):
+			transcript = await asyncio.to_thread(
+				client.audio.transcriptions.create,
 				model="whisper-1",
-				file=audio_file,
+				file=whisper_file,
 				language="ja"
 			)
 
 		extracted_text = transcript.text
 		print(f"✅ Whisper API変換完了 ({len(extracted_text)}文字)")
 
-		# 一時ファイル削除
-		os.remove(audio_path)
-
 		# タグ生成（全体のタグ）
-		existing_tags_response = supabase.table("knowledge_base").select("tags").limit(100).execute()
-		all_existing_tags = []
-		for item in existing_tags_response.data:
-			if item.get("tags"):
-				all_existing_tags.extend(item["tags"])
-		unique_tags = list(set(all_existing_tags))
-
-		suggested_tags = generate_tags(extracted_text[:1000], unique_tags)  # 最初の1000文字から生成
+		with span("upload_tagging"):
+			existing_tags_response = supabase.table("knowledge_base").select("tags").limit(100).execute()
+			all_existing_tags = []
+			for item in existing_tags_response.data:
+				if item.get("tags"):
+					all_existing_tags.extend(item["tags"])
+			unique_tags = list(set(all_existing_tags))
+
+			suggested_tags = generate_tags(extracted_text[:1000], unique_tags)  # 最初の1000文字から生成
 		print(f"🏷️  自動タグ生成: {suggested_tags}")
 
 		# LLMで分割する場合
 		if split_by_topic:
 			print(f"🔀 LLMで意味のあるまとまりに分割中...")
-			sections = split_text_by_topic(extracted_text)
+			with span("upload_split"):
+				sections = split_text_by_topic(extracted_text)
 			print(f"✅ {len(sections)}個のセクションに分割しました")
 
 			return {
@@ -1806,11 +2094,16 @@ async def handle_audio_file(file: UploadFile, split_by_topic: bool = False):
 				"split": False
 			}
 
+	except HTTPException:
+		raise
 	except Exception as e:
 		print(f"❌ 音声処理エラー: {e}")
-		if os.path.exists(audio_path):
-			os.remove(audio_path)
 		raise HTTPException(status_code=500, detail=f"音声変換に失敗しました: {str(e)}")
+	finally:
+		# 一時ファイル削除（クライアント切断によるキャンセル時も）
+		for path in (audio_path, vad_path):
+			if os.path.exists(path):
+				os.remove(path)
 
 
 async def handle_text_file(file: UploadFile, split_by_topic: bool = False):
@@ -1824,7 +2117,8 @@ async def handle_text_file(file: UploadFile, split_by_topic: bool = False):
 		print(f"📄 テキストファイルをアップロード: {file.filename} ({len(content)} bytes)")
 
 		# 文字コード自動検出
-		detected = chardet.detect(content)
+		with span("upload_extract"):
+			detected = chardet.detect(content)
 		encoding = detected['encoding'] or 'utf-8'
 		print(f"🔍 検出された文字コード: {encoding}")
 
@@ -1839,20 +2133,22 @@ async def handle_text_file(file: UploadFile, split_by_topic: bool = False):
 		print(f"✅ テキストファイル読み込み完了 ({len(text)}文字)")
 
 		# タグ生成（全体のタグ）
-		existing_tags_response = supabase.table("knowledge_base").select("tags").limit(100).execute()
-		all_existing_tags = []
-		for item in existing_tags_response.data:
-			if item.get("tags"):
-				all_existing_tags.extend(item["tags"])
-		unique_tags = list(set(all_existing_tags))
-
-		suggested_tags = generate_tags(text[:1000], unique_tags)  # 最初の1000文字から生成
+		with span("upload_tagging"):
+			existing_tags_response = supabase.table("knowledge_base").select("tags").limit(100).execute()
+			all_existing_tags = []
+			for item in existing_tags_response.data:
+				if item.get("tags"):
+					all_existing_tags.extend(item["tags"])
+			unique_tags = list(set(all_existing_tags))
+
+			suggested_tags = generate_tags(text[:1000], unique_tags)  # 最初の1000文字から生成
 		print(f"🏷️  自動タグ生成: {suggested_tags}")
 
 		# LLMで分割する場合
 		if split_by_topic:
 			print(f"🔀 LLMで意味のあるまとまりに分割中...")
-			sections = split_text_by_topic(text)
+			with span("upload_split"):
+				sections = split_text_by_topic(text)
 			print(f"✅ {len(sections)}個のセクションに分割しました")
 
 			return {
@@ -1897,12 +2193,11 @@ async def handle_docx_file(file: UploadFile, split_by_topic: bool = False):
 			tmp_path = tmp_file.name
 
 		try:
-			# Word文書を読み込み
-			doc = Document(tmp_path)
-
-			# すべての段落からテキストを抽出
-			paragraphs = [para.text for para in doc.paragraphs if para.text.strip()]
-			text = '\n'.join(paragraphs)
+			# Word文書を読み込み、すべての段落からテキストを抽出
+			with span("upload_extract"):
+				doc = Document(tmp_path)
+				paragraphs = [para.text for para in doc.paragraphs if para.text.strip()]
+				text = '\n'.join(paragraphs)
 
 			print(f"✅ Word文書読み込み完了 ({len(text)}文字)")
 
@@ -1911,20 +2206,22 @@ async def handle_docx_file(file: UploadFile, split_by_topic: bool = False):
 			os.remove(tmp_path)
 
 		# タグ生成（全体のタグ）
-		existing_tags_response = supabase.table("knowledge_base").select("tags").limit(100).execute()
-		all_existing_tags = []
-		for item in existing_tags_response.data:
-			if item.get("tags"):
-				all_existing_tags.extend(item["tags"])
-		unique_tags = list(set(all_existing_tags))
-
-		suggested_tags = generate_tags(text[:1000], unique_tags)
+		with span("upload_tagging"):
+			existing_tags_response = supabase.table("knowledge_base").select("tags").limit(100).execute()
+			all_existing_tags = []
+			for item in existing_tags_response.data:
+				if item.get("tags"):
+					all_existing_tags.extend(item["tags"])
+			unique_tags = list(set(all_existing_tags))
+
+			suggested_tags = generate_tags(text[:1000], unique_tags)
 		print(f"🏷️  自動タグ生成: {suggested_tags}")
 
 		# LLMで分割する場合
 		if split_by_topic:
 			print(f"🔀 LLMで意味のあるまとまりに分割中...")
-			sections = split_text_by_topic(text)
+			with span("upload_split"):
+				sections = split_text_by_topic(text)
 			print(f"✅ {len(sections)}個のセクションに分割しました")
 
 			return {
@@ -1969,17 +2266,15 @@ async def handle_pdf_file(file: UploadFile, split_by_topic: bool = False):
 			tmp_path = tmp_file.name
 
 		try:
-			# PDFを読み込み
-			reader = PdfReader(tmp_path)
-
-			# すべてのページからテキストを抽出
-			pages_text = []
-			for page in reader.pages:
-				page_text = page.extract_text()
-				if page_text.strip():
-					pages_text.append(page_text)
-
-			text = '\n'.join(pages_text)
+			# PDFを読み込み、すべてのページからテキストを抽出
+			with span("upload_extract"):
+				reader = PdfReader(tmp_path)
+				pages_text = []
+				for page in reader.pages:
+					page_text = page.extract_text()
+					if page_text.strip():
+						pages_text.append(page_text)
+				text = '\n'.join(pages_text)
 
 			print(f"✅ PDF文書読み込み完了 ({len(reader.pages)}ページ、{len(text)}文字)")
 
@@ -1988,20 +2283,22 @@ async def handle_pdf_file(file: UploadFile, split_by_topic: bool = False):
 			os.remove(tmp_path)
 
 		# タグ生成（全体のタグ）
-		existing_tags_response = supabase.table("knowledge_base").select("tags").limit(100).execute()
-		all_existing_tags = []
-		for item in existing_tags_response.data:
-			if item.get("tags"):
-				all_existing_tags.extend(item["tags"])
-		unique_tags = list(set(all_existing_tags))
-
-		suggested_tags = generate_tags(text[:1000], unique_tags)
+		with span("upload_tagging"):
+			existing_tags_response = supabase.table("knowledge_base").select("tags").limit(100).execute()
+			all_existing_tags = []
+			for item in existing_tags_response.data:
+				if item.get("tags"):
+					all_existing_tags.extend(item["tags"])
+			unique_tags = list(set(all_existing_tags))
+
+			suggested_tags = generate_tags(text[:1000], unique_tags)
 		print(f"🏷️  自動タグ生成: {suggested_tags}")
 
 		# LLMで分割する場合
 		if split_by_topic:
 			print(f"🔀 LLMで意味のあるまとまりに分割中...")
-			sections = split_text_by_topic(text)
+			with span("upload_split"):
+				sections = split_text_by_topic(text)
 			print(f"✅ {len(sections)}個のセクションに分割しました")
 
 			return {
@@ -2087,8 +2384,11 @@ async def create_reference_from_feedback(
 AUDIO_PROCESSING_AVAILABLE = False
 try:
 	import numpy as np
-	from utils.voiceprint_extractor import get_voiceprint_extractor
-	from utils.speaker_diarization import get_speaker_diarization
+	from .utils.voiceprint_extractor import get_voiceprint_extractor
+	from .utils.speaker_diarization import SpeakerSegment, get_speaker_diarization
+	from .utils.voiceprint_index import get_voiceprint_index_store, parse_embedding, update_centroid
+	from .utils.vad import AUDIO_VAD_ENABLED, compact_audio_cached, vad_params_id
+	from .utils.transcode import WHISPER_MAX_BYTES, target_bitrate, transcode_audio
 	AUDIO_PROCESSING_AVAILABLE = True
 except ImportError as e:
 	print(f"⚠️ 音声処理ライブラリが利用できません: {e}")
@@ -2096,6 +2396,31 @@ except ImportError as e:
 	numpy = None
 	get_voiceprint_extractor = None
 	get_speaker_diarization = None
+	get_voiceprint_index_store = None
+
+
+@app.on_event("startup")
+async def warm_up_audio_models():
+	"""AUDIO_WARMUP=1 の場合、起動時に音声モデルをバックグラウンドでロードしておく"""
+	if not AUDIO_PROCESSING_AVAILABLE or os.environ.get("AUDIO_WARMUP", "0") != "1":
+		return
+
+	def warm_up():
+		for name, getter in (("声紋抽出", get_voiceprint_extractor), ("話者識別", get_speaker_diarization)):
+			try:
+				getter().warm_up()
+				print(f"✅ {name}モデルのウォームアップ完了")
+			except Exception as e:
+				print(f"⚠️ {name}モデルのウォームアップに失敗: {e}")
+
+	# 起動（ヘルスチェック）を待たせないようにスレッドで実行
+	asyncio.get_running_loop().run_in_executor(None, warm_up)
+
+
+def load_active_voiceprints(user_id: str) -> List[Dict]:
+	"""声紋インデックス用に、ユーザーのアクティブな声紋をSupabaseから読み込む"""
+	response = supabase.table("professor_voiceprints").select("id, voiceprint_name, embedding, sample_count").eq("user_id", user_id).eq("is_active", True).execute()
+	return response.data or []
 
 
 @app.post("/voiceprint/register")
@@ -2135,7 +2460,7 @@ async def register_voiceprint(
 			voiceprint_name = f"教授の声_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
 
 		voiceprint_data = {
-			"user_id": user["id"],
+			"user_id": user["user_id"],
 			"voiceprint_name": voiceprint_name,
 			"embedding": embedding.tolist(),
 			"audio_duration_seconds": duration,
@@ -2146,6 +2471,7 @@ async def register_voiceprint(
 		}
 
 		response = supabase.table("professor_voiceprints").insert(voiceprint_data).execute()
+		get_voiceprint_index_store().invalidate(user["user_id"])
 		print(f"✅ 声紋登録完了: {voiceprint_name}")
 
 		return {
@@ -2160,8 +2486,10 @@ async def register_voiceprint(
 		print(f"❌ 声紋登録エラー: {e}")
 		raise HTTPException(status_code=500, detail=f"声紋の登録に失敗しました: {str(e)}")
 	finally:
-		if temp_audio_path and os.path.exists(temp_audio_path):
-			os.unlink(temp_audio_path)
+		if temp_audio_path:
+			get_voiceprint_extractor().clear_waveform_cache(temp_audio_path)
+			if os.path.exists(temp_audio_path):
+				os.unlink(temp_audio_path)
 
 
 @app.get("/voiceprint/list")
@@ -2174,7 +2502,7 @@ async def list_voiceprints(user: dict = Depends(verify_jwt)):
 		raise HTTPException(status_code=500, detail="Supabaseが設定されていません")
 
 	try:
-		response = supabase.table("professor_voiceprints").select("*").eq("user_id", user["id"]).order("created_at", desc=True).execute()
+		response = supabase.table("professor_voiceprints").select("*").eq("user_id", user["user_id"]).order("created_at", desc=True).execute()
 		return {"success": True, "voiceprints": response.data}
 	except Exception as e:
 		raise HTTPException(status_code=500, detail=f"声紋リストの取得に失敗しました: {str(e)}")
@@ -2190,11 +2518,12 @@ async def delete_voiceprint(voiceprint_id: str, user: dict = Depends(verify_jwt)
 		raise HTTPException(status_code=500, detail="Supabaseが設定されていません")
 
 	try:
-		check_response = supabase.table("professor_voiceprints").select("id").eq("id", voiceprint_id).eq("user_id", user["id"]).execute()
+		check_response = supabase.table("professor_voiceprints").select("id").eq("id", voiceprint_id).eq("user_id", user["user_id"]).execute()
 		if not check_response.data:
 			raise HTTPException(status_code=404, detail="声紋が見つかりません")
 
 		supabase.table("professor_voiceprints").delete().eq("id", voiceprint_id).execute()
+		get_voiceprint_index_store().invalidate(user["user_id"])
 		return {"success": True, "message": "声紋を削除しました"}
 	except HTTPException:
 		raise
@@ -2202,6 +2531,77 @@ async def delete_voiceprint(voiceprint_id: str, user: dict = Depends(verify_jwt)
 		raise HTTPException(status_code=500, detail=f"声紋の削除に失敗しました: {str(e)}")
 
 
+@app.post("/voiceprint/{voiceprint_id}/samples")
+async def add_voiceprint_sample(
+	voiceprint_id: str,
+	file: UploadFile = File(...),
+	start_time: Optional[float] = None,
+	end_time: Optional[float] = None,
+	user: dict = Depends(verify_jwt)
+):
+	"""本人と確認済みの音声サンプルで声紋を更新（重心の逐次平均による継続学習）"""
+	if not AUDIO_PROCESSING_AVAILABLE:
+		raise HTTPException(status_code=501, detail="音声処理機能は現在利用できません。")
+
+	if not supabase:
+		raise HTTPException(status_code=500, detail="Supabaseが設定されていません")
+
+	import tempfile
+
+	temp_audio_path = None
+
+	try:
+		existing = supabase.table("professor_voiceprints").select("id, embedding, sample_count, confidence_score, audio_duration_seconds").eq("id", voiceprint_id).eq("user_id", user["user_id"]).execute()
+		if not existing.data:
+			raise HTTPException(status_code=404, detail="声紋が見つかりません")
+		voiceprint = existing.data[0]
+
+		with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp:
+			content = await file.read()
+			tmp.write(content)
+			temp_audio_path = tmp.name
+
+		extractor = get_voiceprint_extractor()
+		sample = extractor.extract_voiceprint(temp_audio_path, start_time, end_time)
+		duration = extractor.get_audio_duration(temp_audio_path)
+		if start_time is not None or end_time is not None:
+			duration = int((end_time if end_time is not None else duration) - (start_time or 0))
+
+		current = parse_embedding(voiceprint["embedding"])
+		similarity = extractor.compare_voiceprints(current, sample)
+		updated, sample_count = update_centroid(current, voiceprint.get("sample_count") or 1, sample)
+		confidence_score = min((voiceprint.get("confidence_score") or 0.95) + 0.02, 0.99)
+
+		supabase.table("professor_voiceprints").update({
+			"embedding": updated.tolist(),
+			"sample_count": sample_count,
+			"confidence_score": confidence_score,
+			"audio_duration_seconds": (voiceprint.get("audio_duration_seconds") or 0) + max(duration, 1)
+		}).eq("id", voiceprint_id).execute()
+		get_voiceprint_index_store().invalidate(user["user_id"])
+
+		print(f"✅ 声紋更新完了: {voiceprint_id} (サンプル数: {sample_count}, 既存声紋との類似度: {similarity:.2%})")
+
+		return {
+			"success": True,
+			"message": "声紋を更新しました",
+			"voiceprint_id": voiceprint_id,
+			"sample_count": sample_count,
+			"sample_similarity": similarity,
+			"confidence_score": confidence_score
+		}
+	except HTTPException:
+		raise
+	except Exception as e:
+		print(f"❌ 声紋更新エラー: {e}")
+		raise HTTPException(status_code=500, detail=f"声紋の更新に失敗しました: {str(e)}")
+	finally:
+		if temp_audio_path:
+			get_voiceprint_extractor().clear_waveform_cache(temp_audio_path)
+			if os.path.exists(temp_audio_path):
+				os.unlink(temp_audio_path)
+
+
 @app.post("/audio/identify-speakers")
 async def identify_speakers_endpoint(file: UploadFile = File(...), user: dict = Depends(verify_jwt)):
 	"""音声ファイルから話者を識別"""
@@ -2217,11 +2617,12 @@ async def identify_speakers_endpoint(file: UploadFile = File(...), user: dict =
 			content = await file.read()
 			tmp.write(content)
 			temp_audio_path = tmp.name
+		audio_hash = hashlib.sha256(content).hexdigest()
 
 		print(f"🔍 話者識別開始: {file.filename}")
 
 		diarization = get_speaker_diarization()
-		segments = diarization.identify_speakers(temp_audio_path)
+		segments = diarization.identify_speakers(temp_audio_path, audio_hash=audio_hash)
 		statistics = diarization.get_speaker_statistics(segments)
 
 		print(f"✅ 話者識別完了: {statistics['total_speakers']}人検出")
@@ -2235,110 +2636,287 @@ async def identify_speakers_endpoint(file: UploadFile = File(...), user: dict =
 			os.unlink(temp_audio_path)
 
 
-@app.post("/audio/extract-professor-speech")
-async def extract_professor_speech(file: UploadFile = File(...), use_voiceprint: bool = True, user: dict = Depends(verify_jwt)):
-	"""音声ファイルから教授の発言のみを抽出"""
-	if not AUDIO_PROCESSING_AVAILABLE:
-		raise HTTPException(status_code=501, detail="音声処理機能は現在利用できません。")
+# Whisperの分割単位（秒）と同時リクエスト数
+WHISPER_CHUNK_SECONDS = int(os.environ.get("WHISPER_CHUNK_SECONDS", "600"))
+WHISPER_CONCURRENCY = int(os.environ.get("WHISPER_CONCURRENCY", "3"))
 
-	if not supabase:
-		raise HTTPException(status_code=500, detail="Supabaseが設定されていません")
 
-	import tempfile
+def transcribe_audio_chunk(openai_client, audio, offset: float) -> List[Dict]:
+	"""
+	音声（の一部）をWhisperで文字起こしする
+
+	Args:
+		openai_client: OpenAIクライアント
+		audio: 音声ファイルのパス、または (ファイル名, バイト列)
+		offset: 音声の開始時刻（秒）。返すタイムスタンプに加算する
+
+	Returns:
+		単語タイムスタンプ付きのWhisperセグメント（時刻は元の音声基準）
+	"""
+	if isinstance(audio, str):
+		with open(audio, "rb") as audio_file:
+			audio = (os.path.basename(audio), audio_file.read())
+
+	transcript = openai_client.audio.transcriptions.create(
+		model="whisper-1",
+		file=audio,
+		language="ja",
+		response_format="verbose_json",
+		timestamp_granularities=["segment", "word"]
+	)
+
+	# segments / words は SDK のモデル（TranscriptionSegment / TranscriptionWord）なので属性で参照する
+	whisper_segments = [{"start": seg.start + offset, "end": seg.end + offset, "text": seg.text} for seg in (transcript.segments or [])]
+	whisper_words = [{"word": w.word, "start": w.start + offset, "end": w.end + offset} for w in (getattr(transcript, "words", None) or [])]
+	get_speaker_diarization().attach_words_to_segments(whisper_segments, whisper_words)
+	return whisper_segments
+
+
+def identify_professor(diarization, segments, statistics: Dict, audio_path: str, audio_hash: str, user_id: str, use_voiceprint: bool) -> Dict:
+	"""
+	話者の中から教授を特定する（声紋照合 → 失敗時は発言時間ベース）
+
+	Returns:
+		{"professor_speaker_id", "matched_voiceprint_id", "match_score"}
+	"""
+	professor_speaker_id = None
+	matched_voiceprint_id = None
+	best_match_score = 0.0
+
+	if use_voiceprint:
+		# 登録済みの全声紋（N×192）と全話者を1回の行列積で照合
+		voiceprint_index = get_voiceprint_index_store().get(user_id, load_active_voiceprints)
+
+		if len(voiceprint_index) > 0:
+			extractor = get_voiceprint_extractor()
+
+			# 全話者のセグメント（各話者最大3つ）を集め、音声のデコードとエンコードを1回で済ませる
+			requested = []
+			segments_by_speaker = diarization.rows_by_speaker(segments)
+			for speaker_info in statistics["speakers"]:
+				speaker_id = speaker_info["speaker_id"]
+				for seg in segments_by_speaker.get(speaker_id, [])[:3]:
+					requested.append((speaker_id, seg.start, seg.end))
+
+			embeddings_by_speaker: Dict[str, List] = {}
+			extracted = extractor.extract_voiceprints(audio_path, [(start, end) for _, start, end in requested], audio_hash=audio_hash)
+			for (speaker_id, _, _), embedding in zip(requested, extracted):
+				if embedding is not None:
+					embeddings_by_speaker.setdefault(speaker_id, []).append(embedding)
+
+			speaker_embeddings = {
+				speaker_id: extractor.merge_voiceprints(embeddings)
+				for speaker_id, embeddings in embeddings_by_speaker.items()
+			}
+			match = voiceprint_index.best_match(speaker_embeddings)
+
+			if match is not None:
+				for speaker_id, similarity in match["speaker_scores"].items():
+					print(f"  - {speaker_id}: 類似度 {similarity:.2%}")
+				best_match_score = match["score"]
+
+				if best_match_score >= 0.75:
+					professor_speaker_id = match["speaker_id"]
+					matched_voiceprint_id = match["voiceprint_id"]
+					print(f"✅ 声紋照合成功: {professor_speaker_id} (類似度: {best_match_score:.2%})")
+
+	if professor_speaker_id is None:
+		professor_speaker_id = diarization.identify_longest_speaker(segments)
+		print(f"ℹ️ 発言時間ベースで判定: {professor_speaker_id}")
+
+	return {
+		"professor_speaker_id": professor_speaker_id,
+		"matched_voiceprint_id": matched_voiceprint_id,
+		"match_score": best_match_score
+	}
+
+
+async def run_professor_speech_pipeline(audio_path: str, audio_hash: str, user_id: str, use_voiceprint: bool, emit) -> Dict:
+	"""
+	教授音声抽出のパイプライン
+
+	Whisperの文字起こし（WHISPER_CHUNK_SECONDS ごとに分割し、最大 WHISPER_CONCURRENCY 並列）は
+	話者識別・声紋照合に依存しないため、最初に開始して並行に進めます。
+	教授が特定できたら、完了したチャンクから順にマッチングして教授の発言を取り出します。
+
+	Args:
+		audio_path: 音声ファイルのパス
+		audio_hash: 音声のsha256（話者識別・声紋のキャッシュキー）
+		user_id: ユーザーID
+		use_voiceprint: 声紋照合を使用するか
+		emit: 進捗イベント（dict）を受け取るコルーチン関数
+
+	Returns:
+		professor_speaker_id, professor_text などの結果
+	"""
 	from openai import OpenAI
 
-	temp_audio_path = None
 	openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+	diarization = get_speaker_diarization()
+
+	# 話者識別のキャッシュ（元の音声での結果、または同じVAD設定で無音を詰めた音声での結果）を先に確認する
+	params_id = vad_params_id() if AUDIO_VAD_ENABLED else None
+	cached_segments = await asyncio.to_thread(diarization.cached_segments, audio_hash, params_id)
+
+	# 無音を詰めた音声で話者識別・文字起こしを行い、時刻は OffsetMap で元の音声に戻す
+	# （声紋は元の音声・元の時刻から抽出するので、声紋キャッシュはそのまま使える）
+	offset_map = None
+	analysis_path = audio_path
+	compact_path = f"{audio_path}.vad.wav"
+	if AUDIO_VAD_ENABLED:
+		try:
+			with span("audio_vad"):
+				# 発話区間の検出結果もキャッシュするので、2回目以降は詰めた音声の書き出しだけになる
+				offset_map = await asyncio.to_thread(compact_audio_cached, audio_path, compact_path, audio_hash)
+		except Exception as e:
+			print(f"⚠️ 無音除去をスキップ: {e}")
+		if offset_map is not None:
+			analysis_path = compact_path
+			print(f"🔇 無音を除去: {offset_map.original_duration:.0f}秒 → {offset_map.compact_duration:.0f}秒")
+			await emit({"event": "vad", "original_seconds": round(offset_map.original_duration, 1), "speech_seconds": round(offset_map.compact_duration, 1)})
+
+	def to_original_segments(whisper_segments: List[Dict]) -> List[Dict]:
+		if offset_map is not None:
+			for w in whisper_segments:
+				for item in [w] + w.get("words", []):
+					item["start"] = offset_map.to_original(item["start"])
+					item["end"] = offset_map.to_original(item["end"])
+		return whisper_segments
+
+	# 長さを取得して分割計画を立てる（短い音声は分割しない）
+	if offset_map is not None:
+		duration = int(offset_map.compact_duration)
+	else:
+		duration = get_voiceprint_extractor().get_audio_duration(audio_path)
+	if duration > WHISPER_CHUNK_SECONDS:
+		# 長さは秒未満を切り捨てているので、最後のチャンクは1秒長めに切り出す（ffmpegは終端で止まる）
+		chunks = [(float(start), float(min(WHISPER_CHUNK_SECONDS, duration - start + 1))) for start in range(0, duration, WHISPER_CHUNK_SECONDS)]
+	else:
+		chunks = [(0.0, None)]
 
-	try:
-		with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp:
-			content = await file.read()
-			tmp.write(content)
-			temp_audio_path = tmp.name
+	semaphore = asyncio.Semaphore(WHISPER_CONCURRENCY)
 
-		print(f"🎤 教授音声抽出開始: {file.filename}")
+	async def transcribe(index: int, offset: float, length: Optional[float]) -> List[Dict]:
+		async with semaphore:
+			if length is None and os.path.getsize(analysis_path) <= WHISPER_MAX_BYTES:
+				audio = analysis_path
+			else:
+				# ffmpegの出力をパイプで受け取り、そのままWhisperに送る
+				with span("audio_transcode"):
+					encoded = await transcode_audio(analysis_path, target_bitrate(length or duration), start=offset, duration=length)
+				audio = (f"chunk_{index}.mp3", encoded)
+			with span("audio_whisper"):
+				whisper_segments = to_original_segments(
+					await asyncio.to_thread(transcribe_audio_chunk, openai_client, audio, offset)
+				)
+		print(f"📝 文字起こし {index + 1}/{len(chunks)} 完了: {len(whisper_segments)}セグメント")
+		await emit({"event": "transcript_chunk", "index": index, "total": len(chunks), "segments": len(whisper_segments)})
+		return whisper_segments
 
-		# 話者識別
+	print(f"📝 Whisper APIで文字起こし開始（{len(chunks)}チャンク）")
+	transcribe_tasks = [asyncio.create_task(transcribe(i, offset, length)) for i, (offset, length) in enumerate(chunks)]
+	for task in transcribe_tasks:
+		# 途中で失敗・キャンセルした場合に未取得の例外を警告させない
+		task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+	try:
+		# 話者識別（文字起こしと並行）
 		print("📊 話者識別中...")
-		diarization = get_speaker_diarization()
-		segments = diarization.identify_speakers(temp_audio_path)
+		with span("audio_diarization"):
+			if cached_segments is not None:
+				segments = cached_segments
+			elif offset_map is not None:
+				# 詰めた音声で識別して元の時刻に戻し、(元の音声のハッシュ, VAD設定) でキャッシュする
+				segments = await asyncio.to_thread(
+					diarization.identify_speakers_compacted, analysis_path, audio_hash, offset_map, params_id
+				)
+			else:
+				segments = await asyncio.to_thread(diarization.identify_speakers, audio_path, audio_hash)
 		statistics = diarization.get_speaker_statistics(segments)
 		print(f"✅ {statistics['total_speakers']}人の話者を検出")
+		await emit({"event": "diarization", "statistics": statistics})
 
 		# 教授を特定
 		print("🔍 教授を特定中...")
-		professor_speaker_id = None
-		best_match_score = 0.0
-
-		if use_voiceprint:
-			voiceprints_response = supabase.table("professor_voiceprints").select("*").eq("user_id", user["id"]).eq("is_active", True).order("created_at", desc=True).limit(1).execute()
-
-			if voiceprints_response.data:
-				registered_voiceprint = voiceprints_response.data[0]
-				registered_embedding = np.array(registered_voiceprint["embedding"])
-				extractor = get_voiceprint_extractor()
-
-				best_match_speaker = None
-				for speaker_info in statistics["speakers"]:
-					speaker_id = speaker_info["speaker_id"]
-					speaker_segments = diarization.filter_segments_by_speaker(segments, speaker_id)
-
-					speaker_embeddings = []
-					for seg in speaker_segments[:3]:
-						try:
-							embedding = extractor.extract_voiceprint(temp_audio_path, start_time=seg.start, end_time=seg.end)
-							speaker_embeddings.append(embedding)
-						except:
-							continue
-
-					if speaker_embeddings:
-						avg_embedding = extractor.merge_voiceprints(speaker_embeddings)
-						similarity = extractor.compare_voiceprints(registered_embedding, avg_embedding)
-						print(f"  - {speaker_id}: 類似度 {similarity:.2%}")
-
-						if similarity > best_match_score:
-							best_match_score = similarity
-							best_match_speaker = speaker_id
-
-				if best_match_score >= 0.75:
-					professor_speaker_id = best_match_speaker
-					print(f"✅ 声紋照合成功: {professor_speaker_id} (類似度: {best_match_score:.2%})")
-
-		if professor_speaker_id is None:
-			professor_speaker_id = diarization.identify_longest_speaker(segments)
-			print(f"ℹ️ 発言時間ベースで判定: {professor_speaker_id}")
-
-		# Whisper APIで文字起こし
-		print("📝 Whisper APIで文字起こし中...")
-		with open(temp_audio_path, "rb") as audio_file:
-			transcript = openai_client.audio.transcriptions.create(
-				model="whisper-1",
-				file=audio_file,
-				language="ja",
-				response_format="verbose_json",
-				timestamp_granularities=["segment"]
+		with span("audio_identify"):
+			identification = await asyncio.to_thread(
+				identify_professor, diarization, segments, statistics, audio_path, audio_hash, user_id, use_voiceprint
 			)
+		await emit({"event": "speaker_identified", **identification})
+		professor_speaker_id = identification["professor_speaker_id"]
+
+		# 完了したチャンクから時刻順にマッチング（話者交代をまたぐセグメントは単語単位で分割）
+		professor_texts = []
+		for index, task in enumerate(transcribe_tasks):
+			whisper_segments = await task
+			if whisper_segments:
+				window_start = min(w["start"] for w in whisper_segments)
+				window_end = max(w["end"] for w in whisper_segments)
+				chunk_segments = [
+					SpeakerSegment(s.speaker_id, s.start, s.end)
+					for s in segments if s.start < window_end and s.end > window_start
+				]
+				diarization.match_segments_with_transcript(chunk_segments, whisper_segments, split_straddling=True)
+				chunk_text = diarization.extract_speaker_text(chunk_segments, professor_speaker_id)
+			else:
+				chunk_text = ""
 
-		whisper_segments = [{"start": seg["start"], "end": seg["end"], "text": seg["text"]} for seg in transcript.segments]
-		print(f"✅ 文字起こし完了: {len(whisper_segments)}セグメント")
-
-		# セグメントをマッチング
-		segments_with_text = diarization.match_segments_with_transcript(segments, whisper_segments)
+			if chunk_text:
+				professor_texts.append(chunk_text)
+			await emit({"event": "professor_text", "index": index, "total": len(chunks), "text": chunk_text})
 
-		# 教授の発言のみを抽出
-		professor_text = diarization.extract_speaker_text(segments_with_text, professor_speaker_id)
+		professor_text = " ".join(professor_texts)
 		print(f"✅ 教授音声抽出完了: {len(professor_text)}文字")
 
+		best_match_score = identification["match_score"]
 		return {
-			"success": True,
-			"filename": file.filename,
 			"professor_speaker_id": professor_speaker_id,
 			"professor_text": professor_text,
 			"text_length": len(professor_text),
 			"statistics": statistics,
 			"match_method": "voiceprint" if use_voiceprint and best_match_score >= 0.75 else "longest_speaker",
-			"match_score": best_match_score if use_voiceprint else None
+			"match_score": best_match_score if use_voiceprint else None,
+			"matched_voiceprint_id": identification["matched_voiceprint_id"]
 		}
+	finally:
+		for task in transcribe_tasks:
+			if not task.done():
+				task.cancel()
+		if os.path.exists(compact_path):
+			os.unlink(compact_path)
+
+
+async def _save_upload_to_temp(file: UploadFile) -> Tuple[str, str]:
+	"""アップロードされた音声を一時ファイルに保存し、(パス, 内容のsha256) を返す"""
+	import tempfile
+
+	with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp:
+		content = await file.read()
+		tmp.write(content)
+	# 話者識別・声紋のキャッシュキー（音声の内容ハッシュ）
+	return tmp.name, hashlib.sha256(content).hexdigest()
+
+
+@app.post("/audio/extract-professor-speech")
+async def extract_professor_speech(file: UploadFile = File(...), use_voiceprint: bool = True, user: dict = Depends(verify_jwt)):
+	"""音声ファイルから教授の発言のみを抽出"""
+	if not AUDIO_PROCESSING_AVAILABLE:
+		raise HTTPException(status_code=501, detail="音声処理機能は現在利用できません。")
+
+	if not supabase:
+		raise HTTPException(status_code=500, detail="Supabaseが設定されていません")
+
+	temp_audio_path = None
+
+	async def ignore_event(event: Dict):
+		pass
+
+	try:
+		temp_audio_path, audio_hash = await _save_upload_to_temp(file)
+		print(f"🎤 教授音声抽出開始: {file.filename}")
+
+		result = await run_professor_speech_pipeline(temp_audio_path, audio_hash, user["user_id"], use_voiceprint, ignore_event)
+		return {"success": True, "filename": file.filename, **result}
 
 	except Exception as e:
 		print(f"❌ 教授音声抽出エラー: {e}")
@@ -2346,5 +2924,59 @@ async def extract_professor_speech(file: UploadFile = File(...), use_voiceprint:
 		traceback.print_exc()
 		raise HTTPException(status_code=500, detail=f"教授音声の抽出に失敗しました: {str(e)}")
 	finally:
-		if temp_audio_path and os.path.exists(temp_audio_path):
-			os.unlink(temp_audio_path)
+		if temp_audio_path:
+			get_voiceprint_extractor().clear_waveform_cache(temp_audio_path)
+			if os.path.exists(temp_audio_path):
+				os.unlink(temp_audio_path)
+
+
+@app.post("/audio/extract-professor-speech/stream")
+async def extract_professor_speech_stream(file: UploadFile = File(...), use_voiceprint: bool = True, user: dict = Depends(verify_jwt)):
+	"""
+	教授音声抽出（進捗をNDJSONでストリーミング）
+
+	1行1イベントで diarization → speaker_identified → transcript_chunk / professor_text → result
+	（失敗時は error）を返します。result の内容は /audio/extract-professor-speech と同じです。
+	"""
+	if not AUDIO_PROCESSING_AVAILABLE:
+		raise HTTPException(status_code=501, detail="音声処理機能は現在利用できません。")
+
+	if not supabase:
+		raise HTTPException(status_code=500, detail="Supabaseが設定されていません")
+
+	temp_audio_path, audio_hash = await _save_upload_to_temp(file)
+	filename = file.filename
+	events: asyncio.Queue = asyncio.Queue()
+	print(f"🎤 教授音声抽出開始（ストリーミング）: {filename}")
+
+	async def run():
+		try:
+			result = await run_professor_speech_pipeline(temp_audio_path, audio_hash, user["user_id"], use_voiceprint, events.put)
+			await events.put({"event": "result", "success": True, "filename": filename, **result})
+		except Exception as e:
+			print(f"❌ 教授音声抽出エラー: {e}")
+			await events.put({"event": "error", "detail": f"教授音声の抽出に失敗しました: {str(e)}"})
+		finally:
+			await events.put(None)
+
+	async def event_stream():
+		task = asyncio.create_task(run())
+		try:
+			yield json.dumps({"event": "started", "filename": filename}, ensure_ascii=False) + "\n"
+			while True:
+				event = await events.get()
+				if event is None:
+					break
+				yield json.dumps(event, ensure_ascii=False) + "\n"
+		finally:
+			# クライアントが切断した場合もパイプラインを止めて一時ファイルを片付ける
+			# （止まるのを待ってから削除する。実行中のステップが一時ファイルを開いているため）
+			if not task.done():
+				task.cancel()
+			with contextlib.suppress(asyncio.CancelledError):
+				await task
+			get_voiceprint_extractor().clear_waveform_cache(temp_audio_path)
+			if os.path.exists(temp_audio_path):
+				os.unlink(temp_audio_path)
+
+	return StreamingResponse(event_stream(), media_type="application/x-ndjson")
@@ -0,0 +1,18 @@
+-- ==========================================
+-- Embeddingのテキストハッシュ列の追加
+-- ==========================================
+-- このSQLをSupabase SQL Editorで実行してください
+-- 前提: 02_alter_knowledge_base.sql が実行済み
+
+-- 1. Embedding生成時のテキストハッシュとモデル名を保存する列を追加
+-- embedding_hash: sha256(モデル名 + 次元数 + 正規化テキスト)
+--   → テキストもモデルも変わっていない行はマイグレーションで再Embedding化しない
+ALTER TABLE knowledge_base
+  ADD COLUMN IF NOT EXISTS embedding_hash TEXT,
+  ADD COLUMN IF NOT EXISTS embedding_model TEXT;
+
+-- 2. マイグレーションのページング（id順のキーセットページング）用
+-- id は主キーなのでインデックスは既存のものを使用
+
+-- 3. テーブル構造を確認
+\d knowledge_base
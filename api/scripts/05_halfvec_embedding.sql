@@ -0,0 +1,61 @@
+-- ==========================================
+-- Embeddingの省メモリ化（halfvec / 次元削減）※任意
+-- ==========================================
+-- このSQLをSupabase SQL Editorで実行してください
+-- 前提: 04_add_embedding_hash.sql が実行済み、pgvector 0.7.0 以上（halfvec対応）
+--
+-- halfvec はfloat16で保存するため、ベクトル1件あたりのサイズが半分になります。
+-- EMBEDDING_DIMENSIONS を変更する場合は、下記の 1536 を同じ値に置き換えたうえで
+-- 実行し、その後 migrate_embeddings.py を再実行してください（次元数が変わると
+-- embedding_hash が一致しなくなるため、全行が再Embedding化されます）。
+-- 実行後は 06_filter_search_by_embedding_model.sql を（再）実行してください。
+
+-- 1. 既存のインデックスを削除（型変更のため）
+DROP INDEX IF EXISTS knowledge_base_embedding_idx;
+
+-- 2. embedding列を halfvec に変更
+-- 次元数を変更する場合は既存の値を捨てる必要があります:
+--   ALTER TABLE knowledge_base ALTER COLUMN embedding TYPE halfvec(512) USING NULL;
+ALTER TABLE knowledge_base
+  ALTER COLUMN embedding TYPE halfvec(1536) USING embedding::halfvec(1536);
+
+-- 3. HNSWインデックスを作成（halfvec用のコサイン距離演算子クラス）
+CREATE INDEX IF NOT EXISTS knowledge_base_embedding_idx
+ON knowledge_base
+USING hnsw (embedding halfvec_cosine_ops);
+
+-- 4. 検索関数を halfvec 版に置き換え
+DROP FUNCTION IF EXISTS search_knowledge_by_embedding(VECTOR, INT);
+DROP FUNCTION IF EXISTS search_knowledge_by_embedding(VECTOR, INT, TEXT);
+
+CREATE OR REPLACE FUNCTION search_knowledge_by_embedding(
+  query_embedding halfvec(1536),
+  match_count INT DEFAULT 5
+)
+RETURNS TABLE (
+  id UUID,
+  text TEXT,
+  content_type TEXT,
+  type TEXT,
+  tags TEXT[],
+  source TEXT,
+  similarity FLOAT
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  RETURN QUERY
+  SELECT
+    kb.id,
+    kb.text,
+    kb.content_type,
+    kb.type,
+    kb.tags,
+    kb.source,
+    1 - (kb.embedding <=> query_embedding) AS similarity
+  FROM knowledge_base kb
+  WHERE kb.embedding IS NOT NULL
+  ORDER BY kb.embedding <=> query_embedding
+  LIMIT match_count;
+END;
+$$;
@@ -0,0 +1,61 @@
+-- ==========================================
+-- 検索関数にEmbeddingモデルの絞り込みを追加
+-- ==========================================
+-- このSQLをSupabase SQL Editorで実行してください
+-- 前提: 04_add_embedding_hash.sql が実行済み（05_halfvec_embedding.sql は実行済みでも未実行でも可）
+--
+-- 異なるモデル（ベクトル空間）のEmbeddingは比較できないため、
+-- クエリと同じ embedding_model の行だけを検索します。
+-- embedding_model が NULL の行（04以前に保存した行）は text-embedding-3-small として扱います。
+
+-- 1. 既存の関数を削除（引数が変わるため）
+DROP FUNCTION IF EXISTS search_knowledge_by_embedding(VECTOR, INT);
+DROP FUNCTION IF EXISTS search_knowledge_by_embedding(halfvec, INT);
+
+-- 2. filter_model 付きの検索関数を作成（NULL の場合は絞り込まない）
+-- 引数の型は embedding 列の型（vector(1536) / halfvec(1536) など）に合わせる
+DO $$
+DECLARE
+  embedding_type TEXT;
+BEGIN
+  SELECT format_type(atttypid, atttypmod) INTO embedding_type
+  FROM pg_attribute
+  WHERE attrelid = 'knowledge_base'::regclass AND attname = 'embedding';
+
+  EXECUTE format($fn$
+    CREATE OR REPLACE FUNCTION search_knowledge_by_embedding(
+      query_embedding %s,
+      match_count INT DEFAULT 5,
+      filter_model TEXT DEFAULT NULL
+    )
+    RETURNS TABLE (
+      id UUID,
+      text TEXT,
+      content_type TEXT,
+      type TEXT,
+      tags TEXT[],
+      source TEXT,
+      similarity FLOAT
+    )
+    LANGUAGE plpgsql
+    AS $body$
+    BEGIN
+      RETURN QUERY
+      SELECT
+        kb.id,
+        kb.text,
+        kb.content_type,
+        kb.type,
+        kb.tags,
+        kb.source,
+        1 - (kb.embedding <=> query_embedding) AS similarity
+      FROM knowledge_base kb
+      WHERE kb.embedding IS NOT NULL
+        AND (filter_model IS NULL OR COALESCE(kb.embedding_model, 'text-embedding-3-small') = filter_model)
+      ORDER BY kb.embedding <=> query_embedding
+      LIMIT match_count;
+    END;
+    $body$;
+  $fn$, embedding_type);
+END;
+$$;
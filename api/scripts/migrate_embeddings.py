@@ -2,15 +2,34 @@
 既存のknowledge_baseデータをEmbedding化するマイグレーションスクリプト
 
 このスクリプトは以下を実行します:
-1. knowledge_baseから全データを取得
-2. OpenAI Embeddings APIで各テキストをEmbedding化
-3. データベースを更新
+1. knowledge_baseをid順にページ単位で取得（全件をメモリに載せない）
+2. embedding_hash が現在のモデル・テキストと一致する行をスキップ
+3. 残りの行をバッチに分け、レート制限付きで並列にEmbedding化
+4. ページごとに一括upsertでデータベースを更新
+5. ページごとにチェックポイントを保存（中断しても続きから再開）
+
+EMBEDDING_MODEL / EMBEDDING_DIMENSIONS を切り替えて再実行すると、
+ハッシュが一致しなくなった行だけが再Embedding化されます。
+
+EMBEDDING_BACKEND=local（文字n-gram）のベクトルは knowledge_base に保存できないため、
+local では実行できません。
+
+前提: 04_add_embedding_hash.sql が実行済み
+
+使用方法:
+    python api/scripts/migrate_embeddings.py -y
+    python api/scripts/migrate_embeddings.py -y --reset   # チェックポイントを破棄して最初から
+    python api/scripts/migrate_embeddings.py -y --force   # ハッシュが一致する行も再Embedding化
 """
 
+import argparse
+import json
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Optional
 
 # プロジェクトルートをパスに追加
 sys.path.append(str(Path(__file__).parent.parent.parent))
@@ -20,7 +39,15 @@ from dotenv import load_dotenv
 
 # api/utils/embedding.pyをインポート
 sys.path.append(str(Path(__file__).parent.parent))
-from utils.embedding import generate_embeddings_batch
+from utils.embedding import (
+    EMBEDDING_DIMENSIONS,
+    EMBEDDING_BACKEND,
+    EMBEDDING_MODEL,
+    PERSIST_EMBEDDINGS,
+    embedding_text_hash,
+    generate_embeddings_batch,
+)
+from utils.rate_limit import get_openai_limiter
 
 # 環境変数を読み込み
 load_dotenv()
@@ -30,76 +57,190 @@ url = os.getenv("SUPABASE_URL")
 key = os.getenv("SUPABASE_ANON_KEY")
 supabase: Client = create_client(url, key)
 
+CHECKPOINT_PATH = Path(__file__).parent / ".migrate_embeddings_checkpoint.json"
 
-def migrate_embeddings(batch_size: int = 50):
-    """
-    既存のknowledge_baseデータをEmbedding化
+# 書き戻しに必要な列（NOT NULL列を含めないとupsertのINSERT側で失敗する）
+SELECT_COLUMNS = "id, reference_id, type, text, content_type, embedding_hash"
 
-    Args:
-        batch_size: 一度に処理する件数（OpenAI APIの制限を考慮）
-    """
-    print("=== Embedding マイグレーション開始 ===\n")
 
-    # 1. 既存データ取得
-    print("1. knowledge_baseから既存データを取得中...")
+def load_checkpoint() -> Optional[Dict[str, Any]]:
+    """チェックポイントを読み込む（モデル・次元数が異なる場合は無視）"""
+    if not CHECKPOINT_PATH.exists():
+        return None
     try:
-        result = supabase.table("knowledge_base").select("*").execute()
-        knowledge_items = result.data
-        total = len(knowledge_items)
-        print(f"   ✅ 取得完了: {total}件\n")
+        checkpoint = json.loads(CHECKPOINT_PATH.read_text(encoding="utf-8"))
     except Exception as e:
-        print(f"   ❌ エラー: {e}")
-        return
+        print(f"   ⚠️  チェックポイントの読み込みに失敗: {e}")
+        return None
+    if checkpoint.get("model") != EMBEDDING_MODEL or checkpoint.get("dimensions") != EMBEDDING_DIMENSIONS:
+        print("   ℹ️  モデルが変わったため、チェックポイントを破棄して最初から実行します")
+        return None
+    return checkpoint
 
-    if total == 0:
-        print("   ⚠️  データが存在しません")
-        return
 
-    # 2. バッチ処理でEmbedding化
-    print(f"2. Embedding化を開始（バッチサイズ: {batch_size}件）...")
+def save_checkpoint(checkpoint: Dict[str, Any]):
+    """チェックポイントを書き込む（一時ファイル経由で原子的に置き換え）"""
+    tmp_path = CHECKPOINT_PATH.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(checkpoint, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp_path, CHECKPOINT_PATH)
 
-    for i in range(0, total, batch_size):
-        batch = knowledge_items[i:i+batch_size]
-        batch_num = i // batch_size + 1
-        batch_count = min(batch_size, total - i)
 
-        print(f"   バッチ {batch_num} ({batch_count}件) を処理中...")
+def fetch_page(last_id: Optional[str], page_size: int) -> List[Dict[str, Any]]:
+    """id順のキーセットページングで1ページ分を取得"""
+    query = supabase.table("knowledge_base").select(SELECT_COLUMNS).order("id").limit(page_size)
+    if last_id:
+        query = query.gt("id", last_id)
+    return query.execute().data
 
-        # テキストを抽出
-        texts = [item["text"] for item in batch]
 
+def embed_page(items: List[Dict[str, Any]], batch_size: int, concurrency: int) -> Dict[str, List[float]]:
+    """
+    1ページ分の行を並列にEmbedding化する
+
+    Returns:
+        {id: embedding}（失敗したバッチの行は含まれない）
+    """
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+    def run(batch):
         try:
-            # Embedding生成
-            embeddings = generate_embeddings_batch(texts)
+            return batch, generate_embeddings_batch([item["text"] for item in batch])
+        except Exception as e:
+            print(f"   ❌ バッチ（{len(batch)}件）エラー: {e}")
+            return batch, None
 
-            # データベース更新
+    results: Dict[str, List[float]] = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch, embeddings in executor.map(run, batches):
+            if embeddings is None:
+                continue
             for item, embedding in zip(batch, embeddings):
-                supabase.table("knowledge_base").update({
-                    "embedding": embedding,
-                    # デフォルト値を設定（既存データ用）
-                    "content_type": "comment",
-                    "source": "migration"
-                }).eq("id", item["id"]).execute()
+                results[item["id"]] = embedding
+    return results
 
-            print(f"   ✅ バッチ {batch_num} 完了")
 
+def migrate_embeddings(
+    batch_size: int = 100,
+    page_size: int = 1000,
+    concurrency: int = 4,
+    requests_per_minute: int = 500,
+    force: bool = False,
+    reset: bool = False
+):
+    """
+    既存のknowledge_baseデータをEmbedding化
+
+    Args:
+        batch_size: 1リクエストでEmbedding化する件数（OpenAI APIの制限を考慮）
+        page_size: 1ページで取得・書き戻しする件数
+        concurrency: 同時に実行するEmbeddingリクエスト数
+        requests_per_minute: Embeddingリクエストのレート上限
+        force: ハッシュが一致する行も再Embedding化する
+        reset: チェックポイントを破棄して最初から実行する
+    """
+    print("=== Embedding マイグレーション開始 ===\n")
+    if not PERSIST_EMBEDDINGS:
+        print(f"❌ EMBEDDING_BACKEND={EMBEDDING_BACKEND} のEmbeddingは knowledge_base に保存できません。")
+        print("   EMBEDDING_BACKEND=openai で実行してください。")
+        sys.exit(1)
+    print(f"モデル: {EMBEDDING_MODEL} ({EMBEDDING_DIMENSIONS}次元)")
+
+    checkpoint = None if reset else load_checkpoint()
+    if checkpoint:
+        print(f"   ↪️  チェックポイントから再開: {checkpoint['processed']}件処理済み (last_id={checkpoint['last_id']})\n")
+    else:
+        checkpoint = {
+            "model": EMBEDDING_MODEL,
+            "dimensions": EMBEDDING_DIMENSIONS,
+            "last_id": None,
+            "processed": 0,
+            "embedded": 0,
+            "skipped": 0,
+            "failed_ids": [],
+        }
+
+    # レート制限・429のリトライはAPIサーバーと同じ共有リミッターで行う
+    get_openai_limiter().configure(EMBEDDING_MODEL, rpm=requests_per_minute)
+    started = time.time()
+
+    # 1. ページ単位で取得 → Embedding化 → 一括upsert
+    print(f"1. Embedding化を開始（ページ: {page_size}件, バッチ: {batch_size}件, 並列数: {concurrency}）...")
+
+    while True:
+        try:
+            page = fetch_page(checkpoint["last_id"], page_size)
         except Exception as e:
-            print(f"   ❌ バッチ {batch_num} エラー: {e}")
-            print(f"   続行します...")
-            continue
+            print(f"   ❌ 取得エラー: {e}")
+            print("   チェックポイントは保存済みです。再実行すると続きから再開します。")
+            return
+
+        if not page:
+            break
+
+        pending = []
+        for item in page:
+            item["_hash"] = embedding_text_hash(item["text"] or "")
+            if not force and item.get("embedding_hash") == item["_hash"]:
+                continue
+            pending.append(item)
+
+        embeddings = embed_page(pending, batch_size, concurrency) if pending else {}
+
+        rows = [
+            {
+                "id": item["id"],
+                "reference_id": item["reference_id"],
+                "type": item["type"],
+                "text": item["text"],
+                "content_type": item["content_type"],
+                "embedding": embeddings[item["id"]],
+                "embedding_hash": item["_hash"],
+                "embedding_model": EMBEDDING_MODEL,
+            }
+            for item in pending if item["id"] in embeddings
+        ]
+
+        if rows:
+            try:
+                supabase.table("knowledge_base").upsert(rows, on_conflict="id").execute()
+            except Exception as e:
+                print(f"   ❌ 書き戻しエラー: {e}")
+                print("   チェックポイントは保存済みです。再実行すると続きから再開します。")
+                return
+
+        checkpoint["last_id"] = page[-1]["id"]
+        checkpoint["processed"] += len(page)
+        checkpoint["embedded"] += len(rows)
+        checkpoint["skipped"] += len(page) - len(pending)
+        checkpoint["failed_ids"].extend(item["id"] for item in pending if item["id"] not in embeddings)
+        save_checkpoint(checkpoint)
+
+        elapsed = time.time() - started
+        print(f"   ✅ {checkpoint['processed']}件処理済み（Embedding化: {len(rows)}件, スキップ: {len(page) - len(pending)}件, {elapsed:.1f}秒）")
+
+        if len(page) < page_size:
+            break
 
     print(f"\n=== Embedding マイグレーション完了 ===")
-    print(f"総件数: {total}件")
+    print(f"処理: {checkpoint['processed']}件 / Embedding化: {checkpoint['embedded']}件 / スキップ: {checkpoint['skipped']}件")
+
+    failed = checkpoint["failed_ids"]
+    if failed:
+        print(f"⚠️  失敗: {len(failed)}件。--reset を付けて再実行すると、失敗した行だけが再Embedding化されます。")
+    else:
+        CHECKPOINT_PATH.unlink(missing_ok=True)
 
-    # 3. 確認
-    print("\n3. Embedding化されたデータを確認中...")
+    # 2. 確認
+    print("\n2. Embedding化されたデータを確認中...")
     try:
-        result = supabase.table("knowledge_base")\
-            .select("id, embedding")\
+        total = supabase.table("knowledge_base").select("id", count="exact").limit(1).execute().count
+        embedded_count = supabase.table("knowledge_base")\
+            .select("id", count="exact")\
+            .eq("embedding_model", EMBEDDING_MODEL)\
             .not_.is_("embedding", "null")\
-            .execute()
-        embedded_count = len(result.data)
-        print(f"   ✅ Embedding化済み: {embedded_count}件 / {total}件")
+            .limit(1)\
+            .execute().count
+        print(f"   ✅ Embedding化済み（{EMBEDDING_MODEL}）: {embedded_count}件 / {total}件")
 
         if embedded_count == total:
             print(f"   🎉 全データのEmbedding化が完了しました！")
@@ -111,6 +252,16 @@ def migrate_embeddings(batch_size: int = 50):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="knowledge_base Embedding マイグレーション")
+    parser.add_argument("-y", action="store_true", help="確認なしで実行")
+    parser.add_argument("--batch-size", type=int, default=100, help="1リクエストあたりの件数")
+    parser.add_argument("--page-size", type=int, default=1000, help="1ページあたりの件数")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時リクエスト数")
+    parser.add_argument("--rpm", type=int, default=500, help="1分あたりの最大リクエスト数")
+    parser.add_argument("--force", action="store_true", help="ハッシュが一致する行も再Embedding化する")
+    parser.add_argument("--reset", action="store_true", help="チェックポイントを破棄して最初から実行する")
+    args = parser.parse_args()
+
     print("\n" + "=" * 50)
     print("knowledge_base Embedding マイグレーション")
     print("=" * 50 + "\n")
@@ -120,13 +271,20 @@ if __name__ == "__main__":
     print("続行しますか？ (y/n): ", end="")
 
     # 自動実行モード（コマンドライン引数で-yを指定）
-    if len(sys.argv) > 1 and sys.argv[1] == "-y":
+    if args.y:
         answer = "y"
         print("y (自動実行)")
     else:
         answer = input().strip().lower()
 
     if answer == "y":
-        migrate_embeddings()
+        migrate_embeddings(
+            batch_size=args.batch_size,
+            page_size=args.page_size,
+            concurrency=args.concurrency,
+            requests_per_minute=args.rpm,
+            force=args.force,
+            reset=args.reset
+        )
     else:
         print("キャンセルされました")
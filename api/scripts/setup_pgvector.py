@@ -68,7 +68,10 @@ def main():
     sql_files = [
         scripts_dir / "01_enable_pgvector.sql",
         scripts_dir / "02_alter_knowledge_base.sql",
-        scripts_dir / "03_create_search_function.sql"
+        scripts_dir / "03_create_search_function.sql",
+        scripts_dir / "04_add_embedding_hash.sql",
+        scripts_dir / "05_halfvec_embedding.sql",  # 任意（halfvec / 次元削減）
+        scripts_dir / "06_filter_search_by_embedding_model.sql"
     ]
 
     # 各SQLファイルを表示
@@ -2,12 +2,13 @@
 Utility modules for the API
 """
 
-from .embedding import generate_embedding, generate_embeddings_batch
+from .embedding import generate_embedding, generate_embeddings_batch, embedding_text_hash
 from .tagging import generate_tags, suggest_content_type
 
 __all__ = [
     'generate_embedding',
     'generate_embeddings_batch',
+    'embedding_text_hash',
     'generate_tags',
     'suggest_content_type',
 ]
@@ -0,0 +1,404 @@
+"""
+音声解析結果の永続キャッシュ
+
+同じ録音を /audio/identify-speakers と /audio/extract-professor-speech の両方に
+アップロードした場合や、use_voiceprint を切り替えて再実行した場合に、
+話者識別（pyannote）と声紋（ECAPA-TDNN）の計算を省略するためのキャッシュです。
+
+- 話者識別結果: (音声のsha256, モデルID) → セグメントのリスト（SQLite）
+  無音除去後の音声で識別した結果は、モデルIDに VAD の設定を付けて元の時刻で保存します
+- VADの結果: (音声のsha256, VAD設定) → 発話区間（SQLite）
+- 声紋: (音声のsha256, モデルID, 開始ms, 終了ms) → 行番号（SQLite）
+        行番号 → ベクトル（NumPy memmap、float32 × 192次元）
+
+SQLiteのトランザクションで行番号を割り当てるため、複数のuvicornワーカーから
+同時に使っても同じ行を上書きしません。
+
+音声ごとに最終アクセス時刻を記録し、AUDIO_CACHE_TTL_DAYS を過ぎた音声と、
+AUDIO_CACHE_MAX_AUDIOS を超えた古い音声の結果を定期的に削除します。
+削除した声紋の行は空き行として次の保存で再利用します（他のワーカーがmmap中のため、
+ファイル自体は縮めません）。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+AUDIO_CACHE_ENABLED = os.environ.get("AUDIO_CACHE_ENABLED", "1") in ("1", "true", "TRUE", "on")
+AUDIO_CACHE_DIR = os.environ.get(
+    "AUDIO_CACHE_DIR",
+    str(Path(__file__).resolve().parents[2] / "data" / "cache" / "audio")
+)
+
+# 削除の設定（0で無効）
+# TTL: 最後に使われてからこの日数を過ぎた音声を削除 / MAX_AUDIOS: 保持する音声の上限（古い順に削除）
+AUDIO_CACHE_TTL_DAYS = float(os.environ.get("AUDIO_CACHE_TTL_DAYS", "30"))
+AUDIO_CACHE_MAX_AUDIOS = int(os.environ.get("AUDIO_CACHE_MAX_AUDIOS", "500"))
+AUDIO_CACHE_PRUNE_INTERVAL = int(os.environ.get("AUDIO_CACHE_PRUNE_INTERVAL", "3600"))  # 秒
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    ファイル内容のsha256を計算する（大きなファイルも一定メモリで処理）
+
+    Args:
+        path: ファイルのパス
+        chunk_size: 読み込み単位（バイト）
+
+    Returns:
+        sha256の16進文字列
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _ms(seconds: float) -> int:
+    return int(round(seconds * 1000))
+
+
+class AudioAnalysisCache:
+    """音声解析結果の永続キャッシュ（SQLite + NumPy memmap）"""
+
+    def __init__(self, directory: str, dim: int = 192, initial_rows: int = 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self.initial_rows = initial_rows
+        self.vectors_path = self.directory / f"voiceprints_{dim}.f32"
+        self.lock = threading.Lock()
+        self._memmap: Optional[np.memmap] = None
+
+        self.conn = sqlite3.connect(str(self.directory / "index.sqlite3"), check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS voiceprints (
+                audio_hash TEXT NOT NULL,
+                model_id TEXT NOT NULL,
+                start_ms INTEGER NOT NULL,
+                end_ms INTEGER NOT NULL,
+                row INTEGER NOT NULL,
+                PRIMARY KEY (audio_hash, model_id, start_ms, end_ms)
+            );
+            CREATE TABLE IF NOT EXISTS diarizations (
+                audio_hash TEXT NOT NULL,
+                model_id TEXT NOT NULL,
+                segments TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (audio_hash, model_id)
+            );
+            CREATE TABLE IF NOT EXISTS vad_maps (
+                audio_hash TEXT NOT NULL,
+                params_id TEXT NOT NULL,
+                offset_map TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (audio_hash, params_id)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS audio_access (
+                audio_hash TEXT PRIMARY KEY,
+                accessed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS free_rows (
+                row INTEGER PRIMARY KEY
+            );
+            """
+        )
+        self.conn.commit()
+
+    # ---------- memmap ----------
+
+    def _capacity_rows(self) -> int:
+        if not self.vectors_path.exists():
+            return 0
+        return self.vectors_path.stat().st_size // (self.dim * 4)
+
+    def _vectors(self, min_rows: int = 0) -> np.memmap:
+        """memmapを取得（他のプロセスがファイルを拡張していれば開き直す）"""
+        if self._memmap is None or self._memmap.shape[0] < min_rows:
+            rows = self._capacity_rows()
+            if rows == 0:
+                raise KeyError("voiceprint store is empty")
+            self._memmap = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(rows, self.dim))
+        return self._memmap
+
+    def _ensure_capacity(self, rows_needed: int):
+        """ファイルを倍々で拡張する（書き込みトランザクション内で呼ぶこと）"""
+        capacity = self._capacity_rows()
+        if capacity >= rows_needed:
+            return
+        new_capacity = max(self.initial_rows, capacity)
+        while new_capacity < rows_needed:
+            new_capacity *= 2
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(new_capacity * self.dim * 4)
+        self._memmap = None
+
+    # ---------- 削除 ----------
+
+    def _touch(self, audio_hash: str):
+        """最終アクセス時刻を更新する（トランザクション内で呼ぶこと）"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO audio_access (audio_hash, accessed_at) VALUES (?, ?)",
+            (audio_hash, time.time())
+        )
+
+    def _meta(self, key: str, default: int = 0) -> int:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def prune(
+        self,
+        ttl_days: float = AUDIO_CACHE_TTL_DAYS,
+        max_audios: int = AUDIO_CACHE_MAX_AUDIOS
+    ) -> int:
+        """
+        古い音声の解析結果を削除する
+
+        Args:
+            ttl_days: 最後に使われてからこの日数を過ぎた音声を削除（0で無効）
+            max_audios: 保持する音声の上限。超えた分は最終アクセスが古い順に削除（0で無効）
+
+        Returns:
+            削除した音声の数
+        """
+        now = time.time()
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                # アクセス記録のない音声（この仕組みより前に保存したもの）は今から数える
+                self.conn.execute(
+                    """
+                    INSERT OR IGNORE INTO audio_access (audio_hash, accessed_at)
+                    SELECT audio_hash, ? FROM voiceprints
+                    UNION SELECT audio_hash, ? FROM diarizations
+                    UNION SELECT audio_hash, ? FROM vad_maps
+                    """,
+                    (now, now, now)
+                )
+                expired = set()
+                if ttl_days > 0:
+                    expired.update(h for (h,) in self.conn.execute(
+                        "SELECT audio_hash FROM audio_access WHERE accessed_at < ?", (now - ttl_days * 86400,)
+                    ))
+                if max_audios > 0:
+                    expired.update(h for (h,) in self.conn.execute(
+                        "SELECT audio_hash FROM audio_access ORDER BY accessed_at DESC LIMIT -1 OFFSET ?", (max_audios,)
+                    ))
+
+                params = [(h,) for h in expired]
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO free_rows (row) SELECT row FROM voiceprints WHERE audio_hash = ?", params
+                )
+                for table in ("voiceprints", "diarizations", "vad_maps", "audio_access"):
+                    self.conn.executemany(f"DELETE FROM {table} WHERE audio_hash = ?", params)
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_pruned_at', ?)", (int(now),))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        if expired:
+            logger.info(f"Audio analysis cache pruned: {len(expired)} audio files")
+        return len(expired)
+
+    def _maybe_prune(self):
+        """前回の削除から AUDIO_CACHE_PRUNE_INTERVAL 秒以上経っていれば削除する（書き込みの後に呼ぶ）"""
+        if AUDIO_CACHE_PRUNE_INTERVAL <= 0:
+            return
+        with self.lock:
+            last = self._meta("last_pruned_at")
+        if time.time() - last < AUDIO_CACHE_PRUNE_INTERVAL:
+            return
+        try:
+            self.prune()
+        except Exception as e:
+            logger.warning(f"Failed to prune audio analysis cache: {e}")
+
+    # ---------- 声紋 ----------
+
+    def get_voiceprints(
+        self,
+        audio_hash: str,
+        model_id: str,
+        ranges: List[Tuple[float, float]]
+    ) -> Dict[Tuple[int, int], np.ndarray]:
+        """
+        キャッシュ済みの声紋を取得
+
+        Args:
+            audio_hash: 音声ファイルのsha256
+            model_id: 声紋モデルのID
+            ranges: (start_time, end_time) のリスト（秒）
+
+        Returns:
+            {(start_ms, end_ms): vector}（見つからない範囲は含まれない）
+        """
+        if not ranges:
+            return {}
+        with self.lock:
+            try:
+                # 行番号の参照とベクトルの読み出しの間に、他のワーカーの削除で行が再利用されないようにする
+                self.conn.execute("BEGIN IMMEDIATE")
+                rows = self.conn.execute(
+                    "SELECT start_ms, end_ms, row FROM voiceprints WHERE audio_hash = ? AND model_id = ?",
+                    (audio_hash, model_id)
+                ).fetchall()
+                wanted = {(_ms(start), _ms(end)) for start, end in ranges}
+                hits = {(start_ms, end_ms): row for start_ms, end_ms, row in rows if (start_ms, end_ms) in wanted}
+                record_cache("voiceprint", hits=len(hits), misses=len(wanted) - len(hits))
+                result = {}
+                if hits:
+                    vectors = self._vectors(max(hits.values()) + 1)
+                    result = {key: np.array(vectors[row]) for key, row in hits.items()}
+                    self._touch(audio_hash)
+                self.conn.commit()
+                return result
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def put_voiceprints(
+        self,
+        audio_hash: str,
+        model_id: str,
+        items: List[Tuple[float, float, np.ndarray]]
+    ):
+        """
+        声紋をキャッシュに保存
+
+        Args:
+            audio_hash: 音声ファイルのsha256
+            model_id: 声紋モデルのID
+            items: (start_time, end_time, vector) のリスト
+        """
+        if not items:
+            return
+        with self.lock:
+            try:
+                # 行番号の割り当てとファイル拡張を1つの書き込みトランザクションで行う
+                # 空き行（削除済みの声紋の行）から先に使う
+                self.conn.execute("BEGIN IMMEDIATE")
+                next_row = self._meta("next_row")
+                free = [row for (row,) in self.conn.execute("SELECT row FROM free_rows ORDER BY row LIMIT ?", (len(items),))]
+                rows = free + list(range(next_row, next_row + len(items) - len(free)))
+                next_row += len(items) - len(free)
+                self._ensure_capacity(next_row)
+                vectors = self._vectors(next_row)
+
+                for row, (start, end, vector) in zip(rows, items):
+                    vectors[row] = np.asarray(vector, dtype=np.float32)
+                vectors.flush()
+
+                self.conn.executemany("DELETE FROM free_rows WHERE row = ?", [(row,) for row in free])
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO voiceprints (audio_hash, model_id, start_ms, end_ms, row) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (audio_hash, model_id, _ms(start), _ms(end), row)
+                        for row, (start, end, _) in zip(rows, items)
+                    ]
+                )
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_row', ?)", (next_row,))
+                self._touch(audio_hash)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        self._maybe_prune()
+
+    # ---------- 話者識別 ----------
+
+    def get_diarization(self, audio_hash: str, model_id: str) -> Optional[List[Dict[str, Any]]]:
+        """キャッシュ済みの話者識別結果（セグメントの辞書のリスト）を取得"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT segments FROM diarizations WHERE audio_hash = ? AND model_id = ?",
+                (audio_hash, model_id)
+            ).fetchone()
+            if row:
+                self._touch(audio_hash)
+                self.conn.commit()
+        record_cache("diarization", hits=1 if row else 0, misses=0 if row else 1)
+        return json.loads(row[0]) if row else None
+
+    def put_diarization(self, audio_hash: str, model_id: str, segments: List[Dict[str, Any]]):
+        """話者識別結果を保存"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO diarizations (audio_hash, model_id, segments, created_at) VALUES (?, ?, ?, ?)",
+                (audio_hash, model_id, json.dumps(segments), time.time())
+            )
+            self._touch(audio_hash)
+            self.conn.commit()
+        self._maybe_prune()
+
+    # ---------- VAD ----------
+
+    def get_vad_map(self, audio_hash: str, params_id: str) -> Optional[Dict[str, Any]]:
+        """
+        キャッシュ済みのVADの結果を取得
+
+        Returns:
+            {"offset_map": OffsetMap.to_dict() の値、無音を詰めない場合はNone}。未計算ならNone
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT offset_map FROM vad_maps WHERE audio_hash = ? AND params_id = ?",
+                (audio_hash, params_id)
+            ).fetchone()
+            if row:
+                self._touch(audio_hash)
+                self.conn.commit()
+        record_cache("vad", hits=1 if row else 0, misses=0 if row else 1)
+        return {"offset_map": json.loads(row[0])} if row else None
+
+    def put_vad_map(self, audio_hash: str, params_id: str, offset_map: Optional[Dict[str, Any]]):
+        """VADの結果を保存（offset_map=None は「無音を詰めない」という結果）"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO vad_maps (audio_hash, params_id, offset_map, created_at) VALUES (?, ?, ?, ?)",
+                (audio_hash, params_id, json.dumps(offset_map), time.time())
+            )
+            self._touch(audio_hash)
+            self.conn.commit()
+        self._maybe_prune()
+
+
+# シングルトンインスタンス
+_cache_instance: Optional[AudioAnalysisCache] = None
+
+
+def get_audio_cache() -> Optional[AudioAnalysisCache]:
+    """
+    AudioAnalysisCacheのシングルトンインスタンスを取得
+
+    Returns:
+        AudioAnalysisCache instance（AUDIO_CACHE_ENABLED=0 または初期化失敗時はNone）
+    """
+    global _cache_instance
+    if not AUDIO_CACHE_ENABLED:
+        return None
+    if _cache_instance is None:
+        try:
+            _cache_instance = AudioAnalysisCache(AUDIO_CACHE_DIR)
+        except Exception as e:
+            logger.warning(f"Audio analysis cache is disabled: {e}")
+            return None
+    return _cache_instance
@@ -0,0 +1,322 @@
+"""
+参照例の一括インポートユーティリティ
+
+CSV / JSON / NDJSON から参照例を読み込み、Embeddingをバッチ生成、
+LLMタグ付けを並列実行したうえで、knowledge_baseにチャンク単位でupsertします。
+"""
+
+import csv
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from .embedding import EMBEDDING_MODEL, PERSIST_EMBEDDINGS, embedding_text_hash, generate_embeddings_batch
+from .tagging import generate_tags
+
+# 設定
+# OpenAI Embeddings APIは1リクエスト最大2048入力・約30万トークンまで
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+EMBEDDING_BATCH_MAX_CHARS = int(os.getenv("EMBEDDING_BATCH_MAX_CHARS", "200000"))
+BULK_UPSERT_CHUNK_SIZE = int(os.getenv("BULK_UPSERT_CHUNK_SIZE", "200"))
+TAGGING_CONCURRENCY = int(os.getenv("TAGGING_CONCURRENCY", "8"))
+
+VALID_TYPES = ("reflection", "final", "other")
+# content_type が未指定の行に使う値（/references の1件登録と同じく「教授の思考」）
+DEFAULT_CONTENT_TYPE = "thought"
+
+
+def _detect_format(content: str, filename: Optional[str] = None) -> str:
+    """ファイル名（拡張子）または内容からフォーマットを判定する"""
+    if filename and "." in filename:
+        ext = filename.rsplit(".", 1)[-1].lower()
+        if ext == "csv":
+            return "csv"
+        if ext in ("ndjson", "jsonl"):
+            return "ndjson"
+        if ext == "json":
+            return "json"
+
+    head = content.lstrip()[:1]
+    if head == "[":
+        return "json"
+    if head == "{":
+        # 1行目だけで完結するJSONならNDJSON
+        first_line = content.lstrip().split("\n", 1)[0]
+        try:
+            json.loads(first_line)
+            return "ndjson"
+        except ValueError:
+            return "json"
+    return "csv"
+
+
+def _parse_tags(value: Any) -> List[str]:
+    """タグをリストに正規化（配列 / カンマ区切り文字列の両対応）"""
+    if not value:
+        return []
+    if isinstance(value, list):
+        return [str(t).strip() for t in value if str(t).strip()]
+    return [t.strip() for t in str(value).replace("、", ",").split(",") if t.strip()]
+
+
+def _normalize_row(raw: Dict[str, Any], default_type: str, default_source: str) -> Dict[str, Any]:
+    """1行分の入力を参照例の形式に正規化する（不正な場合はValueError）"""
+    text = str(raw.get("text") or "").strip()
+    if not text:
+        raise ValueError("textが空です")
+
+    doc_type = str(raw.get("type") or default_type).strip()
+    if doc_type not in VALID_TYPES:
+        raise ValueError(f"typeが不正です: {doc_type}")
+
+    reference_id = str(raw.get("id") or raw.get("reference_id") or "").strip()
+
+    return {
+        "reference_id": reference_id or None,
+        "type": doc_type,
+        "text": text,
+        "tags": _parse_tags(raw.get("tags")),
+        "source": str(raw.get("source") or default_source).strip(),
+        "content_type": str(raw.get("content_type") or DEFAULT_CONTENT_TYPE).strip(),
+    }
+
+
+def parse_references(
+    content: bytes,
+    filename: Optional[str] = None,
+    fmt: Optional[str] = None,
+    default_type: str = "reflection",
+    default_source: str = "professor_examples"
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    CSV / JSON / NDJSON をパースして参照例のリストに変換する
+
+    Args:
+        content: ファイル内容
+        filename: ファイル名（フォーマット判定用）
+        fmt: フォーマット（"csv" | "json" | "ndjson"）。Noneの場合は自動判定
+        default_type: typeが未指定の行に使う種別
+        default_source: sourceが未指定の行に使う値
+
+    Returns:
+        (rows, errors): 正規化済みの行リストと、行番号付きのエラーリスト
+    """
+    text = content.decode("utf-8-sig") if isinstance(content, bytes) else content
+    fmt = fmt or _detect_format(text, filename)
+
+    raw_rows: List[Tuple[int, Any]] = []
+    errors: List[Dict[str, Any]] = []
+
+    if fmt == "csv":
+        reader = csv.DictReader(io.StringIO(text))
+        # ヘッダー行を1行目とする
+        raw_rows = [(i, row) for i, row in enumerate(reader, 2)]
+    elif fmt == "ndjson":
+        for i, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                raw_rows.append((i, json.loads(line)))
+            except ValueError as e:
+                errors.append({"row": i, "id": None, "error": f"JSONの解析に失敗: {e}"})
+    elif fmt == "json":
+        data = json.loads(text)
+        if isinstance(data, dict):
+            data = data.get("references", [])
+        raw_rows = [(i, row) for i, row in enumerate(data, 1)]
+    else:
+        raise ValueError(f"対応していないフォーマットです: {fmt}")
+
+    rows = []
+    for row_num, raw in raw_rows:
+        if not isinstance(raw, dict):
+            errors.append({"row": row_num, "id": None, "error": "オブジェクト形式ではありません"})
+            continue
+        try:
+            row = _normalize_row(raw, default_type, default_source)
+        except ValueError as e:
+            errors.append({"row": row_num, "id": raw.get("id") or None, "error": str(e)})
+            continue
+        row["_row"] = row_num
+        rows.append(row)
+
+    return rows, errors
+
+
+def _embedding_batches(texts: List[str]) -> List[Tuple[int, int]]:
+    """件数上限と文字数上限の両方を満たすように [start, end) の区間に分割する"""
+    batches = []
+    start = 0
+    chars = 0
+    for i, text in enumerate(texts):
+        if i > start and (i - start >= EMBEDDING_BATCH_SIZE or chars + len(text) > EMBEDDING_BATCH_MAX_CHARS):
+            batches.append((start, i))
+            start = i
+            chars = 0
+        chars += len(text)
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+
+def embed_in_batches(texts: List[str]) -> Tuple[List[Optional[List[float]]], Dict[int, str]]:
+    """
+    テキストをAPI上限に合わせたバッチでEmbedding化する
+
+    Returns:
+        (embeddings, errors): 入力と同じ順序のEmbedding（失敗はNone）と、
+        インデックス → エラーメッセージ
+    """
+    embeddings: List[Optional[List[float]]] = [None] * len(texts)
+    errors: Dict[int, str] = {}
+
+    for start, end in _embedding_batches(texts):
+        try:
+            batch = generate_embeddings_batch(texts[start:end])
+            embeddings[start:end] = batch
+        except Exception as e:
+            for i in range(start, end):
+                errors[i] = f"Embedding生成に失敗: {e}"
+
+    return embeddings, errors
+
+
+def tag_in_parallel(texts: List[str], existing_tags: List[str]) -> List[List[str]]:
+    """generate_tags をスレッドプールで並列実行する"""
+    if not texts:
+        return []
+    with ThreadPoolExecutor(max_workers=TAGGING_CONCURRENCY) as executor:
+        return list(executor.map(lambda t: generate_tags(t, existing_tags), texts))
+
+
+def fetch_existing_tags(supabase, limit: int = 100) -> List[str]:
+    """既存のタグを取得（タグ生成時の参考用）"""
+    response = supabase.table("knowledge_base").select("tags").limit(limit).execute()
+    all_tags = []
+    for item in response.data:
+        if item.get("tags"):
+            all_tags.extend(item["tags"])
+    return list(set(all_tags))
+
+
+def assign_reference_ids(supabase, rows: List[Dict[str, Any]], prefix: str = "prof_custom_") -> None:
+    """IDが未指定の行に prof_custom_XXXX 形式のIDを連番で割り当てる"""
+    missing = [row for row in rows if not row["reference_id"]]
+    if not missing:
+        return
+
+    response = supabase.table("knowledge_base").select("reference_id").like("reference_id", f"{prefix}%").execute()
+    used = [item["reference_id"] for item in response.data]
+    used.extend(row["reference_id"] for row in rows if row["reference_id"])
+    max_num = max(
+        [int(rid.split("_")[-1]) for rid in used if rid.startswith(prefix) and rid.split("_")[-1].isdigit()],
+        default=0
+    )
+
+    for offset, row in enumerate(missing, 1):
+        row["reference_id"] = f"{prefix}{max_num + offset:04d}"
+
+
+def upsert_in_chunks(supabase, records: List[Dict[str, Any]], chunk_size: int = BULK_UPSERT_CHUNK_SIZE) -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    reference_idをキーにチャンク単位でupsertする
+
+    チャンクが失敗した場合のみ1行ずつ再試行し、失敗行を特定します。
+
+    Returns:
+        (upserted_count, errors)
+    """
+    upserted = 0
+    errors: List[Dict[str, Any]] = []
+
+    for i in range(0, len(records), chunk_size):
+        chunk = records[i:i + chunk_size]
+        payload = [{k: v for k, v in r.items() if not k.startswith("_")} for r in chunk]
+        try:
+            supabase.table("knowledge_base").upsert(payload, on_conflict="reference_id").execute()
+            upserted += len(chunk)
+            continue
+        except Exception as e:
+            print(f"⚠️ チャンク upsert 失敗（{len(chunk)}件）、1件ずつ再試行します: {e}")
+
+        for record, row_payload in zip(chunk, payload):
+            try:
+                supabase.table("knowledge_base").upsert(row_payload, on_conflict="reference_id").execute()
+                upserted += 1
+            except Exception as e:
+                errors.append({"row": record.get("_row"), "id": record["reference_id"], "error": f"保存に失敗: {e}"})
+
+    return upserted, errors
+
+
+def import_references(
+    supabase,
+    rows: List[Dict[str, Any]],
+    auto_tag: bool = True,
+    skip_existing: bool = False
+) -> Dict[str, Any]:
+    """
+    参照例を一括インポートする
+
+    Args:
+        supabase: Supabaseクライアント
+        rows: parse_references() で正規化された行
+        auto_tag: タグが空の行をLLMで自動タグ付けするか
+        skip_existing: 既存のreference_idをスキップするか（Falseの場合は上書き）
+
+    Returns:
+        件数・所要時間・行ごとのエラーを含む結果の辞書
+    """
+    started = time.time()
+    errors: List[Dict[str, Any]] = []
+    skipped = 0
+
+    if skip_existing:
+        ids = [row["reference_id"] for row in rows if row["reference_id"]]
+        existing = set()
+        for i in range(0, len(ids), BULK_UPSERT_CHUNK_SIZE):
+            response = supabase.table("knowledge_base").select("reference_id").in_("reference_id", ids[i:i + BULK_UPSERT_CHUNK_SIZE]).execute()
+            existing.update(item["reference_id"] for item in response.data)
+        skipped = sum(1 for row in rows if row["reference_id"] in existing)
+        rows = [row for row in rows if row["reference_id"] not in existing]
+
+    assign_reference_ids(supabase, rows)
+
+    # Embedding（バッチ）とタグ付け（並列）は互いに独立なので同時に実行
+    # EMBEDDING_BACKEND=local のときはEmbeddingを保存しない（NULLで上書きし、古いベクトルを残さない）
+    untagged = [row for row in rows if not row["tags"]] if auto_tag else []
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        embed_future = executor.submit(embed_in_batches, [row["text"] for row in rows]) if PERSIST_EMBEDDINGS else None
+        existing_tags = fetch_existing_tags(supabase) if untagged else []
+        tag_future = executor.submit(tag_in_parallel, [row["text"] for row in untagged], existing_tags)
+        embeddings, embed_errors = embed_future.result() if embed_future else ([None] * len(rows), {})
+        tags = tag_future.result()
+
+    for row, row_tags in zip(untagged, tags):
+        row["tags"] = row_tags
+
+    records = []
+    for i, (row, embedding) in enumerate(zip(rows, embeddings)):
+        if i in embed_errors:
+            errors.append({"row": row["_row"], "id": row["reference_id"], "error": embed_errors[i]})
+            continue
+        row["embedding"] = embedding
+        row["embedding_hash"] = embedding_text_hash(row["text"]) if PERSIST_EMBEDDINGS else None
+        row["embedding_model"] = EMBEDDING_MODEL if PERSIST_EMBEDDINGS else None
+        records.append(row)
+
+    upserted, upsert_errors = upsert_in_chunks(supabase, records)
+    errors.extend(upsert_errors)
+
+    return {
+        "total": len(rows) + skipped,
+        "upserted": upserted,
+        "skipped": skipped,
+        "auto_tagged": len(untagged),
+        "error_count": len(errors),
+        "errors": sorted(errors, key=lambda e: e["row"] or 0),
+        "elapsed_ms": int((time.time() - started) * 1000),
+    }
@@ -1,20 +1,350 @@
 """
 Embedding生成ユーティリティ
 
-OpenAI Embeddings APIを使用してテキストをベクトル化します。
+テキストをベクトル化します。バックエンドは EMBEDDING_BACKEND で切り替えます:
+- openai（デフォルト）: OpenAI Embeddings API
+- local: 文字n-gramのTF-IDFによるローカル計算（ネットワーク不要、開発・テスト用）
+
+同じテキスト（空白の違いを除く）のEmbeddingは content-hash → ベクトルのキャッシュ
+（メモリLRU + SQLite）から返し、APIを再度呼び出しません。
+キャッシュはデフォルトではfloat32（無損失）で保持し、EMBEDDING_STORAGE_DTYPE で
+float16 / int8 の量子化を選べます（容量は減りますが値は丸められます）。EMBEDDING_DIMENSIONS を
+1536未満にするとMatryoshka方式で次元を切り詰めます（text-embedding-3系）。
 """
 
+import hashlib
+import math
 import os
-from typing import List
-from openai import OpenAI
+import re
+import sqlite3
+import struct
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
 
-# OpenAI クライアント初期化
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+from .metrics import record_cache
 
 # 設定
-EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
+_DEFAULT_MODELS = {"openai": "text-embedding-3-small", "local": "local-char-ngram-v1"}
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", _DEFAULT_MODELS.get(EMBEDDING_BACKEND, "text-embedding-3-small"))
 EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "1536"))
 
+# knowledge_base.embedding に保存してよいか
+# 保存済みのEmbeddingと search_knowledge_by_embedding はOpenAIのベクトル空間が前提のため、
+# local（文字n-gram）のベクトルは保存しない（embedding は NULL のままにし、
+# openai で migrate_embeddings.py を実行したときに付与する）
+PERSIST_EMBEDDINGS = EMBEDDING_BACKEND == "openai"
+
+# キャッシュ設定
+# EMBEDDING_CACHE_PATH を空にするとディスクキャッシュを無効化
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH",
+    str(Path(__file__).resolve().parents[2] / "data" / "cache" / "embeddings.sqlite3")
+)
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+
+# 量子化設定（float32 | float16 | int8）
+# STORAGE: キャッシュ内部の保持形式（float16 / int8 は損失ありのため明示した場合だけ）
+# TRANSPORT: 返却するベクトル（DB保存・RPC送信）の精度
+EMBEDDING_STORAGE_DTYPE = os.getenv("EMBEDDING_STORAGE_DTYPE", "float32")
+EMBEDDING_TRANSPORT_DTYPE = os.getenv("EMBEDDING_TRANSPORT_DTYPE", "float32")
+
+# dimensionsパラメータ（Matryoshka表現）に対応したモデル
+_MATRYOSHKA_MODELS = ("text-embedding-3-small", "text-embedding-3-large")
+_NATIVE_DIMENSIONS = {"text-embedding-3-small": 1536, "text-embedding-3-large": 3072}
+
+
+def normalize_text(text: str) -> str:
+    """
+    Embedding用にテキストを正規化する（連続する空白・改行を1つの空白にまとめる）
+
+    空白だけが異なるテキストは同じEmbeddingになるものとして扱います。
+    """
+    return re.sub(r"\s+", " ", text.replace("　", " ")).strip()
+
+
+def embedding_text_hash(text: str) -> str:
+    """
+    Embeddingの再利用判定に使うハッシュを計算する
+
+    モデル名と次元数を含めるため、EMBEDDING_MODELを切り替えると
+    すべての行が「未Embedding化」として扱われます。
+
+    Args:
+        text: Embedding化するテキスト
+
+    Returns:
+        sha256の16進文字列
+    """
+    key = f"{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS}:{normalize_text(text)}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+# ===========================================
+# 量子化・次元削減
+# ===========================================
+
+def truncate_embedding(vector: List[float], dimensions: int) -> List[float]:
+    """
+    Matryoshka方式で先頭 dimensions 次元に切り詰めて再正規化する
+
+    Args:
+        vector: 元のEmbedding
+        dimensions: 切り詰め後の次元数
+
+    Returns:
+        L2正規化された切り詰め後のベクトル
+    """
+    if dimensions >= len(vector):
+        return vector
+    head = vector[:dimensions]
+    norm = math.sqrt(sum(v * v for v in head)) or 1.0
+    return [v / norm for v in head]
+
+
+def pack_embedding(vector: List[float], dtype: str = EMBEDDING_STORAGE_DTYPE) -> bytes:
+    """
+    ベクトルをバイト列に量子化する
+
+    - float32: 4バイト/次元
+    - float16: 2バイト/次元
+    - int8: 1バイト/次元 + スケール4バイト（ベクトルごとの対称量子化）
+    """
+    n = len(vector)
+    if dtype == "float16":
+        return struct.pack(f"<{n}e", *vector)
+    if dtype == "int8":
+        scale = max((abs(v) for v in vector), default=0.0) / 127.0 or 1.0
+        return struct.pack("<f", scale) + struct.pack(f"<{n}b", *(round(v / scale) for v in vector))
+    return struct.pack(f"<{n}f", *vector)
+
+
+def unpack_embedding(data: bytes, dtype: str = EMBEDDING_STORAGE_DTYPE) -> List[float]:
+    """pack_embedding() の逆変換"""
+    if dtype == "float16":
+        return list(struct.unpack(f"<{len(data) // 2}e", data))
+    if dtype == "int8":
+        (scale,) = struct.unpack("<f", data[:4])
+        return [q * scale for q in struct.unpack(f"<{len(data) - 4}b", data[4:])]
+    return list(struct.unpack(f"<{len(data) // 4}f", data))
+
+
+def to_transport(vector: List[float], dtype: str = EMBEDDING_TRANSPORT_DTYPE) -> List[float]:
+    """
+    DB保存・RPC送信用にベクトルの精度を落とす
+
+    JSONでは float64 の repr（17桁前後）がそのまま送られるため、
+    量子化後の有効桁数に丸めてペイロードを縮めます。
+    """
+    if dtype == "float16":
+        return [float(f"{v:.4g}") for v in unpack_embedding(pack_embedding(vector, "float16"), "float16")]
+    if dtype == "int8":
+        return [float(f"{v:.3g}") for v in unpack_embedding(pack_embedding(vector, "int8"), "int8")]
+    return vector
+
+
+# ===========================================
+# content-hash → ベクトル キャッシュ
+# ===========================================
+
+class EmbeddingCache:
+    """content-hash → ベクトルのキャッシュ（メモリLRU + SQLite）
+
+    メモリ上もディスク上も量子化済みのバイト列で保持し、
+    取り出すときにfloatのリストへ戻します。
+    """
+
+    def __init__(self, path: Optional[str], max_items: int, dtype: str):
+        self.max_items = max_items
+        self.dtype = dtype
+        self.memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conn: Optional[sqlite3.Connection] = None
+
+        if path:
+            try:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                self.conn = sqlite3.connect(path, check_same_thread=False)
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    "hash TEXT PRIMARY KEY, dtype TEXT NOT NULL, vector BLOB NOT NULL)"
+                )
+                self.conn.commit()
+            except Exception as e:
+                print(f"⚠️ Embeddingディスクキャッシュを開けません（メモリのみ使用）: {e}")
+                self.conn = None
+
+    def _remember(self, key: str, data: bytes):
+        self.memory[key] = data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys: List[str], count_misses: bool = True) -> Dict[str, List[float]]:
+        """
+        キャッシュ済みのベクトルを返す（見つからないキーは含まれない）
+
+        count_misses=False は、見つからなければこの後 _embed_with_cache で引き直す呼び出し用です
+        （ミスを二重に数えないよう、ヒットだけを数えます）。
+        """
+        found: Dict[str, bytes] = {}
+        with self.lock:
+            for key in keys:
+                data = self.memory.get(key)
+                if data is not None:
+                    self.memory.move_to_end(key)
+                    found[key] = data
+
+            missing = [key for key in keys if key not in found]
+            if missing and self.conn is not None:
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    rows = self.conn.execute(
+                        f"SELECT hash, vector FROM embeddings WHERE dtype = ? AND hash IN ({','.join('?' * len(chunk))})",
+                        [self.dtype, *chunk]
+                    ).fetchall()
+                    for key, data in rows:
+                        found[key] = data
+                        self._remember(key, data)
+
+            misses = len(keys) - len(found) if count_misses else 0
+            self.hits += len(found)
+            self.misses += misses
+        record_cache("embedding", hits=len(found), misses=misses)
+
+        return {key: unpack_embedding(data, self.dtype) for key, data in found.items()}
+
+    def put_many(self, items: Dict[str, List[float]]):
+        """ベクトルをキャッシュに保存する"""
+        packed = {key: pack_embedding(vector, self.dtype) for key, vector in items.items()}
+        with self.lock:
+            for key, data in packed.items():
+                self._remember(key, data)
+            if self.conn is not None:
+                try:
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO embeddings (hash, dtype, vector) VALUES (?, ?, ?)",
+                        [(key, self.dtype, data) for key, data in packed.items()]
+                    )
+                    self.conn.commit()
+                except Exception as e:
+                    print(f"⚠️ Embeddingディスクキャッシュへの書き込みに失敗: {e}")
+
+
+_cache = EmbeddingCache(EMBEDDING_CACHE_PATH or None, EMBEDDING_CACHE_SIZE, EMBEDDING_STORAGE_DTYPE)
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """共有のEmbeddingキャッシュを取得"""
+    return _cache
+
+
+# ===========================================
+# Embeddingバックエンド
+# ===========================================
+
+class EmbeddingBackend:
+    """Embeddingバックエンドの共通インターフェース"""
+
+    model_id: str = ""
+    dimensions: int = EMBEDDING_DIMENSIONS
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """
+        テキストのリストをベクトルのリストに変換する（キャッシュなし）
+
+        Args:
+            texts: Embedding化するテキストのリスト
+
+        Returns:
+            入力と同じ順序のEmbeddingベクトルのリスト
+        """
+        raise NotImplementedError
+
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    """OpenAI Embeddings APIを使うバックエンド"""
+
+    def __init__(self, model: str = EMBEDDING_MODEL, dimensions: int = EMBEDDING_DIMENSIONS):
+        self.model_id = model
+        self.dimensions = dimensions
+        self.client = None
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        if self.client is None:
+            # APIキーのない環境（localバックエンドでの開発など）でもimportできるよう遅延初期化
+            # リトライは get_openai_limiter() が行うので、SDK側のリトライは無効にする
+            from openai import OpenAI
+            self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+        params = {"model": self.model_id, "input": texts}
+        native = _NATIVE_DIMENSIONS.get(self.model_id)
+        if self.model_id in _MATRYOSHKA_MODELS and native and self.dimensions < native:
+            # API側で切り詰め＋再正規化してくれる
+            params["dimensions"] = self.dimensions
+        from .rate_limit import get_openai_limiter, sdk_usage_tokens
+        from .token_budget import count_tokens
+        response = get_openai_limiter().call(
+            self.model_id,
+            sum(count_tokens(text) for text in texts),
+            lambda: self.client.embeddings.create(**params),
+            used_tokens=sdk_usage_tokens
+        )
+        return [truncate_embedding(data.embedding, self.dimensions) for data in response.data]
+
+
+_backend_instance: Optional[EmbeddingBackend] = None
+
+
+def get_embedding_backend() -> EmbeddingBackend:
+    """
+    EMBEDDING_BACKEND で指定されたバックエンドのシングルトンインスタンスを取得
+
+    Returns:
+        EmbeddingBackend instance
+    """
+    global _backend_instance
+    if _backend_instance is None:
+        if EMBEDDING_BACKEND == "local":
+            from .local_embedding import LocalEmbeddingBackend
+            _backend_instance = LocalEmbeddingBackend(dimensions=EMBEDDING_DIMENSIONS)
+        elif EMBEDDING_BACKEND == "openai":
+            _backend_instance = OpenAIEmbeddingBackend()
+        else:
+            raise ValueError(f"Unknown EMBEDDING_BACKEND: {EMBEDDING_BACKEND}")
+    return _backend_instance
+
+
+def _request_embeddings(texts: List[str]) -> List[List[float]]:
+    """選択中のバックエンドでEmbeddingを生成する（キャッシュなし）"""
+    return get_embedding_backend().embed(texts)
+
+
+def _embed_with_cache(texts: List[str]) -> List[List[float]]:
+    """キャッシュを引き、見つからないテキスト（重複除去済み）だけAPIで生成する"""
+    keys = [embedding_text_hash(text) for text in texts]
+    vectors = _cache.get_many(list(dict.fromkeys(keys)))
+
+    missing: Dict[str, str] = {}
+    for key, text in zip(keys, texts):
+        if key not in vectors and key not in missing:
+            missing[key] = normalize_text(text)
+
+    if missing:
+        generated = dict(zip(missing.keys(), _request_embeddings(list(missing.values()))))
+        _cache.put_many(generated)
+        if _cache.dtype != "float32":
+            # 量子化して保持する場合は、初回もキャッシュから返る値と同じベクトルを返す
+            generated = {key: unpack_embedding(pack_embedding(v, _cache.dtype), _cache.dtype) for key, v in generated.items()}
+        vectors.update(generated)
+
+    return [to_transport(vectors[key]) for key in keys]
+
 
 def generate_embedding(text: str) -> List[float]:
     """
@@ -24,17 +354,13 @@ def generate_embedding(text: str) -> List[float]:
         text: Embedding化するテキスト
 
     Returns:
-        List[float]: Embeddingベクトル（1536次元）
+        List[float]: Embeddingベクトル（EMBEDDING_DIMENSIONS次元、デフォルト1536）
 
     Raises:
         Exception: Embedding生成に失敗した場合
     """
     try:
-        response = client.embeddings.create(
-            model=EMBEDDING_MODEL,
-            input=text
-        )
-        return response.data[0].embedding
+        return _embed_with_cache([text])[0]
     except Exception as e:
         print(f"Embedding generation error: {e}")
         raise
@@ -54,11 +380,7 @@ def generate_embeddings_batch(texts: List[str]) -> List[List[float]]:
         Exception: Embedding生成に失敗した場合
     """
     try:
-        response = client.embeddings.create(
-            model=EMBEDDING_MODEL,
-            input=texts
-        )
-        return [data.embedding for data in response.data]
+        return _embed_with_cache(texts)
     except Exception as e:
         print(f"Batch embedding generation error: {e}")
         raise
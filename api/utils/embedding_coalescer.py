@@ -0,0 +1,160 @@
+"""
+Embeddingリクエストのマイクロバッチ化
+
+同時に届いた generate_embedding 相当の呼び出しを数ミリ秒だけ溜め、
+generate_embeddings_batch の1リクエストにまとめてから各呼び出し元に結果を返します。
+採点期間のように同時リクエストが多いとき、Embedding APIの往復回数を大きく減らせます。
+"""
+
+import asyncio
+import os
+from typing import Callable, List, Optional, Set, Tuple
+
+from .embedding import embedding_text_hash, generate_embeddings_batch, get_embedding_cache, to_transport
+
+# 設定
+EMBEDDING_COALESCE_MS = float(os.getenv("EMBEDDING_COALESCE_MS", "5"))
+EMBEDDING_COALESCE_MAX_BATCH = int(os.getenv("EMBEDDING_COALESCE_MAX_BATCH", "64"))
+# 1リクエストあたりの入力トークン上限の目安（日本語は1文字≒1トークンとして文字数で近似）
+EMBEDDING_COALESCE_MAX_TOKENS = int(os.getenv("EMBEDDING_COALESCE_MAX_TOKENS", "100000"))
+
+
+class EmbeddingCoalescer:
+    """複数の非同期Embedding呼び出しを1つのバッチリクエストにまとめる
+
+    次のいずれかを満たした時点でバッチを送信します:
+    - 最初の呼び出しから max_wait_ms 経過
+    - 溜まった入力が max_batch 件に到達
+    - 溜まった入力の推定トークン数が max_tokens に到達
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[List[str]], List[List[float]]] = generate_embeddings_batch,
+        max_wait_ms: float = EMBEDDING_COALESCE_MS,
+        max_batch: int = EMBEDDING_COALESCE_MAX_BATCH,
+        max_tokens: int = EMBEDDING_COALESCE_MAX_TOKENS
+    ):
+        self.embed_fn = embed_fn
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch = max_batch
+        self.max_tokens = max_tokens
+
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._pending_tokens = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # 実行中のバッチ（イベントループはタスクを弱参照でしか持たないため、完了まで参照を保持する）
+        self._tasks: Set[asyncio.Task] = set()
+
+        # 統計（呼び出し数 / 実際のAPIリクエスト数）
+        self.calls = 0
+        self.requests = 0
+
+    async def embed(self, text: str) -> List[float]:
+        """
+        テキストをEmbedding化する（他の呼び出しとまとめて送信）
+
+        Args:
+            text: Embedding化するテキスト
+
+        Returns:
+            Embeddingベクトル
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # イベントループが変わった場合（テストなど）は状態を作り直す
+            self._loop = loop
+            self._pending = []
+            self._pending_tokens = 0
+            self._timer = None
+            self._tasks = set()
+
+        tokens = len(text)
+        if self._pending and self._pending_tokens + tokens > self.max_tokens:
+            self._flush()
+
+        future = loop.create_future()
+        self._pending.append((text, future))
+        self._pending_tokens += tokens
+        self.calls += 1
+
+        if len(self._pending) >= self.max_batch or self._pending_tokens >= self.max_tokens:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self):
+        """溜まっている入力をバッチとして送信する"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        batch = self._pending
+        self._pending = []
+        self._pending_tokens = 0
+        self.requests += 1
+        task = self._loop.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[str, asyncio.Future]]):
+        texts = [text for text, _ in batch]
+        try:
+            embeddings = await asyncio.to_thread(self.embed_fn, texts)
+        except Exception as e:
+            if len(batch) == 1:
+                _, future = batch[0]
+                if not future.done():
+                    future.set_exception(e)
+                return
+            # 1件の不正な入力（トークン上限超えなど）で同じバッチの全員を失敗させないよう、
+            # 半分ずつに分けて送り直し、原因の呼び出しにだけ例外を返す
+            middle = len(batch) // 2
+            self.requests += 2
+            await asyncio.gather(self._run(batch[:middle]), self._run(batch[middle:]))
+            return
+
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+
+_coalescer_instance: Optional[EmbeddingCoalescer] = None
+
+
+def get_embedding_coalescer() -> EmbeddingCoalescer:
+    """
+    EmbeddingCoalescerのシングルトンインスタンスを取得
+
+    Returns:
+        EmbeddingCoalescer instance
+    """
+    global _coalescer_instance
+    if _coalescer_instance is None:
+        _coalescer_instance = EmbeddingCoalescer()
+    return _coalescer_instance
+
+
+async def generate_embedding_async(text: str) -> List[float]:
+    """
+    generate_embedding の非同期版（マイクロバッチ経由）
+
+    キャッシュにあるテキストは待ち時間なしで返します。
+    見つからなかった場合のミスは、バッチ側の _embed_with_cache で1回だけ数えます。
+
+    Args:
+        text: Embedding化するテキスト
+
+    Returns:
+        Embeddingベクトル
+    """
+    key = embedding_text_hash(text)
+    cached = get_embedding_cache().get_many([key], count_misses=False)
+    if key in cached:
+        return to_transport(cached[key])
+    return await get_embedding_coalescer().embed(text)
@@ -0,0 +1,145 @@
+"""
+ローカルEmbeddingバックエンド（ネットワーク不要）
+
+文字n-gramを特徴量ハッシングで固定次元に射影し、TF-IDFで重み付けしたベクトルを
+NumPyだけで計算します。OpenAIのEmbeddingほどの意味的な精度はありませんが、
+日本語のレポートでも表記の重なりをよく捉え、1クラス分のレポートを1秒未満でベクトル化できます。
+
+開発・テスト（EMBEDDING_BACKEND=local）と、API障害時の参照例検索のフォールバックに使います。
+"""
+
+import math
+import unicodedata
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .embedding import EmbeddingBackend
+
+LOCAL_EMBEDDING_MODEL = "local-char-ngram-v1"
+
+# 文字コード列から n-gram のハッシュを作るための定数（64bit上で計算）
+_PRIME = np.uint64(1000003)
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _codepoints(text: str) -> np.ndarray:
+    """NFKC正規化・小文字化したテキストをコードポイント配列に変換"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = " ".join(text.split())
+    return np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+
+
+def _ngram_hashes(codes: np.ndarray, ngram_range: Tuple[int, int]) -> np.ndarray:
+    """文字n-gramのハッシュ値をベクトル演算でまとめて計算"""
+    hashes = []
+    for n in range(ngram_range[0], ngram_range[1] + 1):
+        if len(codes) < n:
+            continue
+        h = np.full(len(codes) - n + 1, np.uint64(n), dtype=np.uint64)
+        for offset in range(n):
+            h = h * _PRIME + codes[offset:len(codes) - n + 1 + offset]
+        # 上位ビットに偏りが出ないように攪拌
+        h = h * _MIX
+        h ^= h >> np.uint64(29)
+        hashes.append(h)
+    if not hashes:
+        return np.zeros(0, dtype=np.uint64)
+    return np.concatenate(hashes)
+
+
+class LocalEmbeddingBackend(EmbeddingBackend):
+    """ハッシュ化した文字n-gramのTF-IDFによるEmbedding
+
+    - n-gramは特徴量ハッシングで dimensions 個のバケットに射影（符号付き）
+    - TFは 1 + log(count) のサブリニアスケール
+    - fit() でコーパスの文書頻度からIDFを学習（未学習の場合はTFのみ）
+    - 出力はL2正規化済み（内積 = コサイン類似度）
+    """
+
+    model_id = LOCAL_EMBEDDING_MODEL
+
+    def __init__(self, dimensions: int = 1536, ngram_range: Tuple[int, int] = (1, 3)):
+        self.dimensions = dimensions
+        self.ngram_range = ngram_range
+        self.idf: Optional[np.ndarray] = None
+
+    def _buckets(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        hashes = _ngram_hashes(_codepoints(text), self.ngram_range)
+        buckets = (hashes % np.uint64(self.dimensions)).astype(np.int64)
+        signs = np.where((hashes >> np.uint64(63)) == 0, 1.0, -1.0)
+        return buckets, signs
+
+    def fit(self, corpus: Sequence[str]) -> "LocalEmbeddingBackend":
+        """
+        コーパスの文書頻度からIDFを学習する
+
+        Args:
+            corpus: 文書のリスト
+
+        Returns:
+            self
+        """
+        df = np.zeros(self.dimensions, dtype=np.float64)
+        for text in corpus:
+            buckets, _ = self._buckets(text)
+            df[np.unique(buckets)] += 1.0
+        n_docs = len(corpus)
+        self.idf = np.log((1.0 + n_docs) / (1.0 + df)) + 1.0
+        return self
+
+    def embed_matrix(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        テキストを (len(texts), dimensions) の行列に変換する
+
+        Args:
+            texts: Embedding化するテキストのリスト
+
+        Returns:
+            L2正規化済みのEmbedding行列
+        """
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            buckets, signs = self._buckets(text)
+            if len(buckets) == 0:
+                continue
+            counts = np.bincount(buckets, minlength=self.dimensions).astype(np.float64)
+            signed = np.bincount(buckets, weights=signs, minlength=self.dimensions)
+            tf = np.zeros(self.dimensions, dtype=np.float64)
+            nonzero = counts > 0
+            tf[nonzero] = (1.0 + np.log(counts[nonzero])) * np.sign(signed[nonzero])
+            if self.idf is not None:
+                tf *= self.idf
+            norm = np.linalg.norm(tf)
+            if norm > 0:
+                matrix[row] = tf / norm
+        return matrix
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """EmbeddingBackendインターフェース: テキストのリストをベクトルのリストに変換"""
+        return self.embed_matrix(texts).tolist()
+
+
+def rank_by_similarity(query: str, documents: List[str], k: int = 5, dimensions: int = 1536) -> List[Tuple[float, int]]:
+    """
+    ローカルEmbeddingでクエリに近い文書を検索する
+
+    documents でIDFを学習してから、コサイン類似度の上位k件を返します。
+
+    Args:
+        query: 検索クエリ
+        documents: 検索対象の文書リスト
+        k: 取得件数
+        dimensions: ハッシュ空間の次元数
+
+    Returns:
+        [(similarity, document_index), ...]（類似度の降順）
+    """
+    if not documents:
+        return []
+    backend = LocalEmbeddingBackend(dimensions=dimensions).fit(documents)
+    doc_matrix = backend.embed_matrix(documents)
+    query_vector = backend.embed_matrix([query])[0]
+    scores = doc_matrix @ query_vector
+    order = np.argsort(-scores)[:k]
+    return [(float(scores[i]), int(i)) for i in order if not math.isnan(scores[i])]
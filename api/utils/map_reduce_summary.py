@@ -0,0 +1,244 @@
+"""
+非常に長い文書（講義の文字起こし、長い最終レポート）の階層的な要約（map-reduce）
+
+1つのプロンプトに収まらない文書を段落・文の単位でセクションに分け、
+各セクションを安価なモデル（SUMMARY_MAP_MODEL）で並列に要約（map）し、
+要約をつなげたメモを通常の要約プロンプトに渡して 1️⃣〜4️⃣ の形式にまとめます（reduce）。
+メモ自体が長すぎる場合は、メモをさらにセクションに分けて要約を繰り返します。
+
+セクションの区切りは段落の内容のハッシュで決める（content-defined chunking）ので、
+1つの段落を編集しても区切りがずれるのはその前後だけです。セクションの要約は
+(モデル, プロンプトのバージョン, セクション本文) のハッシュでキャッシュし、
+変更の無いセクションは再計算しません。
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .metrics import record_cache
+from .prompt_registry import get_prompt_registry
+from .token_budget import count_tokens, truncate_to_tokens
+
+# これを超える文書は map-reduce で要約する（トークン）
+SUMMARY_MAP_REDUCE_THRESHOLD = int(os.environ.get("SUMMARY_MAP_REDUCE_THRESHOLD", "12000"))
+SUMMARY_MAP_MODEL = os.environ.get("SUMMARY_MAP_MODEL", "gpt-4o-mini")
+SUMMARY_MAP_CONCURRENCY = int(os.environ.get("SUMMARY_MAP_CONCURRENCY", "4"))
+# セクションの目安の大きさ（トークン）。区切りはこの半分〜1.5倍の間で内容から決まる
+SUMMARY_SECTION_TOKENS = int(os.environ.get("SUMMARY_SECTION_TOKENS", "3000"))
+# SUMMARY_CACHE_PATH を空にするとディスクキャッシュを無効化
+SUMMARY_CACHE_PATH = os.getenv(
+    "SUMMARY_CACHE_PATH",
+    str(Path(__file__).resolve().parents[2] / "data" / "cache" / "summary_sections.sqlite3")
+)
+
+SECTION_PROMPT = "summary_section"
+# 区切り候補にする割合（段落のハッシュ % _BOUNDARY_MODULUS == 0 の段落の後で区切る）
+_BOUNDARY_MODULUS = 4
+
+_SENTENCE_END = re.compile(r"(?<=[。！？!?])")
+
+# (prompt, system_prompt, model) → (要約, エラー)
+Completion = Callable[[str, Optional[str], str], Tuple[Optional[str], Optional[str]]]
+
+
+class SectionSummaryCache:
+    """セクション本文のハッシュ → 要約（SQLite）"""
+
+    def __init__(self, path: Optional[str]):
+        self.lock = threading.Lock()
+        self.memory: Dict[str, str] = {}
+        self.conn: Optional[sqlite3.Connection] = None
+        if path:
+            try:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("CREATE TABLE IF NOT EXISTS section_summaries (hash TEXT PRIMARY KEY, summary TEXT NOT NULL)")
+                self.conn.commit()
+            except Exception as e:
+                print(f"⚠️ 要約キャッシュを開けません（メモリのみ使用）: {e}")
+                self.conn = None
+
+    @staticmethod
+    def key(model: str, prompt_version: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\n{prompt_version}\n{text}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            if key in self.memory:
+                return self.memory[key]
+            if self.conn is None:
+                return None
+            row = self.conn.execute("SELECT summary FROM section_summaries WHERE hash = ?", (key,)).fetchone()
+            if row:
+                self.memory[key] = row[0]
+                return row[0]
+        return None
+
+    def put(self, key: str, summary: str):
+        with self.lock:
+            self.memory[key] = summary
+            if self.conn is not None:
+                try:
+                    self.conn.execute("INSERT OR REPLACE INTO section_summaries (hash, summary) VALUES (?, ?)", (key, summary))
+                    self.conn.commit()
+                except Exception as e:
+                    print(f"⚠️ 要約キャッシュへの書き込みに失敗: {e}")
+
+
+_cache_instance: Optional[SectionSummaryCache] = None
+
+
+def get_section_summary_cache() -> SectionSummaryCache:
+    """SectionSummaryCacheのシングルトンインスタンスを取得"""
+    global _cache_instance
+    if _cache_instance is None:
+        _cache_instance = SectionSummaryCache(SUMMARY_CACHE_PATH or None)
+    return _cache_instance
+
+
+def _units(text: str, max_tokens: int) -> List[str]:
+    """段落に分け、長すぎる段落（改行の無い文字起こしなど）は文に分ける"""
+    units = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if count_tokens(paragraph) <= max_tokens // 4:
+            units.append(paragraph)
+            continue
+        for sentence in _SENTENCE_END.split(paragraph):
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            # 句点の無い長い文は予算で切る
+            while count_tokens(sentence) > max_tokens // 2:
+                head = truncate_to_tokens(sentence, max_tokens // 2).rstrip("…")
+                units.append(head)
+                sentence = sentence[len(head):].strip()
+            if sentence:
+                units.append(sentence)
+    return units
+
+
+def split_sections(text: str, section_tokens: int = SUMMARY_SECTION_TOKENS) -> List[str]:
+    """
+    文書をセクションに分ける（内容で区切りを決める）
+
+    段落の後で区切るのは、セクションが section_tokens の半分以上になっていて
+    その段落のハッシュが区切り条件を満たすとき、または次の段落で
+    section_tokens の1.5倍を超えるときです。
+
+    Args:
+        text: 文書
+        section_tokens: セクションの目安の大きさ（トークン）
+
+    Returns:
+        セクション本文のリスト
+    """
+    min_tokens = section_tokens // 2
+    max_tokens = section_tokens * 3 // 2
+    sections: List[str] = []
+    current: List[str] = []
+    used = 0
+
+    for unit in _units(text, section_tokens):
+        tokens = count_tokens(unit)
+        if current and used + tokens > max_tokens:
+            sections.append("\n\n".join(current))
+            current, used = [], 0
+        current.append(unit)
+        used += tokens
+        digest = hashlib.blake2b(unit.encode("utf-8"), digest_size=4).digest()
+        if used >= min_tokens and int.from_bytes(digest, "big") % _BOUNDARY_MODULUS == 0:
+            sections.append("\n\n".join(current))
+            current, used = [], 0
+
+    if current:
+        sections.append("\n\n".join(current))
+    return sections
+
+
+def summarize_sections(
+    sections: List[str],
+    complete: Completion,
+    model: str = SUMMARY_MAP_MODEL,
+    concurrency: int = SUMMARY_MAP_CONCURRENCY
+) -> Tuple[List[str], int]:
+    """
+    セクションを並列に要約する（キャッシュ済みのものは再計算しない）
+
+    Returns:
+        (セクションごとの要約, キャッシュから返した数)
+
+    Raises:
+        RuntimeError: 要約に失敗したセクションがある
+    """
+    prompts = get_prompt_registry()
+    template = prompts.get(SECTION_PROMPT)
+    cache = get_section_summary_cache()
+    keys = [cache.key(model, template.version, section) for section in sections]
+    summaries: List[Optional[str]] = [cache.get(key) for key in keys]
+    cached = sum(1 for s in summaries if s is not None)
+    record_cache("summary_section", hits=cached, misses=len(sections) - cached)
+
+    def run(index: int) -> Tuple[int, str]:
+        summary, error = complete(template.render(text=sections[index]), None, model)
+        if not summary or error:
+            raise RuntimeError(f"セクション {index + 1}/{len(sections)} の要約に失敗: {error}")
+        summary = summary.strip()
+        cache.put(keys[index], summary)
+        return index, summary
+
+    pending = [i for i, s in enumerate(summaries) if s is None]
+    if pending:
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(pending)))) as executor:
+            for index, summary in executor.map(run, pending):
+                summaries[index] = summary
+    return summaries, cached
+
+
+def condense(
+    text: str,
+    complete: Completion,
+    reduce_budget: int = SUMMARY_MAP_REDUCE_THRESHOLD,
+    model: str = SUMMARY_MAP_MODEL,
+    section_tokens: int = SUMMARY_SECTION_TOKENS
+) -> Dict[str, object]:
+    """
+    文書をセクション要約のメモにまとめる（メモが reduce_budget 以下になるまで繰り返す）
+
+    Args:
+        text: 文書
+        complete: LLM呼び出し (prompt, system_prompt, model) → (要約, エラー)
+        reduce_budget: 最後の要約（reduce）に渡すメモの上限（トークン）
+        model: セクション要約に使うモデル
+        section_tokens: セクションの目安の大きさ
+
+    Returns:
+        {"text": メモ, "sections": 最初の段のセクション数, "cached": キャッシュから返した数, "levels": 段数}
+    """
+    sections = split_sections(text, section_tokens)
+    first_level = len(sections)
+    cached_total = 0
+    levels = 0
+
+    while True:
+        summaries, cached = summarize_sections(sections, complete, model)
+        cached_total += cached
+        levels += 1
+        notes = "\n\n".join(f"【パート{i}/{len(summaries)}】\n{s}" for i, s in enumerate(summaries, 1))
+        if count_tokens(notes) <= reduce_budget or len(summaries) <= 1:
+            break
+        sections = split_sections("\n\n".join(summaries), section_tokens)
+        if len(sections) >= len(summaries):
+            # これ以上まとまらない（要約が縮まない）
+            break
+
+    return {"text": notes, "sections": first_level, "cached": cached_total, "levels": levels}
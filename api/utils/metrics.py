@@ -0,0 +1,267 @@
+"""
+処理段階ごとのレイテンシ計測（スパン）と Prometheus 形式のメトリクス
+
+    with span("retrieval"):
+        refs = ...
+
+スパンは次の2か所に記録されます。
+- プロセス全体のヒストグラム app_stage_duration_seconds{stage="retrieval"}（/metrics で公開）
+- 実行中のHTTPリクエストの Server-Timing ヘッダー（ブラウザの開発者ツールで段階ごとの時間が見える）
+
+リクエストごとの記録は contextvars で持つので、asyncio.to_thread で実行した処理の中の
+スパンも同じリクエストに記録されます（ThreadPoolExecutor に直接渡した処理は対象外）。
+
+ほかに、OpenAIの使用トークン数、キャッシュのヒット率、フォールバックの回数を数えます。
+値はワーカー（プロセス）ごとです。複数のuvicornワーカーで動かす場合、/metrics は
+応答したワーカーの値を返します。
+"""
+
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") in ("1", "true", "TRUE", "on")
+
+# レイテンシのヒストグラムの区切り（秒）。LLM呼び出しや音声処理の数十秒まで含める
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """ラベルごとの累積カウンタ"""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram:
+    """ラベルごとのヒストグラム（累積バケット、合計、件数）"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[Labels, List[float]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            # [バケットごとの件数..., 合計, 件数]
+            state = self.values.setdefault(key, [0.0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            items = sorted((key, list(state)) for key, state in self.values.items())
+        for key, state in items:
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', _format_value(bound)))} {_format_value(cumulative)}"
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', '+Inf'))} {_format_value(state[-1])}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-2])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {_format_value(state[-1])}"
+
+
+class CallbackMetric:
+    """出力のたびに collect() で値を集めるメトリクス（他のモジュールの統計をそのまま公開する）"""
+
+    def __init__(self, name: str, help: str, type: str, labelnames: Sequence[str], collect: Callable[[], Dict[Labels, float]]):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def samples(self) -> Iterator[str]:
+        try:
+            values = self.collect()
+        except Exception as e:
+            print(f"⚠️ メトリクス {self.name} を収集できません: {e}")
+            return
+        for key, value in sorted(values.items()):
+            if value is None:
+                continue
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class MetricsRegistry:
+    """メトリクスの一覧と Prometheus テキスト形式への出力"""
+
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name: str, help: str, type: str, labelnames: Sequence[str], collect: Callable[[], Dict[Labels, float]]) -> CallbackMetric:
+        """collect() の値を出力するメトリクスを登録する（同じ名前は置き換える）"""
+        metric = CallbackMetric(name, help, type, labelnames, collect)
+        with self.lock:
+            self.metrics[name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "app_stage_duration_seconds", "処理段階ごとの所要時間", ["stage"]
+)
+STAGE_ERRORS = REGISTRY.counter(
+    "app_stage_errors_total", "例外で終了した処理段階の数", ["stage"]
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "app_http_request_duration_seconds", "HTTPリクエストの所要時間", ["method", "route", "status"]
+)
+OPENAI_TOKENS = REGISTRY.counter(
+    "app_openai_tokens_total", "OpenAI APIの使用トークン数（応答の usage.total_tokens）", ["model"]
+)
+CACHE_LOOKUPS = REGISTRY.counter(
+    "app_cache_lookups_total", "キャッシュの参照数（result=hit/miss）", ["cache", "result"]
+)
+FALLBACKS = REGISTRY.counter(
+    "app_fallbacks_total", "フォールバックの回数（定型コメント、簡易要約、ローカル検索など）", ["kind"]
+)
+
+
+def _cache_hit_ratios() -> Dict[Labels, float]:
+    with CACHE_LOOKUPS.lock:
+        values = dict(CACHE_LOOKUPS.values)
+    totals: Dict[str, List[float]] = {}
+    for (cache, result), count in values.items():
+        totals.setdefault(cache, [0.0, 0.0])[0 if result == "hit" else 1] += count
+    return {(cache,): hits / (hits + misses) for cache, (hits, misses) in totals.items() if hits + misses}
+
+
+REGISTRY.callback("app_cache_hit_ratio", "キャッシュのヒット率（起動からの累計）", "gauge", ["cache"], _cache_hit_ratios)
+
+
+# ---------- スパンと Server-Timing ----------
+
+_request_timings: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar(
+    "request_timings", default=None
+)
+
+
+def begin_request() -> List[Tuple[str, float]]:
+    """実行中のリクエストのスパン記録を始める（ミドルウェアから呼ぶ）"""
+    timings: List[Tuple[str, float]] = []
+    _request_timings.set(timings)
+    return timings
+
+
+@contextmanager
+def span(stage: str):
+    """with ブロックの所要時間を stage として記録する"""
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def server_timing(timings: List[Tuple[str, float]]) -> str:
+    """Server-Timing ヘッダーの値（同じ段階が複数回あれば合計し、回数を desc に入れる）"""
+    totals: Dict[str, List[float]] = {}
+    for stage, elapsed in timings:
+        entry = totals.setdefault(stage, [0.0, 0])
+        entry[0] += elapsed
+        entry[1] += 1
+    parts = []
+    for stage, (elapsed, count) in totals.items():
+        part = f"{stage};dur={elapsed * 1000:.1f}"
+        if count > 1:
+            part += f';desc="x{count}"'
+        parts.append(part)
+    return ", ".join(parts)
+
+
+def record_tokens(model: str, tokens: Optional[int]):
+    if tokens:
+        OPENAI_TOKENS.inc(tokens, model=model)
+
+
+def record_cache(cache: str, hits: int = 0, misses: int = 0):
+    if hits:
+        CACHE_LOOKUPS.inc(hits, cache=cache, result="hit")
+    if misses:
+        CACHE_LOOKUPS.inc(misses, cache=cache, result="miss")
+
+
+def record_fallback(kind: str):
+    FALLBACKS.inc(kind=kind)
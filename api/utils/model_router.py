@@ -0,0 +1,246 @@
+"""
+LLMモデルのルーティングとヘッジリクエスト
+
+モデルごとに直近の応答時間とエラー率を記録し、次のように呼び出し先を決めます。
+- 短い入力（SUMMARY_SHORT_INPUT_TOKENS 未満）は安価なモデルを優先する
+- 直近のエラー率が高いモデルは後回しにする
+- 1つ目のモデルが p95 の応答時間を過ぎても返らなければ、2つ目のモデルにも同じ
+  リクエストを送り（ヘッジ）、先に成功した方を採用してもう一方は打ち切る
+- 1つ目が失敗した場合は待たずに2つ目を呼ぶ
+
+打ち切りは協調的に行います。負けた方のセッションの cancelled フラグを立てるので、
+attempt は応答をストリーミング（stream=True / SSE）で受け取り、チャンクの合間に
+フラグを見て RequestCancelled を送出してください（応答を閉じると接続が切れ、
+サーバー側の生成も止まります）。Session.close() だけでは読み込み中のソケットは
+中断されないため、最初のチャンクが届くまでの待ちと、ストリーミングしない attempt は
+応答（またはタイムアウト）まで打ち切れません。
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+import numpy as np
+import requests
+
+MODEL_HEDGE_ENABLED = os.environ.get("MODEL_HEDGE_ENABLED", "1") in ("1", "true", "TRUE", "on")
+# 記録が少ないうちのヘッジまでの待ち時間（秒）
+MODEL_HEDGE_DEFAULT_DELAY = float(os.environ.get("MODEL_HEDGE_DEFAULT_DELAY", "20"))
+MODEL_HEDGE_MIN_DELAY = float(os.environ.get("MODEL_HEDGE_MIN_DELAY", "3"))
+# この入力トークン数未満のレポートは安価なモデルで要約する
+SUMMARY_SHORT_INPUT_TOKENS = int(os.environ.get("SUMMARY_SHORT_INPUT_TOKENS", "1500"))
+CHEAP_MODEL = os.environ.get("CHEAP_MODEL", "gpt-4o-mini")
+
+# 記録する直近の呼び出し数と、p95を使い始める最小記録数
+_WINDOW = 100
+_MIN_SAMPLES = 10
+# エラー率がこれを超えたモデルは後回しにする（最小記録数以上のとき）
+_MAX_ERROR_RATE = 0.5
+
+T = TypeVar("T")
+
+
+class ModelRouterError(Exception):
+    """すべてのモデルで失敗した（cause に最後のモデルの例外）"""
+
+    def __init__(self, model: str, cause: Exception):
+        super().__init__(f"{model}: {cause}")
+        self.model = model
+        self.cause = cause
+
+
+class RequestCancelled(Exception):
+    """ヘッジで負けたため、attempt が読み込みを打ち切った"""
+    pass
+
+
+class ModelStats:
+    """1モデル分の直近の応答時間と成否"""
+
+    def __init__(self, window: int = _WINDOW):
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.outcomes: Deque[bool] = deque(maxlen=window)
+        self.hedges = 0
+        self.wins = 0
+
+    def record(self, latency: float, ok: bool):
+        if ok:
+            self.latencies.append(latency)
+        self.outcomes.append(ok)
+
+    def p95(self) -> Optional[float]:
+        if len(self.latencies) < _MIN_SAMPLES:
+            return None
+        return float(np.percentile(np.fromiter(self.latencies, dtype=np.float64), 95))
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return 1.0 - sum(self.outcomes) / len(self.outcomes)
+
+
+class ModelRouter:
+    """モデルごとの統計を持ち、呼び出し順とヘッジを決めるルーター"""
+
+    def __init__(self, hedge_enabled: bool = MODEL_HEDGE_ENABLED, max_workers: int = 16):
+        self.hedge_enabled = hedge_enabled
+        self._stats: Dict[str, ModelStats] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="model-router")
+
+    def stats(self, model: str) -> ModelStats:
+        with self._lock:
+            if model not in self._stats:
+                self._stats[model] = ModelStats()
+            return self._stats[model]
+
+    def route(self, models: List[str], input_tokens: Optional[int] = None) -> List[str]:
+        """
+        呼び出す順序を決める
+
+        Args:
+            models: 候補（優先順）
+            input_tokens: 入力の長さ（短ければ CHEAP_MODEL を先頭にする）
+
+        Returns:
+            並べ替えた候補
+        """
+        ordered = list(models)
+        if input_tokens is not None and input_tokens < SUMMARY_SHORT_INPUT_TOKENS and CHEAP_MODEL in ordered:
+            ordered.remove(CHEAP_MODEL)
+            ordered.insert(0, CHEAP_MODEL)
+
+        def unhealthy(model: str) -> bool:
+            stats = self.stats(model)
+            return len(stats.outcomes) >= _MIN_SAMPLES and stats.error_rate() > _MAX_ERROR_RATE
+
+        # 安定ソートで、エラーの多いモデルだけ後ろに回す
+        return sorted(ordered, key=unhealthy)
+
+    def hedge_delay(self, model: str, timeout: float) -> float:
+        """model の p95 応答時間（記録が少なければ既定値）。timeout を超えない"""
+        p95 = self.stats(model).p95()
+        delay = MODEL_HEDGE_DEFAULT_DELAY if p95 is None else p95
+        return min(max(delay, MODEL_HEDGE_MIN_DELAY), timeout)
+
+    def _attempt(self, model: str, attempt: Callable[[str, requests.Session], T], session: requests.Session, cancelled: threading.Event) -> T:
+        started = time.monotonic()
+        try:
+            result = attempt(model, session)
+        except Exception:
+            # 打ち切った側の失敗はモデルのエラーとして数えない
+            if not cancelled.is_set():
+                self.stats(model).record(time.monotonic() - started, ok=False)
+            raise
+        finally:
+            session.close()
+        self.stats(model).record(time.monotonic() - started, ok=True)
+        return result
+
+    def call(
+        self,
+        attempt: Callable[[str, requests.Session], T],
+        models: List[str],
+        timeouts: Optional[Dict[str, float]] = None,
+        hedge: bool = True
+    ) -> Tuple[str, T]:
+        """
+        候補のモデルを順に（遅ければヘッジして並行に）呼び出す
+
+        Args:
+            attempt: (モデル名, セッション) を受け取り、結果を返すか例外を送出する関数
+            models: 呼び出す順序
+            timeouts: モデルごとのタイムアウト（秒、ヘッジ待ちの上限に使う）
+            hedge: ヘッジリクエストを使うか
+
+        Returns:
+            (成功したモデル, 結果)
+
+        Raises:
+            ModelRouterError: すべてのモデルで失敗した
+        """
+        timeouts = timeouts or {}
+        remaining = list(models)
+        running: Dict[Future, Tuple[str, requests.Session, threading.Event]] = {}
+        last_error: Optional[ModelRouterError] = None
+        hedge_at: Optional[float] = None
+
+        def start(model: str):
+            nonlocal hedge_at
+            session = requests.Session()
+            cancelled = threading.Event()
+            # attempt 側でリトライを打ち切れるように、打ち切りフラグをセッションに持たせる
+            session.cancelled = cancelled
+            future = self._executor.submit(self._attempt, model, attempt, session, cancelled)
+            running[future] = (model, session, cancelled)
+            hedge_at = None
+            if hedge and self.hedge_enabled and remaining:
+                hedge_at = time.monotonic() + self.hedge_delay(model, timeouts.get(model, MODEL_HEDGE_DEFAULT_DELAY))
+
+        start(remaining.pop(0))
+        while running:
+            timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at is not None else None
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                # 応答が遅い: 次のモデルにも送る
+                model = remaining.pop(0)
+                self.stats(model).hedges += 1
+                print(f"[INFO] Hedging request to {model}")
+                start(model)
+                continue
+
+            for future in done:
+                model, _, _ = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    last_error = ModelRouterError(model, e)
+                    if remaining and not running:
+                        start(remaining.pop(0))
+                    continue
+
+                # 勝った方を採用し、残りは打ち切る（attempt が次のチャンクで応答を閉じる）
+                for other, (_, other_session, other_cancelled) in running.items():
+                    other_cancelled.set()
+                    other.cancel()
+                    other_session.close()
+                self.stats(model).wins += 1
+                return model, result
+
+        raise last_error or ModelRouterError(",".join(models), RuntimeError("no model to call"))
+
+    def snapshot(self) -> Dict[str, Dict[str, object]]:
+        """モデルごとの統計（デバッグ・メトリクス用）"""
+        with self._lock:
+            items = list(self._stats.items())
+        return {
+            model: {
+                "calls": len(stats.outcomes),
+                "p95_seconds": stats.p95(),
+                "error_rate": round(stats.error_rate(), 3),
+                "hedges": stats.hedges,
+                "wins": stats.wins,
+            }
+            for model, stats in items
+        }
+
+
+# シングルトンインスタンス
+_router_instance: Optional[ModelRouter] = None
+
+
+def get_model_router() -> ModelRouter:
+    """
+    ModelRouterのシングルトンインスタンスを取得
+
+    Returns:
+        ModelRouter instance
+    """
+    global _router_instance
+    if _router_instance is None:
+        _router_instance = ModelRouter()
+    return _router_instance
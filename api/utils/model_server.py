@@ -0,0 +1,286 @@
+"""
+音声モデルサーバー
+
+SpeechBrain（ECAPA-TDNN）と pyannote（speaker-diarization-3.1）を1つのプロセスに
+ロードし、Unixソケット経由で各uvicornワーカーから利用できるようにします。
+ワーカーごとに約1GBのモデルを持つ必要がなくなり、起動時にモデルをロード・
+ウォームアップしておくので最初のリクエストでロード待ちが発生しません。
+
+起動:
+    AUDIO_MODEL_SOCKET=/tmp/audio_models.sock python -m api.utils.model_server
+
+APIサーバー側も同じ AUDIO_MODEL_SOCKET を設定すると、get_voiceprint_extractor() と
+get_speaker_diarization() がこのサーバーへのプロキシを返します。
+音声は同一ホストの一時ファイルのパスで受け渡します（ワーカーとサーバーで共有）。
+
+プロトコル: 1接続1リクエスト。JSONを1行送り、JSONを1行受け取ります。
+    → {"method": "extract_voiceprints", "params": {...}}
+    ← {"ok": true, "result": ...} / {"ok": false, "error": "..."}
+"""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .speaker_diarization import SpeakerDiarization, SpeakerSegment
+from .voiceprint_extractor import VoiceprintExtractor
+
+logger = logging.getLogger(__name__)
+
+AUDIO_MODEL_SOCKET = os.environ.get("AUDIO_MODEL_SOCKET", "")
+# 話者識別は長い音声で数分かかるため、タイムアウトは長めに取る
+AUDIO_MODEL_TIMEOUT = float(os.environ.get("AUDIO_MODEL_TIMEOUT", "1800"))
+
+
+class ModelServerError(Exception):
+    """モデルサーバーとの通信に失敗した"""
+    pass
+
+
+class ModelServerUnavailable(ModelServerError):
+    """モデルサーバーが起動していない（ソケットがない・接続を拒否された）"""
+    pass
+
+
+# ---------- クライアント ----------
+
+def call_model_server(method: str, params: Dict[str, Any], socket_path: Optional[str] = None, timeout: Optional[float] = None) -> Any:
+    """
+    モデルサーバーのメソッドを呼び出す
+
+    Args:
+        method: メソッド名
+        params: 引数（JSONに変換できる値）
+        socket_path: Unixソケットのパス（省略時は AUDIO_MODEL_SOCKET）
+        timeout: タイムアウト（秒）
+
+    Returns:
+        サーバーが返した result
+
+    Raises:
+        ModelServerUnavailable: サーバーが起動していない（このプロセスで処理してよい）
+        ModelServerError: タイムアウト・通信エラー・サーバー側でエラー
+    """
+    socket_path = socket_path or AUDIO_MODEL_SOCKET
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout or AUDIO_MODEL_TIMEOUT)
+            try:
+                sock.connect(socket_path)
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                raise ModelServerUnavailable(f"model server unavailable ({socket_path}): {e}") from e
+            sock.sendall(json.dumps({"method": method, "params": params}).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as reader:
+                line = reader.readline()
+    except socket.timeout as e:
+        raise ModelServerError(f"model server timed out ({method}, {timeout or AUDIO_MODEL_TIMEOUT}s)") from e
+    except OSError as e:
+        raise ModelServerError(f"model server connection failed ({socket_path}): {e}") from e
+
+    if not line:
+        raise ModelServerError("model server closed the connection")
+    response = json.loads(line)
+    if not response.get("ok"):
+        raise ModelServerError(response.get("error", "unknown error"))
+    return response.get("result")
+
+
+def model_server_available(socket_path: Optional[str] = None) -> bool:
+    """モデルサーバーが応答するか"""
+    socket_path = socket_path or AUDIO_MODEL_SOCKET
+    if not socket_path or not os.path.exists(socket_path):
+        return False
+    try:
+        call_model_server("ping", {}, socket_path, timeout=5)
+        return True
+    except ModelServerError:
+        return False
+
+
+class RemoteVoiceprintExtractor(VoiceprintExtractor):
+    """声紋抽出をモデルサーバーに委譲するプロキシ
+
+    サーバーが起動していない場合だけ、このプロセスでモデルをロードして処理します。
+    サーバー側のエラーとタイムアウトはそのまま呼び出し元に返します（再実行すると二重に待つため）。
+    """
+
+    def __init__(self, socket_path: str):
+        super().__init__()
+        self.socket_path = socket_path
+
+    def extract_voiceprints(
+        self,
+        audio_path: str,
+        segments: List[Tuple[float, float]],
+        audio_hash: Optional[str] = None
+    ) -> List[Optional[np.ndarray]]:
+        try:
+            result = call_model_server(
+                "extract_voiceprints",
+                {"audio_path": os.path.abspath(audio_path), "segments": [list(s) for s in segments], "audio_hash": audio_hash},
+                self.socket_path
+            )
+        except ModelServerUnavailable as e:
+            logger.warning(f"{e}; extracting voiceprints in-process")
+            return super().extract_voiceprints(audio_path, segments, audio_hash)
+        return [np.asarray(v, dtype=np.float32) if v is not None else None for v in result]
+
+    def extract_voiceprint(
+        self,
+        audio_path: str,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None
+    ) -> np.ndarray:
+        try:
+            result = call_model_server(
+                "extract_voiceprint",
+                {"audio_path": os.path.abspath(audio_path), "start_time": start_time, "end_time": end_time},
+                self.socket_path
+            )
+        except ModelServerUnavailable as e:
+            logger.warning(f"{e}; extracting voiceprint in-process")
+            return super().extract_voiceprint(audio_path, start_time, end_time)
+        return np.asarray(result, dtype=np.float32)
+
+    def warm_up(self):
+        call_model_server("ping", {}, self.socket_path, timeout=5)
+
+
+class RemoteSpeakerDiarization(SpeakerDiarization):
+    """話者識別をモデルサーバーに委譲するプロキシ
+
+    統計・マッチングなどモデルを使わない処理はこのプロセスで行います。
+    """
+
+    def __init__(self, socket_path: str):
+        super().__init__()
+        self.socket_path = socket_path
+
+    def identify_speakers(self, audio_path: str, audio_hash: Optional[str] = None, use_cache: bool = True) -> List[SpeakerSegment]:
+        try:
+            result = call_model_server(
+                "identify_speakers",
+                {"audio_path": os.path.abspath(audio_path), "audio_hash": audio_hash, "use_cache": use_cache},
+                self.socket_path
+            )
+        except ModelServerUnavailable as e:
+            logger.warning(f"{e}; running speaker diarization in-process")
+            return super().identify_speakers(audio_path, audio_hash, use_cache)
+        return [SpeakerSegment(s["speaker_id"], s["start"], s["end"]) for s in result]
+
+    def warm_up(self):
+        call_model_server("ping", {}, self.socket_path, timeout=5)
+
+
+# ---------- サーバー ----------
+
+class _ModelHandler(socketserver.StreamRequestHandler):
+    """1接続1リクエストのハンドラ"""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            result = self.server.dispatch(request.get("method"), request.get("params") or {})
+            response = {"ok": True, "result": result}
+        except Exception as e:
+            logger.exception("model server request failed")
+            response = {"ok": False, "error": str(e)}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class ModelServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """モデルを保持し、Unixソケットで推論リクエストを受け付けるサーバー"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _ModelHandler)
+        os.chmod(socket_path, 0o660)
+        self.extractor = VoiceprintExtractor()
+        self.diarization = SpeakerDiarization()
+        # モデルはスレッドセーフではないため推論はモデルごとに直列化する。
+        # 数分かかる話者識別の間も声紋抽出（ECAPA）は待たせない（pingはどちらも待たない）
+        self.encoder_lock = threading.Lock()
+        self.diarization_lock = threading.Lock()
+        self.started_at = time.time()
+
+    def dispatch(self, method: str, params: Dict[str, Any]) -> Any:
+        if method == "ping":
+            return {"uptime_seconds": round(time.time() - self.started_at, 1)}
+
+        if method == "extract_voiceprints":
+            with self.encoder_lock:
+                try:
+                    vectors = self.extractor.extract_voiceprints(
+                        params["audio_path"],
+                        [tuple(s) for s in params["segments"]],
+                        params.get("audio_hash")
+                    )
+                finally:
+                    self.extractor.clear_waveform_cache(params["audio_path"])
+            return [v.tolist() if v is not None else None for v in vectors]
+
+        if method == "extract_voiceprint":
+            with self.encoder_lock:
+                try:
+                    vector = self.extractor.extract_voiceprint(params["audio_path"], params.get("start_time"), params.get("end_time"))
+                finally:
+                    self.extractor.clear_waveform_cache(params["audio_path"])
+            return vector.tolist()
+
+        if method == "identify_speakers":
+            with self.diarization_lock:
+                segments = self.diarization.identify_speakers(params["audio_path"], params.get("audio_hash"), params.get("use_cache", True))
+            return [{"speaker_id": s.speaker_id, "start": s.start, "end": s.end} for s in segments]
+
+        raise ValueError(f"unknown method: {method}")
+
+    def warm_up(self):
+        """起動時にモデルをロードし、ダミー入力で1回推論しておく"""
+        started = time.time()
+        self.extractor.warm_up()
+        try:
+            self.diarization.warm_up()
+        except Exception as e:
+            logger.warning(f"Speaker diarization warm-up skipped: {e}")
+        logger.info(f"Models warmed up in {time.time() - started:.1f}s")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="音声モデルサーバー（SpeechBrain / pyannote）")
+    parser.add_argument("--socket", default=AUDIO_MODEL_SOCKET or "/tmp/audio_models.sock", help="Unixソケットのパス")
+    parser.add_argument("--no-warmup", action="store_true", help="起動時のモデルロードを行わない")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    server = ModelServer(args.socket)
+    if not args.no_warmup:
+        server.warm_up()
+    logger.info(f"Model server listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+OpenAI Batch API クライアント（期末レポートの一括採点用）
+
+対話的な応答速度が不要な一括処理では、Chat Completionsのリクエストを JSONL に
+まとめて Batch API に送ると、料金が半額になり、通常のレート制限（RPM/TPM）も消費しません。
+結果は最大24時間後に返るので、送信後はステータスをポーリングして待ちます。
+
+    client = OpenAIBatchClient(api_key)
+    batch = client.submit(lines)          # JSONL をアップロードしてバッチを作成
+    batch = client.wait(batch["id"])      # 完了まで待つ
+    results = client.results(batch)       # custom_id → {"content", "error", "usage"}
+
+OPENAI_BASE_URL を変えると、ネットワークの無い環境でも tools/openai_batch_standin.py
+（ローカルのスタンドインサーバー）に対して同じ手順を試せます。
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+import requests
+
+from .rate_limit import get_openai_limiter
+
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
+BATCH_COMPLETION_WINDOW = os.environ.get("BATCH_COMPLETION_WINDOW", "24h")
+BATCH_POLL_INTERVAL = float(os.environ.get("BATCH_POLL_INTERVAL", "60"))
+
+CHAT_COMPLETIONS_ENDPOINT = "/v1/chat/completions"
+# 1バッチあたりの上限（50,000リクエスト・200MB）。サイズは余裕を持たせる
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_BYTES = 190 * 1024 * 1024
+
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# ファイル・バッチ管理のリクエストはモデルの枠とは別に、この名前でリトライ制御する
+_LIMITER_KEY = "openai-batch"
+
+
+class BatchError(Exception):
+    """バッチが完了しなかった（failed / expired / cancelled）、または待ち時間を超えた"""
+    pass
+
+
+def batch_line(custom_id: str, body: Dict, url: str = CHAT_COMPLETIONS_ENDPOINT) -> Dict:
+    """Batch APIの入力ファイルの1行"""
+    return {"custom_id": custom_id, "method": "POST", "url": url, "body": body}
+
+
+def split_batches(
+    lines: List[Dict],
+    max_requests: int = BATCH_MAX_REQUESTS,
+    max_bytes: int = BATCH_MAX_BYTES
+) -> List[List[Dict]]:
+    """1バッチの上限（件数・バイト数）に収まるように入力を分ける"""
+    batches: List[List[Dict]] = []
+    current: List[Dict] = []
+    size = 0
+    for line in lines:
+        line_size = len(json.dumps(line, ensure_ascii=False).encode("utf-8")) + 1
+        if current and (len(current) >= max_requests or size + line_size > max_bytes):
+            batches.append(current)
+            current, size = [], 0
+        current.append(line)
+        size += line_size
+    if current:
+        batches.append(current)
+    return batches
+
+
+def write_jsonl(lines: Iterable[Dict], path: Path) -> Path:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+    return path
+
+
+def parse_results(content: str) -> Dict[str, Dict]:
+    """
+    出力ファイル（またはエラーファイル）を custom_id ごとの結果に変換する
+
+    Returns:
+        custom_id → {"content": 生成テキスト or None, "error": エラー文 or None, "usage": 使用トークン数 or None}
+    """
+    results: Dict[str, Dict] = {}
+    for raw in content.splitlines():
+        if not raw.strip():
+            continue
+        line = json.loads(raw)
+        response = line.get("response") or {}
+        body = response.get("body") or {}
+        error = line.get("error")
+        if error:
+            message = error.get("message") if isinstance(error, dict) else str(error)
+        elif response.get("status_code", 200) != 200:
+            message = f"HTTP {response.get('status_code')}: {(body.get('error') or {}).get('message', '')}"
+        else:
+            message = None
+
+        content_text = None
+        if message is None:
+            content_text = (body.get("choices") or [{}])[0].get("message", {}).get("content")
+            if content_text is None:
+                message = "応答に本文がありません"
+        results[line["custom_id"]] = {
+            "content": content_text,
+            "error": message,
+            "usage": (body.get("usage") or {}).get("total_tokens"),
+        }
+    return results
+
+
+class OpenAIBatchClient:
+    """Files API と Batches API の最小限のクライアント"""
+
+    def __init__(self, api_key: str, base_url: str = OPENAI_BASE_URL, timeout: float = 120):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        def send() -> requests.Response:
+            resp = self.session.request(method, f"{self.base_url}{path}", timeout=self.timeout, **kwargs)
+            resp.raise_for_status()
+            return resp
+
+        # 429・5xx・接続エラーはバックオフしてリトライ
+        return get_openai_limiter().call(_LIMITER_KEY, 0, send)
+
+    def upload(self, path: Path) -> str:
+        """入力ファイルをアップロードし、ファイルIDを返す"""
+        path = Path(path)
+        # リトライで送り直せるよう、ファイルハンドルではなく内容を渡す
+        # （読み切ったハンドルを再送すると空のファイルがアップロードされる）
+        content = path.read_bytes()
+        resp = self._request(
+            "POST", "/files",
+            data={"purpose": "batch"},
+            files={"file": (path.name, content, "application/jsonl")}
+        )
+        return resp.json()["id"]
+
+    def create(self, input_file_id: str, metadata: Optional[Dict[str, str]] = None) -> Dict:
+        """バッチを作成する"""
+        payload = {
+            "input_file_id": input_file_id,
+            "endpoint": CHAT_COMPLETIONS_ENDPOINT,
+            "completion_window": BATCH_COMPLETION_WINDOW,
+        }
+        if metadata:
+            payload["metadata"] = metadata
+        return self._request("POST", "/batches", json=payload).json()
+
+    def submit(self, lines: List[Dict], path: Path, metadata: Optional[Dict[str, str]] = None) -> Dict:
+        """入力を path に書き出し、アップロードしてバッチを作成する"""
+        return self.create(self.upload(write_jsonl(lines, path)), metadata)
+
+    def get(self, batch_id: str) -> Dict:
+        return self._request("GET", f"/batches/{batch_id}").json()
+
+    def cancel(self, batch_id: str) -> Dict:
+        return self._request("POST", f"/batches/{batch_id}/cancel").json()
+
+    def content(self, file_id: str) -> str:
+        resp = self._request("GET", f"/files/{file_id}/content")
+        resp.encoding = "utf-8"
+        return resp.text
+
+    def wait(
+        self,
+        batch_id: str,
+        poll_interval: float = BATCH_POLL_INTERVAL,
+        timeout: Optional[float] = None,
+        on_update: Optional[Callable[[Dict], None]] = None
+    ) -> Dict:
+        """
+        バッチが終了状態（completed / failed / expired / cancelled）になるまで待つ
+
+        Args:
+            batch_id: バッチID
+            poll_interval: ポーリング間隔（秒）
+            timeout: 待つ上限（秒、None は無制限）
+            on_update: ポーリングごとにバッチの情報を受け取る関数（進捗表示用）
+
+        Returns:
+            終了したバッチの情報
+
+        Raises:
+            BatchError: timeout を超えた
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            batch = self.get(batch_id)
+            if on_update:
+                on_update(batch)
+            if batch.get("status") in TERMINAL_STATUSES:
+                return batch
+            if deadline is not None and time.monotonic() + poll_interval > deadline:
+                raise BatchError(f"{batch_id}: {timeout:.0f}秒以内に完了しませんでした（status={batch.get('status')}）")
+            time.sleep(poll_interval)
+
+    def results(self, batch: Dict) -> Dict[str, Dict]:
+        """
+        終了したバッチの出力ファイルとエラーファイルを読み込む
+
+        期限切れ（expired）やキャンセルでも、それまでに完了したリクエストの結果は返ります。
+
+        Raises:
+            BatchError: バッチ自体が失敗した（入力ファイルの検証エラーなど）
+        """
+        if batch.get("status") == "failed":
+            errors = (batch.get("errors") or {}).get("data") or []
+            detail = "; ".join(e.get("message", "") for e in errors) or "unknown error"
+            raise BatchError(f"{batch['id']}: バッチが失敗しました: {detail}")
+
+        results: Dict[str, Dict] = {}
+        for key in ("output_file_id", "error_file_id"):
+            if batch.get(key):
+                results.update(parse_results(self.content(batch[key])))
+        return results
@@ -0,0 +1,126 @@
+"""
+プロンプトテンプレートのレジストリ
+
+prompts/ 以下のテンプレートを1回だけ読み込み、ファイルの更新時刻（mtime）が
+変わったときだけ読み直します。テンプレートは最初の差し込み位置 {{name}} を境に
+「固定の前半（static prefix）」と「差し込みを含む後半」に分けて事前に分解しておき、
+前半はリクエストをまたいでバイト単位で同一になるようにします
+（OpenAIのプロンプトキャッシュは先頭一致で効くため）。
+
+各テンプレートの内容からバージョン（SHA-256の先頭12桁）を計算し、
+レスポンスの prompt_version として返せるようにします。
+"""
+
+import hashlib
+import os
+import pathlib
+import re
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# mtime を確認する間隔（秒）。0 なら毎回確認する
+PROMPT_RELOAD_INTERVAL = float(os.environ.get("PROMPT_RELOAD_INTERVAL", "2"))
+
+_PLACEHOLDER = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+
+class PromptTemplate:
+    """事前に分解したプロンプトテンプレート"""
+
+    def __init__(self, name: str, source: str):
+        self.name = name
+        self.source = source
+        self.version = hashlib.sha256(source.encode("utf-8")).hexdigest()[:12]
+
+        # (固定文字列, 差し込み名) の列に分解。最後の要素の差し込み名は None
+        parts: List[Tuple[str, Optional[str]]] = []
+        position = 0
+        for match in _PLACEHOLDER.finditer(source):
+            parts.append((source[position:match.start()], match.group(1)))
+            position = match.end()
+        parts.append((source[position:], None))
+
+        self.static_prefix = parts[0][0] if len(parts) > 1 else source
+        self._suffix_parts = parts[1:] if len(parts) > 1 else []
+        self._first_field = parts[0][1]
+        self.fields = [field for _, field in parts if field is not None]
+
+    def render(self, **values: str) -> str:
+        """
+        差し込み値を埋めたプロンプトを返す
+
+        Raises:
+            KeyError: 差し込み値が足りない
+        """
+        if self._first_field is None:
+            return self.static_prefix
+        pieces = [self.static_prefix, values[self._first_field]]
+        for literal, field in self._suffix_parts:
+            pieces.append(literal)
+            if field is not None:
+                pieces.append(values[field])
+        return "".join(pieces)
+
+
+class PromptRegistry:
+    """ディレクトリ内のテンプレート（<name>.txt）を保持するレジストリ"""
+
+    def __init__(self, directory: pathlib.Path, reload_interval: float = PROMPT_RELOAD_INTERVAL):
+        self.directory = pathlib.Path(directory)
+        self.reload_interval = reload_interval
+        # name → (テンプレート, mtime_ns, 最後に mtime を確認した時刻)
+        self._templates: Dict[str, Tuple[PromptTemplate, int, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> PromptTemplate:
+        """
+        テンプレートを取得（未ロード、またはファイルが更新されていれば読み直す）
+
+        Raises:
+            FileNotFoundError: テンプレートが存在しない
+        """
+        now = time.monotonic()
+        entry = self._templates.get(name)
+        if entry is not None and now - entry[2] < self.reload_interval:
+            return entry[0]
+
+        path = self.directory / f"{name}.txt"
+        mtime = path.stat().st_mtime_ns
+        with self._lock:
+            entry = self._templates.get(name)
+            if entry is not None and entry[1] == mtime:
+                self._templates[name] = (entry[0], mtime, now)
+                return entry[0]
+            template = PromptTemplate(name, path.read_text(encoding="utf-8"))
+            self._templates[name] = (template, mtime, now)
+            return template
+
+    def render(self, name: str, **values: str) -> str:
+        """テンプレートを取得して差し込み値を埋める"""
+        return self.get(name).render(**values)
+
+    def version(self, names: Iterable[str]) -> str:
+        """複数のテンプレートをまとめたバージョン（順序に依存しない）"""
+        digest = hashlib.sha256()
+        for name in sorted(set(names)):
+            digest.update(f"{name}:{self.get(name).version}\n".encode("utf-8"))
+        return digest.hexdigest()[:12]
+
+
+# シングルトンインスタンス
+_registry_instance: Optional[PromptRegistry] = None
+
+
+def get_prompt_registry() -> PromptRegistry:
+    """
+    PromptRegistryのシングルトンインスタンスを取得（prompts/ ディレクトリ）
+
+    Returns:
+        PromptRegistry instance
+    """
+    global _registry_instance
+    if _registry_instance is None:
+        directory = os.environ.get("PROMPTS_DIR") or pathlib.Path(__file__).resolve().parents[2] / "prompts"
+        _registry_instance = PromptRegistry(directory)
+    return _registry_instance
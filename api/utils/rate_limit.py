@@ -0,0 +1,319 @@
+"""
+OpenAI API呼び出しのレート制御（プロセス内で共有）
+
+採点が集中する時間帯に429（Rate limit）が返ると、コメント生成が定型文の
+フォールバックになってしまいます。すべてのOpenAI呼び出し（コメント、要約、タグ、
+分割、Embedding）をここを通し、モデルごとに次を行います。
+
+- トークンバケット: 1分あたりのリクエスト数（RPM）とトークン数（TPM）を事前に予約し、
+  超える分は送信前に待つ（複数ワーカーでは上限を WEB_CONCURRENCY で割って使う）
+- Retry-After: 429 で返された待ち時間の間は、そのモデルへの送信を全体で止める
+- AIMD: 同時リクエスト数の上限を、成功で少しずつ増やし、429 で半分にする
+- リトライ: 429・5xx・タイムアウト・接続エラーは指数バックオフ＋ジッターで再試行する
+"""
+
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple, TypeVar
+
+from .metrics import record_tokens
+
+OPENAI_RPM = int(os.environ.get("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.environ.get("OPENAI_TPM", "200000"))
+# モデルごとの上書き（例: "gpt-4o=500:30000,text-embedding-3-small=3000:1000000"）
+OPENAI_RATE_LIMITS = os.environ.get("OPENAI_RATE_LIMITS", "")
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "4"))
+# 1回の呼び出しでリトライ・待機に使う時間の上限（秒）
+OPENAI_RETRY_BUDGET = float(os.environ.get("OPENAI_RETRY_BUDGET", "60"))
+OPENAI_INITIAL_CONCURRENCY = int(os.environ.get("OPENAI_INITIAL_CONCURRENCY", "8"))
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "32"))
+
+_BACKOFF_BASE = 0.5
+_BACKOFF_CAP = 20.0
+# 429 が続けて返っても、同時実行数を半分にするのはこの間隔に1回まで（秒）
+_DECREASE_COOLDOWN = 2.0
+
+T = TypeVar("T")
+
+
+class RateLimitTimeout(Exception):
+    """待ち時間が OPENAI_RETRY_BUDGET を超える"""
+    pass
+
+
+def _worker_share() -> int:
+    try:
+        return max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+    except ValueError:
+        return 1
+
+
+def _parse_limits(spec: str) -> Dict[str, Tuple[int, int]]:
+    limits = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        model, values = item.split("=", 1)
+        rpm, _, tpm = values.partition(":")
+        limits[model.strip()] = (int(rpm), int(tpm or OPENAI_TPM))
+    return limits
+
+
+class TokenBucket:
+    """1分あたり rate_per_minute のトークンバケット（予約型、スレッドセーフ）"""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """
+        amount を予約し、送信までに待つべき秒数を返す
+
+        残量が足りない場合も予約自体は行い（残量が負になる）、後続の呼び出しは
+        その分だけ長く待つので、到着順に公平に送信されます。
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            self.level -= min(amount, self.capacity)
+            return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount: float):
+        """予約しすぎた分（実際の使用トークンとの差・送信しなかった予約）を戻す"""
+        if amount <= 0 or self.rate <= 0:
+            return
+        with self.lock:
+            # reserve() が差し引いたのは capacity までなので、戻すのもそこまで
+            self.level = min(self.capacity, self.level + min(amount, self.capacity))
+
+
+class AdaptiveConcurrency:
+    """AIMDで上限を調整するセマフォ"""
+
+    def __init__(self, initial: int = OPENAI_INITIAL_CONCURRENCY, maximum: int = OPENAI_MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self, outcome: str):
+        """outcome: "ok"（加算増加）/ "throttled"（乗算減少）/ "error"（変更なし）"""
+        with self.condition:
+            self.in_flight -= 1
+            if outcome == "ok":
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            elif outcome == "throttled":
+                now = time.monotonic()
+                if now - self.last_decrease >= _DECREASE_COOLDOWN:
+                    self.limit = max(1.0, self.limit / 2.0)
+                    self.last_decrease = now
+            self.condition.notify_all()
+
+
+class _ModelLimits:
+    def __init__(self, rpm: int, tpm: int):
+        share = _worker_share()
+        self.requests = TokenBucket(rpm / share)
+        self.tokens = TokenBucket(tpm / share)
+        self.concurrency = AdaptiveConcurrency()
+        self.blocked_until = 0.0
+        self.throttled = 0
+        self.retries = 0
+
+
+def _response_of(error: Exception):
+    return getattr(error, "response", None)
+
+
+def _status_of(error: Exception) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(_response_of(error), "status_code", None)
+    return status
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """例外に付いたレスポンスの Retry-After（秒）"""
+    headers = getattr(_response_of(error), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    """429・5xx・タイムアウト・接続エラーか（requests / openai SDK の両方）"""
+    status = _status_of(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    name = type(error).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+def sdk_usage_tokens(response) -> Optional[int]:
+    """openai SDK のレスポンスから実際の使用トークン数を取り出す"""
+    return getattr(getattr(response, "usage", None), "total_tokens", None)
+
+
+class OpenAIRateLimiter:
+    """モデルごとのトークンバケット・同時実行数・Retry-After を管理する"""
+
+    def __init__(self):
+        self._models: Dict[str, _ModelLimits] = {}
+        self._overrides = _parse_limits(OPENAI_RATE_LIMITS)
+        self._lock = threading.Lock()
+
+    def limits(self, model: str) -> _ModelLimits:
+        with self._lock:
+            if model not in self._models:
+                rpm, tpm = self._overrides.get(model, (OPENAI_RPM, OPENAI_TPM))
+                self._models[model] = _ModelLimits(rpm, tpm)
+            return self._models[model]
+
+    def configure(self, model: str, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        """モデルの上限を変更する（バッチスクリプトなどから）"""
+        current_rpm, current_tpm = self._overrides.get(model, (OPENAI_RPM, OPENAI_TPM))
+        with self._lock:
+            self._overrides[model] = (rpm or current_rpm, tpm or current_tpm)
+            self._models.pop(model, None)
+
+    def call(
+        self,
+        model: str,
+        tokens: int,
+        send: Callable[[], T],
+        used_tokens: Optional[Callable[[T], Optional[int]]] = None,
+        cancelled: Optional[Callable[[], bool]] = None
+    ) -> T:
+        """
+        レート制御とリトライ付きで send() を呼ぶ
+
+        Args:
+            model: モデル名
+            tokens: 予約するトークン数（入力 + 最大出力の見積もり）
+            send: リクエストを送る関数（失敗時は例外を送出）
+            used_tokens: 結果から実際の使用トークン数を取り出す関数（予約の差分を戻す）
+            cancelled: True を返したらリトライをやめる関数（ヘッジで打ち切られた場合など）
+
+        Returns:
+            send() の結果
+
+        Raises:
+            RateLimitTimeout: 送信待ちが OPENAI_RETRY_BUDGET を超える
+            Exception: リトライできない失敗、またはリトライ回数を使い切った失敗
+        """
+        limits = self.limits(model)
+        deadline = time.monotonic() + OPENAI_RETRY_BUDGET
+        attempt = 0
+
+        while True:
+            wait = max(
+                limits.blocked_until - time.monotonic(),
+                limits.requests.reserve(1),
+                limits.tokens.reserve(tokens)
+            )
+            if time.monotonic() + wait > deadline:
+                limits.requests.refund(1)
+                limits.tokens.refund(tokens)
+                raise RateLimitTimeout(f"{model}: rate limit wait {wait:.1f}s exceeds budget")
+            if wait > 0:
+                time.sleep(wait)
+            if not limits.concurrency.acquire(max(0.0, deadline - time.monotonic())):
+                limits.requests.refund(1)
+                limits.tokens.refund(tokens)
+                raise RateLimitTimeout(f"{model}: no concurrency slot within budget")
+
+            try:
+                result = send()
+            except Exception as e:
+                throttled = _status_of(e) == 429
+                limits.concurrency.release("throttled" if throttled else "error")
+                # 失敗したリクエストの予約は戻す（リトライでは改めて予約する）。
+                # 429 はOpenAI側でもリクエスト数に数えられないので、リクエスト枠も戻す
+                limits.tokens.refund(tokens)
+                if throttled:
+                    limits.requests.refund(1)
+                if throttled:
+                    limits.throttled += 1
+                    retry_after = retry_after_seconds(e)
+                    if retry_after:
+                        # 他のスレッドもこのモデルへの送信を止める
+                        limits.blocked_until = max(limits.blocked_until, time.monotonic() + retry_after)
+
+                attempt += 1
+                if not is_retryable(e) or attempt > OPENAI_MAX_RETRIES or (cancelled and cancelled()):
+                    raise
+                backoff = random.uniform(0, min(_BACKOFF_CAP, _BACKOFF_BASE * 2 ** attempt))
+                delay = max(backoff, limits.blocked_until - time.monotonic())
+                if time.monotonic() + delay > deadline:
+                    raise
+                limits.retries += 1
+                print(f"[INFO] {model}: retry {attempt}/{OPENAI_MAX_RETRIES} in {delay:.1f}s ({type(e).__name__})")
+                time.sleep(delay)
+                continue
+
+            limits.concurrency.release("ok")
+            if used_tokens is not None:
+                actual = used_tokens(result)
+                if actual:
+                    limits.tokens.refund(tokens - actual)
+                    record_tokens(model, actual)
+            return result
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """モデルごとの状態（デバッグ・メトリクス用）"""
+        with self._lock:
+            items = list(self._models.items())
+        return {
+            model: {
+                "concurrency_limit": round(limits.concurrency.limit, 2),
+                "in_flight": limits.concurrency.in_flight,
+                "throttled": limits.throttled,
+                "retries": limits.retries,
+            }
+            for model, limits in items
+        }
+
+
+# シングルトンインスタンス
+_limiter_instance: Optional[OpenAIRateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_openai_limiter() -> OpenAIRateLimiter:
+    """
+    OpenAIRateLimiterのシングルトンインスタンスを取得
+
+    Returns:
+        OpenAIRateLimiter instance
+    """
+    global _limiter_instance
+    with _limiter_lock:
+        if _limiter_instance is None:
+            _limiter_instance = OpenAIRateLimiter()
+    return _limiter_instance
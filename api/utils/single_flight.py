@@ -0,0 +1,363 @@
+"""
+同じ内容の生成リクエストの重複実行を防ぐ（single-flight）
+
+教授が「生成」を2回押した場合や、2人のTAが同じレポートを同時に採点した場合に、
+/generate_direct のパイプライン（参照例の検索、Embedding、コメント生成、要約）が
+二重に走らないよう、同じキーの計算は1つだけ実行して全員に同じ結果を返します。
+
+- 同じワーカー内: 実行中の計算（asyncio.Future）をそのまま待つ
+- ワーカー間: SQLite の行をリース（期限付きのロック）として使う。最初に行を取った
+  ワーカーが計算し、他のワーカーは結果が書き込まれるまでポーリングで待つ。
+  計算中のワーカーはリースを延長し続けるので、ワーカーが落ちた場合は
+  期限切れ後に待っていた側が計算を引き継ぐ
+- 完了した結果は SINGLE_FLIGHT_RESULT_TTL 秒だけ残し、直後の再送信（ダブルクリック）にも返す
+
+結果にはレポート由来の本文（マスク済みテキスト、検出したPII、コメント、要約）が含まれるため、
+SQLite には平文で書きません。行のキーは flight_key のハッシュ、結果は flight_key から導いた鍵
+（ENCRYPTION_KEY があればそれも混ぜる）で AES-256-GCM 暗号化して保存するので、同じリクエストの
+内容を知らなければ復号できません。期限を過ぎた行は削除し、削除した領域もゼロで上書きします。
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from .metrics import record_cache
+
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "1") in ("1", "true", "TRUE", "on")
+# SINGLE_FLIGHT_PATH を空にするとワーカー間の重複排除を無効化（ワーカー内のみ）
+SINGLE_FLIGHT_PATH = os.getenv(
+    "SINGLE_FLIGHT_PATH",
+    str(Path(__file__).resolve().parents[2] / "data" / "cache" / "single_flight.sqlite3")
+)
+# リースの有効期限（秒）。計算中は期限の1/3ごとに延長する
+SINGLE_FLIGHT_LEASE = float(os.environ.get("SINGLE_FLIGHT_LEASE", "30"))
+# 完了した結果を共有する期間（秒）
+SINGLE_FLIGHT_RESULT_TTL = float(os.environ.get("SINGLE_FLIGHT_RESULT_TTL", "30"))
+# 他のワーカーの計算を待つ上限（秒）。超えたら自分で計算する
+SINGLE_FLIGHT_MAX_WAIT = float(os.environ.get("SINGLE_FLIGHT_MAX_WAIT", "300"))
+
+_POLL_INTERVAL = 0.2
+
+
+_SERVER_SECRET = os.environ.get("ENCRYPTION_KEY", "")
+
+
+def flight_key(*parts: str) -> str:
+    """キーの構成要素（エンドポイント、本文、プロンプトのバージョンなど）からキーを作る"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class SingleFlight:
+    """同じキーの非同期計算を1回にまとめる（ワーカー内 + SQLiteのリースでワーカー間）"""
+
+    def __init__(
+        self,
+        path: Optional[str],
+        lease_seconds: float = SINGLE_FLIGHT_LEASE,
+        result_ttl: float = SINGLE_FLIGHT_RESULT_TTL,
+        max_wait: float = SINGLE_FLIGHT_MAX_WAIT
+    ):
+        self.lease_seconds = lease_seconds
+        self.result_ttl = result_ttl
+        self.max_wait = max_wait
+        self.owner = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # 期限切れ後に結果を削除するタスク（完了まで参照を保持する）
+        self._expiry_tasks: Set[asyncio.Task] = set()
+
+        # 統計（計算した数 / 結果を共有した数）
+        self.computed = 0
+        self.shared = 0
+
+        self.conn: Optional[sqlite3.Connection] = None
+        if path:
+            try:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                # 削除した行（暗号化済みの結果）の領域をゼロで上書きする
+                self.conn.execute("PRAGMA secure_delete=ON")
+                self.conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS flights (
+                        key TEXT PRIMARY KEY,
+                        owner TEXT NOT NULL,
+                        lease_until REAL NOT NULL,
+                        result TEXT,
+                        finished_at REAL
+                    )
+                    """
+                )
+                # 前回の起動で残った期限切れの行を消す
+                self._purge_expired(time.time())
+                self.conn.commit()
+            except Exception as e:
+                print(f"⚠️ single-flight のリースDBを開けません（ワーカー内のみ重複排除）: {e}")
+                self.conn = None
+
+    async def run(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Any]],
+        keep: Optional[Callable[[Any], bool]] = None
+    ) -> Tuple[Any, bool]:
+        """
+        key の計算を1回だけ実行し、同時に来た呼び出しには同じ結果を返す
+
+        Args:
+            key: 計算内容を表すキー（flight_key で作る）
+            compute: 計算を行うコルーチン関数（結果はJSONに変換できること）
+            keep: 結果を完了後も SINGLE_FLIGHT_RESULT_TTL 秒残すかを決める関数
+                  （失敗した結果を再送信に返さないため。実行中に待っていた呼び出しには常に返す）
+
+        Returns:
+            (結果, 他の呼び出しの結果を共有したか)
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # イベントループが変わった場合（テストなど）は状態を作り直す
+            self._loop = loop
+            self._inflight = {}
+            self._expiry_tasks = set()
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.shared += 1
+            record_cache("single_flight", hits=1)
+            return await asyncio.shield(future), True
+
+        future = loop.create_future()
+        # 待っている呼び出しが無くても例外が「未取得」の警告にならないようにする
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        try:
+            result, shared = await self._run_across_workers(key, compute, keep)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            self._inflight.pop(key, None)
+
+        if shared:
+            self.shared += 1
+        else:
+            self.computed += 1
+        record_cache("single_flight", hits=1 if shared else 0, misses=0 if shared else 1)
+        return result, shared
+
+    async def _run_across_workers(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Any]],
+        keep: Optional[Callable[[Any], bool]]
+    ) -> Tuple[Any, bool]:
+        if self.conn is None:
+            return await compute(), False
+
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            try:
+                state, result = await asyncio.to_thread(self._acquire, key)
+            except sqlite3.Error as e:
+                print(f"⚠️ single-flight のリースを取得できません（重複排除せずに生成）: {e}")
+                return await compute(), False
+            if state == "done":
+                return result, True
+            if state == "leader":
+                break
+            if time.monotonic() > deadline:
+                print("⚠️ 他のワーカーの生成を待ちきれないため、自分で生成します")
+                return await compute(), False
+            await asyncio.sleep(_POLL_INTERVAL)
+
+        heartbeat = asyncio.create_task(self._heartbeat(key))
+        try:
+            result = await compute()
+        except BaseException:
+            heartbeat.cancel()
+            # 待っている側が引き継げるように、すぐにリースを手放す
+            try:
+                await asyncio.to_thread(self._release, key)
+            except sqlite3.Error:
+                pass
+            raise
+        heartbeat.cancel()
+        try:
+            if keep is None or keep(result):
+                await asyncio.to_thread(self._complete, key, result)
+                task = asyncio.create_task(self._expire_later(key))
+                self._expiry_tasks.add(task)
+                task.add_done_callback(self._expiry_tasks.discard)
+            else:
+                await asyncio.to_thread(self._release, key)
+        except sqlite3.Error as e:
+            print(f"⚠️ single-flight の結果を保存できません: {e}")
+        return result, False
+
+    async def _heartbeat(self, key: str):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await asyncio.to_thread(self._renew, key)
+            except sqlite3.Error as e:
+                print(f"⚠️ single-flight のリースを延長できません: {e}")
+
+    async def _expire_later(self, key: str):
+        """SINGLE_FLIGHT_RESULT_TTL 後に結果の行を削除する（次の _acquire を待たない）"""
+        await asyncio.sleep(self.result_ttl)
+        try:
+            await asyncio.to_thread(self._expire, key)
+        except sqlite3.Error as e:
+            print(f"⚠️ single-flight の期限切れの結果を削除できません: {e}")
+
+    # ---------- 暗号化 ----------
+
+    @staticmethod
+    def _row_id(key: str) -> str:
+        """SQLiteの行のキー（復号に使う flight_key そのものは保存しない）"""
+        return hashlib.sha256(b"single-flight-row\0" + key.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _cipher(key: str) -> AESGCM:
+        secret = hashlib.sha256(b"single-flight-result\0" + key.encode("utf-8") + b"\0" + _SERVER_SECRET.encode("utf-8"))
+        return AESGCM(secret.digest())
+
+    def _encrypt(self, key: str, payload: str) -> str:
+        nonce = os.urandom(12)
+        return base64.b64encode(nonce + self._cipher(key).encrypt(nonce, payload.encode("utf-8"), None)).decode("ascii")
+
+    def _decrypt(self, key: str, token: str) -> str:
+        data = base64.b64decode(token)
+        return self._cipher(key).decrypt(data[:12], data[12:], None).decode("utf-8")
+
+    # ---------- SQLite（スレッドから呼ぶ） ----------
+
+    def _purge_expired(self, now: float):
+        """期限切れの行を削除する（トランザクション内で呼ぶ）"""
+        self.conn.execute(
+            "DELETE FROM flights WHERE (finished_at IS NOT NULL AND finished_at <= ?) OR (finished_at IS NULL AND lease_until <= ?)",
+            (now - self.result_ttl, now)
+        )
+
+    def _acquire(self, key: str) -> Tuple[str, Any]:
+        """
+        リースを取る
+
+        Returns:
+            ("done", 結果) / ("waiting", None) / ("leader", None)
+        """
+        now = time.time()
+        row_id = self._row_id(key)
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                row = self.conn.execute(
+                    "SELECT owner, lease_until, result, finished_at FROM flights WHERE key = ?",
+                    (row_id,)
+                ).fetchone()
+                if row is not None:
+                    owner, lease_until, result, finished_at = row
+                    if finished_at is not None and finished_at > now - self.result_ttl:
+                        try:
+                            shared = json.loads(self._decrypt(key, result))
+                        except Exception as e:
+                            # ワーカー間で ENCRYPTION_KEY が異なるなど。共有せずに自分で計算し直す
+                            print(f"⚠️ single-flight の結果を復号できません（再生成します）: {e.__class__.__name__}")
+                        else:
+                            self.conn.rollback()
+                            return "done", shared
+                    elif finished_at is None and lease_until > now:
+                        self.conn.rollback()
+                        return "waiting", None
+
+                # 期限切れの行を掃除してから、自分の行として登録する
+                self._purge_expired(now)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO flights (key, owner, lease_until, result, finished_at) VALUES (?, ?, ?, NULL, NULL)",
+                    (row_id, self.owner, now + self.lease_seconds)
+                )
+                self.conn.commit()
+                return "leader", None
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def _renew(self, key: str):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE flights SET lease_until = ? WHERE key = ? AND owner = ? AND finished_at IS NULL",
+                (time.time() + self.lease_seconds, self._row_id(key), self.owner)
+            )
+            self.conn.commit()
+
+    def _complete(self, key: str, result: Any):
+        try:
+            payload = self._encrypt(key, json.dumps(result, ensure_ascii=False))
+        except (TypeError, ValueError) as e:
+            print(f"⚠️ 生成結果をJSONに変換できないため共有しません: {e}")
+            self._release(key)
+            return
+        with self.lock:
+            self.conn.execute(
+                "UPDATE flights SET result = ?, finished_at = ? WHERE key = ? AND owner = ?",
+                (payload, time.time(), self._row_id(key), self.owner)
+            )
+            self.conn.commit()
+
+    def _release(self, key: str):
+        row_id = self._row_id(key)
+        with self.lock:
+            self.conn.execute("UPDATE flights SET result = NULL WHERE key = ? AND owner = ?", (row_id, self.owner))
+            self.conn.execute("DELETE FROM flights WHERE key = ? AND owner = ?", (row_id, self.owner))
+            self.conn.commit()
+
+    def _expire(self, key: str):
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM flights WHERE key = ? AND owner = ? AND finished_at IS NOT NULL AND finished_at <= ?",
+                (self._row_id(key), self.owner, time.time() - self.result_ttl)
+            )
+            self.conn.commit()
+
+    def snapshot(self) -> Dict[str, int]:
+        """統計（デバッグ・メトリクス用）"""
+        return {"computed": self.computed, "shared": self.shared, "in_flight": len(self._inflight)}
+
+
+# シングルトンインスタンス
+_single_flight_instance: Optional[SingleFlight] = None
+
+
+def get_single_flight() -> SingleFlight:
+    """
+    SingleFlightのシングルトンインスタンスを取得
+
+    Returns:
+        SingleFlight instance
+    """
+    global _single_flight_instance
+    if _single_flight_instance is None:
+        _single_flight_instance = SingleFlight(SINGLE_FLIGHT_PATH or None)
+    return _single_flight_instance
@@ -6,23 +6,43 @@ pyannote.audioを使用して音声から話者を識別し、
 """
 
 import os
+import sys
 import logging
 from typing import List, Dict, Any, Optional, Tuple
 import numpy as np
 from pathlib import Path
 
+from .audio_cache import file_sha256, get_audio_cache
+from .vad import AUDIO_VAD_ENABLED, OffsetMap, vad_params_id
+
 logger = logging.getLogger(__name__)
 
+DIARIZATION_MODEL_ID = "pyannote/speaker-diarization-3.1"
+
+
+def vad_model_id(params_id: str) -> str:
+    """無音除去後の音声で識別した結果のキャッシュ用モデルID"""
+    return f"{DIARIZATION_MODEL_ID}#{params_id}"
+
 
 class SpeakerSegment:
-    """話者セグメント（発言の時間帯）"""
+    """話者セグメント（発言の時間帯）
+
+    長時間の録音では数千件になるため、__slots__ でインスタンスごとの __dict__ を持たせず、
+    話者IDは intern して同じ話者のセグメント間で文字列を共有します。
+    """
+
+    __slots__ = ("speaker_id", "start", "end", "text")
 
     def __init__(self, speaker_id: str, start: float, end: float, text: Optional[str] = None):
-        self.speaker_id = speaker_id  # 例: "SPEAKER_00"
+        self.speaker_id = sys.intern(speaker_id)  # 例: "SPEAKER_00"
         self.start = start  # 開始時刻（秒）
         self.end = end  # 終了時刻（秒）
         self.text = text  # テキスト（Whisperの結果とマッチング後）
-        self.duration = end - start
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
 
     def __repr__(self):
         return f"SpeakerSegment({self.speaker_id}, {self.start:.1f}s-{self.end:.1f}s, {self.duration:.1f}s)"
@@ -37,6 +57,59 @@ class SpeakerSegment:
         }
 
 
+class SegmentTable:
+    """話者セグメントの列指向表現
+
+    開始・終了時刻をNumPy配列、話者を整数コードで持ち、話者 → 行番号の索引を
+    1回だけ作ります。話者ごとの発言時間・セグメント数は bincount の1パスで求まります。
+    """
+
+    __slots__ = ("starts", "ends", "codes", "speakers", "speaker_index", "_order", "_bounds")
+
+    def __init__(self, segments: List[SpeakerSegment]):
+        count = len(segments)
+        self.starts = np.fromiter((s.start for s in segments), dtype=np.float64, count=count)
+        self.ends = np.fromiter((s.end for s in segments), dtype=np.float64, count=count)
+        self.speakers: List[str] = []  # 初出順
+        self.speaker_index: Dict[str, int] = {}
+
+        codes = np.empty(count, dtype=np.int32)
+        for row, segment in enumerate(segments):
+            code = self.speaker_index.get(segment.speaker_id)
+            if code is None:
+                code = len(self.speakers)
+                self.speaker_index[segment.speaker_id] = code
+                self.speakers.append(segment.speaker_id)
+            codes[row] = code
+        self.codes = codes
+
+        # 話者コードで安定ソートした行番号と、各話者の範囲
+        self._order = np.argsort(codes, kind="stable")
+        self._bounds = np.searchsorted(codes[self._order], np.arange(len(self.speakers) + 1))
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def durations(self) -> np.ndarray:
+        return self.ends - self.starts
+
+    def speaker_durations(self) -> np.ndarray:
+        """話者コードごとの合計発言時間（秒）"""
+        return np.bincount(self.codes, weights=self.durations, minlength=len(self.speakers))
+
+    def speaker_counts(self) -> np.ndarray:
+        """話者コードごとのセグメント数"""
+        return np.bincount(self.codes, minlength=len(self.speakers))
+
+    def rows_for(self, speaker_id: str) -> np.ndarray:
+        """話者のセグメントの行番号（元の順序）"""
+        code = self.speaker_index.get(speaker_id)
+        if code is None:
+            return np.zeros(0, dtype=np.int64)
+        return self._order[self._bounds[code]:self._bounds[code + 1]]
+
+
 class SpeakerDiarization:
     """話者識別クラス"""
 
@@ -62,7 +135,7 @@ class SpeakerDiarization:
             from pyannote.audio import Pipeline
 
             self.pipeline = Pipeline.from_pretrained(
-                "pyannote/speaker-diarization-3.1",
+                DIARIZATION_MODEL_ID,
                 use_auth_token=self.hf_token
             )
 
@@ -71,16 +144,81 @@ class SpeakerDiarization:
             logger.error(f"Failed to load pyannote.audio pipeline: {e}")
             raise
 
-    def identify_speakers(self, audio_path: str) -> List[SpeakerSegment]:
+    def warm_up(self):
+        """パイプラインをロードし、ダミー音声で1回推論しておく（初回リクエストの待ち時間をなくす）"""
+        self._load_pipeline()
+
+        import torch
+
+        self.pipeline({"waveform": torch.randn(1, 16000 * 5) * 0.01, "sample_rate": 16000})
+        logger.info("SpeakerDiarization warmed up")
+
+    def cached_segments(self, audio_hash: str, vad_params_id: Optional[str] = None) -> Optional[List[SpeakerSegment]]:
+        """
+        キャッシュ済みの話者識別結果を取得
+
+        元の音声での結果（/audio/identify-speakers と教授音声抽出で共有）を優先し、
+        無ければ vad_params_id の設定で無音を詰めた音声での結果（元の時刻に戻したもの）を探します。
+
+        Args:
+            audio_hash: 元の音声ファイルのsha256
+            vad_params_id: vad_params_id() の値（Noneなら無音除去後の結果は探さない）
+
+        Returns:
+            SpeakerSegmentのリスト（キャッシュに無い、またはキャッシュ無効ならNone）
+        """
+        cache = get_audio_cache()
+        if cache is None:
+            return None
+        model_ids = [DIARIZATION_MODEL_ID]
+        if vad_params_id:
+            model_ids.append(vad_model_id(vad_params_id))
+        for model_id in model_ids:
+            try:
+                cached = cache.get_diarization(audio_hash, model_id)
+            except Exception as e:
+                logger.warning(f"Diarization cache lookup failed: {e}")
+                return None
+            if cached is not None:
+                logger.info(f"Speaker diarization served from cache ({len(cached)} segments, {model_id})")
+                return [SpeakerSegment(s["speaker_id"], s["start"], s["end"]) for s in cached]
+        return None
+
+    def _store_segments(self, audio_hash: str, model_id: str, segments: List[SpeakerSegment]):
+        cache = get_audio_cache()
+        if cache is None:
+            return
+        try:
+            cache.put_diarization(
+                audio_hash,
+                model_id,
+                [{"speaker_id": s.speaker_id, "start": s.start, "end": s.end} for s in segments]
+            )
+        except Exception as e:
+            logger.warning(f"Failed to store diarization in cache: {e}")
+
+    def identify_speakers(self, audio_path: str, audio_hash: Optional[str] = None, use_cache: bool = True) -> List[SpeakerSegment]:
         """
         音声ファイルから話者を識別
 
+        音声解析キャッシュが有効な場合、同じ内容の音声（sha256が一致）は
+        パイプラインを実行せずに前回の結果を返します。
+
         Args:
             audio_path: 音声ファイルのパス
+            audio_hash: 音声ファイルのsha256（計算済みの場合）。Noneならここで計算
+            use_cache: Falseならキャッシュを引かず、結果も保存しない（無音を詰めた一時ファイル用）
 
         Returns:
             SpeakerSegmentのリスト
         """
+        use_cache = use_cache and get_audio_cache() is not None
+        if use_cache:
+            audio_hash = audio_hash or file_sha256(audio_path)
+            cached = self.cached_segments(audio_hash, vad_params_id() if AUDIO_VAD_ENABLED else None)
+            if cached is not None:
+                return cached
+
         self._load_pipeline()
 
         try:
@@ -101,12 +239,60 @@ class SpeakerDiarization:
 
             logger.info(f"Identified {len(segments)} speaker segments from {len(set(s.speaker_id for s in segments))} speakers")
 
+            if use_cache:
+                self._store_segments(audio_hash, DIARIZATION_MODEL_ID, segments)
+
             return segments
 
         except Exception as e:
             logger.error(f"Failed to identify speakers: {e}")
             raise
 
+    def identify_speakers_compacted(
+        self,
+        compact_path: str,
+        audio_hash: str,
+        offset_map: OffsetMap,
+        params_id: str
+    ) -> List[SpeakerSegment]:
+        """
+        無音を詰めた音声で話者を識別し、元の音声の時刻に戻す
+
+        詰めた継ぎ目をまたぐセグメントは分割します。結果は元の音声のハッシュと
+        VADの設定をキーにキャッシュするので、同じ録音の再実行や /audio/identify-speakers と共有できます。
+
+        Args:
+            compact_path: 無音を詰めた音声ファイル
+            audio_hash: 元の音声ファイルのsha256
+            offset_map: compact_path の時刻 → 元の時刻の対応表
+            params_id: vad_params_id() の値
+
+        Returns:
+            元の時刻のSpeakerSegmentのリスト
+        """
+        compact_segments = self.identify_speakers(compact_path, use_cache=False)
+        segments = [
+            SpeakerSegment(s.speaker_id, start, end)
+            for s in compact_segments for start, end in offset_map.split_range(s.start, s.end)
+        ]
+        self._store_segments(audio_hash, vad_model_id(params_id), segments)
+        return segments
+
+    def segment_table(self, segments: List[SpeakerSegment]) -> SegmentTable:
+        """
+        セグメントリストの SegmentTable を作成
+
+        呼び出しごとに作り直します（bincount と argsort だけなので安価）。シングルトンに
+        リストと対応づけて保持すると、リストがその場で書き換えられた場合に古い索引を返すためです。
+
+        Args:
+            segments: SpeakerSegmentのリスト
+
+        Returns:
+            SegmentTable
+        """
+        return SegmentTable(segments)
+
     def get_speaker_durations(self, segments: List[SpeakerSegment]) -> Dict[str, float]:
         """
         各話者の発言時間を計算
@@ -117,11 +303,8 @@ class SpeakerDiarization:
         Returns:
             {speaker_id: total_duration_seconds}
         """
-        durations = {}
-        for segment in segments:
-            durations[segment.speaker_id] = durations.get(segment.speaker_id, 0) + segment.duration
-
-        return durations
+        table = self.segment_table(segments)
+        return dict(zip(table.speakers, table.speaker_durations().tolist()))
 
     def identify_longest_speaker(self, segments: List[SpeakerSegment]) -> str:
         """
@@ -159,57 +342,133 @@ class SpeakerDiarization:
         Returns:
             フィルタリングされたセグメントのリスト
         """
-        filtered = [s for s in segments if s.speaker_id == speaker_id]
+        filtered = [segments[row] for row in self.segment_table(segments).rows_for(speaker_id).tolist()]
         logger.info(f"Filtered {len(filtered)} segments for speaker {speaker_id}")
         return filtered
 
+    def rows_by_speaker(self, segments: List[SpeakerSegment]) -> Dict[str, List[SpeakerSegment]]:
+        """
+        全話者のセグメントを1パスでグループ化
+
+        話者ごとに filter_segments_by_speaker を呼ぶと SegmentTable を毎回作り直すため、
+        複数の話者を扱う場合はこちらを使います。
+
+        Args:
+            segments: SpeakerSegmentのリスト
+
+        Returns:
+            {speaker_id: その話者のセグメントのリスト（元の順序）}（初出順）
+        """
+        table = self.segment_table(segments)
+        return {
+            speaker_id: [segments[row] for row in table.rows_for(speaker_id).tolist()]
+            for speaker_id in table.speakers
+        }
+
     def match_segments_with_transcript(
         self,
         segments: List[SpeakerSegment],
-        whisper_segments: List[Dict[str, Any]]
+        whisper_segments: List[Dict[str, Any]],
+        split_straddling: bool = False,
+        min_split_ratio: float = 0.2
     ) -> List[SpeakerSegment]:
         """
         話者セグメントとWhisperの文字起こしセグメントをマッチング
 
+        両方を開始時刻でソートし、2ポインタのスイープで重なり得る話者セグメント
+        （アクティブ集合）だけを比較するため、計算量は O((W + S) log(W + S)) です。
+        各話者セグメントのテキストはリストに溜めて最後に1回だけ結合します。
+
         Args:
             segments: SpeakerSegmentのリスト
             whisper_segments: Whisperの文字起こし結果（タイムスタンプ付き）
                 例: [{"start": 0.0, "end": 3.5, "text": "こんにちは"}, ...]
+                "words"（[{"word", "start", "end"}, ...]）があれば話者交代の分割に使う
+            split_straddling: Trueの場合、話者交代をまたぐWhisperセグメントを分割して
+                各話者に割り当てる（単語タイムスタンプがあれば単語単位、
+                無ければ重なり時間の比率で文字数を按分）。Falseの場合は最も重なる話者に全文を割り当てる
+            min_split_ratio: 分割対象とする重なりの最小割合（Whisperセグメントの重なり合計に対する比）
 
         Returns:
             テキストが付与されたSpeakerSegmentのリスト
         """
-        # 各Whisperセグメントに対して、最も重複する話者セグメントを見つける
-        for whisper_seg in whisper_segments:
+        order = sorted(range(len(segments)), key=lambda i: segments[i].start)
+        texts: List[List[str]] = [[] for _ in segments]
+        active: List[int] = []
+        next_pos = 0
+
+        for whisper_seg in sorted(whisper_segments, key=lambda w: w["start"]):
             w_start = whisper_seg["start"]
             w_end = whisper_seg["end"]
-            w_text = whisper_seg["text"]
 
-            # 重複する話者セグメントを探す
-            best_segment = None
-            best_overlap = 0
+            # Whisperセグメントの終了より前に始まる話者セグメントをアクティブに追加
+            while next_pos < len(order) and segments[order[next_pos]].start < w_end:
+                active.append(order[next_pos])
+                next_pos += 1
 
-            for speaker_seg in segments:
-                # 重複時間を計算
-                overlap_start = max(w_start, speaker_seg.start)
-                overlap_end = min(w_end, speaker_seg.end)
-                overlap = max(0, overlap_end - overlap_start)
+            # 既に終わった話者セグメントを除外（Whisperは開始順なので以後も重ならない）
+            active = [i for i in active if segments[i].end > w_start]
 
-                if overlap > best_overlap:
-                    best_overlap = overlap
-                    best_segment = speaker_seg
+            overlaps = []
+            for i in active:
+                overlap = min(w_end, segments[i].end) - max(w_start, segments[i].start)
+                if overlap > 0:
+                    overlaps.append((overlap, i))
 
-            # 最も重複するセグメントにテキストを追加
-            if best_segment is not None:
-                if best_segment.text is None:
-                    best_segment.text = w_text
-                else:
-                    best_segment.text += " " + w_text
+            if not overlaps:
+                continue
+
+            if split_straddling and len(overlaps) > 1:
+                pieces = _split_whisper_segment(whisper_seg, overlaps, segments, min_split_ratio)
+            else:
+                # 最も重複するセグメントに全文を割り当てる（同率なら開始が早い方）
+                best_index = max(overlaps, key=lambda x: (x[0], -segments[x[1]].start))[1]
+                pieces = [(best_index, whisper_seg["text"])]
+
+            for i, text in pieces:
+                if text:
+                    texts[i].append(text)
+
+        for i, segment_texts in enumerate(texts):
+            if segment_texts:
+                existing = [segments[i].text] if segments[i].text else []
+                segments[i].text = " ".join(existing + segment_texts)
 
         logger.info(f"Matched {len(whisper_segments)} transcripts with speaker segments")
 
         return segments
 
+    def attach_words_to_segments(
+        self,
+        whisper_segments: List[Dict[str, Any]],
+        words: List[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        """
+        Whisperの単語タイムスタンプ（timestamp_granularities=["word"]）を各セグメントの "words" に振り分ける
+
+        単語の中点が含まれるセグメント（無ければ直前のセグメント）に割り当てます。
+
+        Args:
+            whisper_segments: Whisperのセグメント（開始時刻順）
+            words: [{"word": "...", "start": 0.0, "end": 0.3}, ...]（開始時刻順）
+
+        Returns:
+            "words" が付与されたwhisper_segments
+        """
+        word_pos = 0
+        for index, whisper_seg in enumerate(whisper_segments):
+            is_last = index == len(whisper_segments) - 1
+            assigned = []
+            while word_pos < len(words):
+                word = words[word_pos]
+                midpoint = (word["start"] + word["end"]) / 2
+                if not is_last and midpoint >= whisper_segments[index + 1]["start"]:
+                    break
+                assigned.append(word)
+                word_pos += 1
+            whisper_seg["words"] = assigned
+        return whisper_segments
+
     def extract_speaker_text(
         self,
         segments: List[SpeakerSegment],
@@ -245,28 +504,113 @@ class SpeakerDiarization:
         Returns:
             統計情報の辞書
         """
-        durations = self.get_speaker_durations(segments)
-        total_duration = sum(durations.values())
+        table = self.segment_table(segments)
+        durations = table.speaker_durations()
+        counts = table.speaker_counts()
+        total_duration = float(durations.sum())
+        percentages = durations / total_duration * 100 if total_duration > 0 else np.zeros_like(durations)
 
         speakers_info = []
-        for speaker_id, duration in sorted(durations.items(), key=lambda x: x[1], reverse=True):
-            percentage = (duration / total_duration * 100) if total_duration > 0 else 0
-            segment_count = len([s for s in segments if s.speaker_id == speaker_id])
-
+        # 発言時間の降順（同率は初出順）
+        for code in np.argsort(-durations, kind="stable").tolist():
             speakers_info.append({
-                "speaker_id": speaker_id,
-                "duration_seconds": round(duration, 1),
-                "percentage": round(percentage, 1),
-                "segment_count": segment_count
+                "speaker_id": table.speakers[code],
+                "duration_seconds": round(float(durations[code]), 1),
+                "percentage": round(float(percentages[code]), 1),
+                "segment_count": int(counts[code])
             })
 
         return {
-            "total_speakers": len(durations),
+            "total_speakers": len(table.speakers),
             "total_duration_seconds": round(total_duration, 1),
             "speakers": speakers_info
         }
 
 
+# 話者交代でテキストを按分するときに区切り位置として優先する文字
+_BREAK_CHARS = set(" 　、。，．,.!?！？")
+
+
+def _join_words(words: List[str]) -> str:
+    """Whisperの単語を結合（英数字どうしの間だけ空白を入れる）"""
+    result: List[str] = []
+    for word in words:
+        word = word.strip()
+        if not word:
+            continue
+        if result and result[-1][-1].isascii() and result[-1][-1].isalnum() and word[0].isascii() and word[0].isalnum():
+            result.append(" ")
+        result.append(word)
+    return "".join(result)
+
+
+def _split_text_by_ratios(text: str, ratios: List[float], snap: int = 5) -> List[str]:
+    """テキストを比率で分割（±snap文字以内に句読点・空白があればそこで区切る）"""
+    cuts: List[int] = []
+    cumulative = 0.0
+    for ratio in ratios[:-1]:
+        cumulative += ratio
+        position = round(len(text) * cumulative)
+        for delta in range(snap + 1):
+            candidates = [c for c in (position + delta, position - delta) if 0 < c < len(text) and text[c - 1] in _BREAK_CHARS]
+            if candidates:
+                position = candidates[0]
+                break
+        cuts.append(max(cuts[-1] if cuts else 0, position))
+    bounds = [0] + cuts + [len(text)]
+    return [text[a:b].strip() for a, b in zip(bounds, bounds[1:])]
+
+
+def _split_whisper_segment(
+    whisper_seg: Dict[str, Any],
+    overlaps: List[Tuple[float, int]],
+    segments: List[SpeakerSegment],
+    min_split_ratio: float
+) -> List[Tuple[int, str]]:
+    """
+    話者交代をまたぐWhisperセグメントを (話者セグメントのindex, テキスト) に分割
+
+    Args:
+        whisper_seg: Whisperのセグメント
+        overlaps: [(重なり時間, 話者セグメントのindex), ...]
+        segments: 話者セグメントのリスト
+        min_split_ratio: 分割対象とする重なりの最小割合
+
+    Returns:
+        時刻順の [(index, text), ...]
+    """
+    total = sum(overlap for overlap, _ in overlaps)
+    candidates = [(overlap, i) for overlap, i in overlaps if overlap >= total * min_split_ratio]
+    candidates.sort(key=lambda x: segments[x[1]].start)
+    best_index = max(overlaps, key=lambda x: (x[0], -segments[x[1]].start))[1]
+
+    if len(candidates) < 2:
+        return [(best_index, whisper_seg["text"])]
+
+    words = whisper_seg.get("words")
+    if words:
+        # 単語ごとに最も重なる話者セグメントへ割り当てる
+        grouped: List[Tuple[int, List[str]]] = []
+        for word in words:
+            target = best_index
+            best_overlap = 0.0
+            for _, i in candidates:
+                overlap = min(word["end"], segments[i].end) - max(word["start"], segments[i].start)
+                if overlap > best_overlap:
+                    best_overlap = overlap
+                    target = i
+            if grouped and grouped[-1][0] == target:
+                grouped[-1][1].append(word["word"])
+            else:
+                grouped.append((target, [word["word"]]))
+        return [(i, _join_words(ws)) for i, ws in grouped]
+
+    # 単語タイムスタンプが無い場合は重なり時間の比率で文字数を按分
+    candidate_total = sum(overlap for overlap, _ in candidates)
+    pieces = _split_text_by_ratios(whisper_seg["text"], [overlap / candidate_total for overlap, _ in candidates])
+    return [(i, text) for (_, i), text in zip(candidates, pieces)]
+
+
 # シングルトンインスタンス
 _diarization_instance: Optional[SpeakerDiarization] = None
 
@@ -275,10 +619,18 @@ def get_speaker_diarization() -> SpeakerDiarization:
     """
     SpeakerDiarizationのシングルトンインスタンスを取得
 
+    AUDIO_MODEL_SOCKET が設定されている場合はモデルサーバーへのプロキシを返します。
+
     Returns:
         SpeakerDiarization instance
     """
     global _diarization_instance
     if _diarization_instance is None:
-        _diarization_instance = SpeakerDiarization()
+        socket_path = os.environ.get("AUDIO_MODEL_SOCKET")
+        if socket_path:
+            # モデルサーバー（api.utils.model_server）に推論を委譲
+            from .model_server import RemoteSpeakerDiarization
+            _diarization_instance = RemoteSpeakerDiarization(socket_path)
+        else:
+            _diarization_instance = SpeakerDiarization()
     return _diarization_instance
@@ -0,0 +1,216 @@
+"""
+要約前の抽出型圧縮（ローカル処理）
+
+長いレポート（最終レポートは2〜3万字）をそのまま gpt-4o に送ると、要約が
+最も遅く高価な呼び出しになります。ここでは文字n-gramのベクトルで文どうしの
+類似度グラフを作り、TextRank（PageRank）で中心性の高い文を選んで、
+トークン予算に収まる「抜粋版」を作ります。
+
+選ぶ順序:
+1. 見出し行（短く句点の無い行。レポートの構成を残す）
+2. 中心性の高い文（予算の central_ratio まで）
+3. 数値・固有名詞（カタカナ語、英字略語、「」内の語、社名など）を含む文を中心性の順に
+4. 残りの予算を中心性の高い文で埋める
+
+抜粋は元の順序で並べ、省略した箇所には「（中略）」を入れます。
+"""
+
+import bisect
+import os
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .local_embedding import LocalEmbeddingBackend
+from .token_budget import count_tokens
+
+SUMMARY_COMPRESSION_ENABLED = os.environ.get("SUMMARY_COMPRESSION_ENABLED", "0") in ("1", "true", "TRUE", "on")
+# 抜粋版のトークン予算（本文がこれ以下なら圧縮しない）
+SUMMARY_COMPRESSION_BUDGET = int(os.environ.get("SUMMARY_COMPRESSION_BUDGET", "4000"))
+
+GAP_MARKER = "（中略）"
+
+_SENTENCE = re.compile(r"[^。！？!?\n]+[。！？!?]*")
+_ENTITY_OR_NUMBER = re.compile(
+    r"[0-9０-９]"                      # 数値（売上、年、割合など）
+    r"|[ァ-ヴー]{3,}"                   # カタカナ語（社名・サービス名・概念）
+    r"|[A-Za-zＡ-Ｚａ-ｚ]{2,}"          # 英字（EC, KPI, DX など）
+    r"|「[^」]{1,30}」"                 # かぎ括弧で示された固有の語
+    r"|株式会社|[一-龥]{1,8}(?:社|銀行|大学|省|庁)"
+)
+
+
+def split_sentences(text: str) -> List[Dict[str, object]]:
+    """
+    文に分割する（改行も区切りとして扱う）
+
+    Returns:
+        [{"text": 文, "paragraph": 段落番号, "heading": 見出し行か}]
+    """
+    sentences = []
+    for paragraph, block in enumerate(re.split(r"\n\s*\n", text)):
+        for line in block.split("\n"):
+            line = line.strip()
+            if not line:
+                continue
+            heading = len(line) <= 40 and not re.search(r"[。！？!?]$", line) and not re.search(r"[。、]", line)
+            for match in _SENTENCE.finditer(line):
+                sentence = match.group(0).strip()
+                if sentence:
+                    sentences.append({"text": sentence, "paragraph": paragraph, "heading": heading})
+    return sentences
+
+
+def textrank(sentences: List[str], damping: float = 0.85, max_iter: int = 100, tol: float = 1e-6) -> np.ndarray:
+    """
+    文のTextRankスコア（文字n-gramのTF-IDFベクトルのコサイン類似度グラフ上のPageRank）
+
+    Args:
+        sentences: 文のリスト
+        damping: ダンピング係数
+        max_iter: 最大反復回数
+        tol: 収束判定の閾値（L1）
+
+    Returns:
+        スコア（合計1）
+    """
+    n = len(sentences)
+    if n == 0:
+        return np.zeros(0)
+    backend = LocalEmbeddingBackend(dimensions=4096, ngram_range=(2, 3)).fit(sentences)
+    vectors = backend.embed_matrix(sentences)
+    similarity = np.clip(vectors @ vectors.T, 0.0, None)
+    np.fill_diagonal(similarity, 0.0)
+
+    # 行ごとに正規化して遷移行列にする（類似する文が無い文は全体へ一様に遷移）
+    row_sums = similarity.sum(axis=1, keepdims=True)
+    transition = np.where(row_sums > 0, similarity / np.where(row_sums > 0, row_sums, 1.0), 1.0 / n)
+
+    scores = np.full(n, 1.0 / n)
+    for _ in range(max_iter):
+        updated = (1.0 - damping) / n + damping * (transition.T @ scores)
+        if np.abs(updated - scores).sum() < tol:
+            scores = updated
+            break
+        scores = updated
+    return scores / scores.sum()
+
+
+def compress_for_summary(
+    text: str,
+    budget_tokens: int = SUMMARY_COMPRESSION_BUDGET,
+    central_ratio: float = 0.5,
+    model: str = None
+) -> Dict[str, object]:
+    """
+    要約に送る抜粋版を作る
+
+    Args:
+        text: レポート本文
+        budget_tokens: 抜粋版のトークン予算（区切りの改行と「（中略）」を含む）
+        central_ratio: 中心性だけで選ぶ分の予算の割合（残りは数値・固有名詞を含む文を優先）
+        model: トークン数を数えるモデル名
+
+    Returns:
+        {"text": 抜粋版（圧縮しない場合は原文）, "compressed": 圧縮したか,
+         "original_tokens", "tokens", "kept_sentences", "total_sentences"}
+    """
+    original_tokens = count_tokens(text, model)
+    sentences = split_sentences(text)
+    result = {
+        "text": text,
+        "compressed": False,
+        "original_tokens": original_tokens,
+        "tokens": original_tokens,
+        "kept_sentences": len(sentences),
+        "total_sentences": len(sentences),
+    }
+    if original_tokens <= budget_tokens or len(sentences) < 2:
+        return result
+
+    texts = [s["text"] for s in sentences]
+    tokens = [count_tokens(t, model) for t in texts]
+    order = np.argsort(-textrank(texts), kind="stable")
+
+    last_index = len(sentences) - 1
+    separator_tokens: Dict[str, int] = {}
+
+    def separator(previous: Optional[int], index: int) -> str:
+        """index の文の前に入れる区切り（previous は直前に採用した文、無ければNone）"""
+        if previous is None:
+            return f"{GAP_MARKER}\n" if index != 0 else ""
+        if index != previous + 1:
+            return f"\n{GAP_MARKER}\n"
+        if sentences[index]["paragraph"] != sentences[previous]["paragraph"]:
+            return "\n\n"
+        if sentences[index]["heading"] or sentences[previous]["heading"]:
+            return "\n"
+        return ""
+
+    def trailer(last: Optional[int]) -> str:
+        return f"\n{GAP_MARKER}" if last is not None and last != last_index else ""
+
+    def cost(piece: str) -> int:
+        if piece not in separator_tokens:
+            separator_tokens[piece] = count_tokens(piece, model)
+        return separator_tokens[piece]
+
+    # 採用した文（元の順序）。区切りと「（中略）」も予算に含めて数える
+    chosen: List[int] = []
+    used = 0
+
+    def take(index: int, limit: int) -> bool:
+        nonlocal used
+        position = bisect.bisect_left(chosen, index)
+        if position < len(chosen) and chosen[position] == index:
+            return False
+        previous = chosen[position - 1] if position > 0 else None
+        following = chosen[position] if position < len(chosen) else None
+        added = tokens[index] + cost(separator(previous, index))
+        if following is not None:
+            added += cost(separator(index, following)) - cost(separator(previous, following))
+        else:
+            added += cost(trailer(index)) - cost(trailer(previous))
+        if used + added > limit:
+            return False
+        chosen.insert(position, index)
+        used += added
+        return True
+
+    def assemble() -> str:
+        # 元の順序で並べ、段落と省略箇所を残す
+        pieces: List[str] = []
+        previous = None
+        for index in chosen:
+            pieces.append(separator(previous, index))
+            pieces.append(texts[index])
+            previous = index
+        pieces.append(trailer(previous))
+        return "".join(pieces)
+
+    for index, sentence in enumerate(sentences):
+        if sentence["heading"]:
+            take(index, budget_tokens)
+    for index in order:
+        take(int(index), int(budget_tokens * central_ratio))
+    for index in order:
+        if _ENTITY_OR_NUMBER.search(texts[index]):
+            take(int(index), budget_tokens)
+    for index in order:
+        take(int(index), budget_tokens)
+
+    # 区切りをまたいでトークンが結合する分の誤差があれば、中心性の低い文から外して予算内に収める
+    condensed = assemble()
+    rank = {int(index): position for position, index in enumerate(order)}
+    while len(chosen) > 1 and count_tokens(condensed, model) > budget_tokens:
+        chosen.remove(max(chosen, key=lambda index: rank[index]))
+        condensed = assemble()
+
+    result.update({
+        "text": condensed,
+        "compressed": True,
+        "tokens": count_tokens(condensed, model),
+        "kept_sentences": len(chosen),
+    })
+    return result
@@ -6,9 +6,26 @@
 
 import os
 from typing import List
-from openai import OpenAI
 
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+from .rate_limit import get_openai_limiter, sdk_usage_tokens
+from .token_budget import count_tokens
+
+_client = None
+
+
+def get_client():
+    """
+    OpenAIクライアントを取得（初回呼び出し時に作成）
+
+    api.utils をimportするだけでは作成しないので、APIキーのない環境
+    （EMBEDDING_BACKEND=local での開発など）でもimportできます。
+    """
+    global _client
+    if _client is None:
+        from openai import OpenAI
+        # リトライは get_openai_limiter() が行うので、SDK側のリトライは無効にする
+        _client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0)
+    return _client
 
 
 def generate_tags(text: str, existing_tags: List[str] = None) -> List[str]:
@@ -43,14 +60,19 @@ def generate_tags(text: str, existing_tags: List[str] = None) -> List[str]:
 タグのみを出力し、説明や補足は不要です。"""
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "あなたは教授の思考やコメントを分析し、適切なタグを生成する専門家です。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=100
+        response = get_openai_limiter().call(
+            "gpt-4o-mini",
+            count_tokens(prompt) + 150,
+            lambda: get_client().chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": "あなたは教授の思考やコメントを分析し、適切なタグを生成する専門家です。"},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.3,
+                max_tokens=100
+            ),
+            used_tokens=sdk_usage_tokens
         )
 
         # レスポンスからタグを抽出
@@ -92,14 +114,19 @@ def suggest_content_type(text: str) -> str:
 以下のいずれか1つを出力してください: comment, thought, lecture"""
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "あなたはテキストの性質を分析し、適切なカテゴリーに分類する専門家です。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0,
-            max_tokens=10
+        response = get_openai_limiter().call(
+            "gpt-4o-mini",
+            count_tokens(prompt) + 60,
+            lambda: get_client().chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": "あなたはテキストの性質を分析し、適切なカテゴリーに分類する専門家です。"},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0,
+                max_tokens=10
+            ),
+            used_tokens=sdk_usage_tokens
         )
 
         content_type = response.choices[0].message.content.strip().lower()
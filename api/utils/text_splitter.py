@@ -8,7 +8,11 @@ import os
 from typing import List, Dict
 from openai import OpenAI
 
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+from .rate_limit import get_openai_limiter, sdk_usage_tokens
+from .token_budget import count_tokens
+
+# リトライは get_openai_limiter() が行うので、SDK側のリトライは無効にする
+client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0)
 
 
 def split_text_by_topic(text: str, max_chunk_size: int = 1500) -> List[Dict[str, str]]:
@@ -57,18 +61,23 @@ def split_text_by_topic(text: str, max_chunk_size: int = 1500) -> List[Dict[str,
         estimated_tokens = int(len(text) * 3.5)  # 日本語の文字数 × 3.5
         max_output_tokens = min(estimated_tokens, 15000)  # 最大15,000トークン
 
-        response = client.chat.completions.create(
-            model="gpt-4o",  # 高品質な分割のためgpt-4oを使用
-            messages=[
-                {
-                    "role": "system",
-                    "content": "あなたはテキストを意味のあるまとまりに分割する専門家です。元のテキストの内容を一切変更せず、適切に分割してください。必ずJSON形式で応答してください。"
-                },
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=max_output_tokens,
-            response_format={"type": "json_object"}  # JSON形式を強制
+        response = get_openai_limiter().call(
+            "gpt-4o",
+            count_tokens(prompt) + max_output_tokens,
+            lambda: client.chat.completions.create(
+                model="gpt-4o",  # 高品質な分割のためgpt-4oを使用
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "あなたはテキストを意味のあるまとまりに分割する専門家です。元のテキストの内容を一切変更せず、適切に分割してください。必ずJSON形式で応答してください。"
+                    },
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.3,
+                max_tokens=max_output_tokens,
+                response_format={"type": "json_object"}  # JSON形式を強制
+            ),
+            used_tokens=sdk_usage_tokens
         )
 
         result_text = response.choices[0].message.content.strip()
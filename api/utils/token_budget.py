@@ -0,0 +1,214 @@
+"""
+トークン数の見積もりと、入力トークン予算に合わせた参照例の詰め込み
+
+tiktoken がインストールされていればモデルのBPEで正確に数え、無ければ
+文字種ごとの係数（gpt-4o系の o200k_base で日本語のレポート・コメントを
+実測して合わせたもの）で見積もります。見積もりは多め（切り上げ）になるようにしています。
+
+参照例は類似度の高い順に、ほぼ同じ内容のものを除きながら参照例の予算内に収め、
+1件が長すぎる場合や予算の残りが少ない場合は文の区切りで切り詰めます。
+レポート本文は、プロンプトと出力の合計がモデルのコンテキスト長を超える場合だけ切り詰めます。
+"""
+
+import math
+import os
+import re
+import unicodedata
+from typing import Callable, Dict, List, Optional, Sequence
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# プロンプト（system + user）全体の入力トークンの上限。未設定（0）ならモデルのコンテキスト長 − 出力トークン数
+PROMPT_INPUT_TOKEN_BUDGET = int(os.environ.get("PROMPT_INPUT_TOKEN_BUDGET", "0"))
+# 参照例に使うトークン数の上限
+PROMPT_REF_TOKEN_BUDGET = int(os.environ.get("PROMPT_REF_TOKEN_BUDGET", "2000"))
+# 参照例のために必ず確保するトークン数（長いレポートでも参照例が全部押し出されないように）
+PROMPT_REF_RESERVE_TOKENS = int(os.environ.get("PROMPT_REF_RESERVE_TOKENS", "1200"))
+# 参照例1件あたりの上限（長い1件が他の参照例を押し出さないように）
+PROMPT_MAX_REF_TOKENS = int(os.environ.get("PROMPT_MAX_REF_TOKENS", "400"))
+# 予算の残りがこれ未満なら、切り詰めてまで参照例を追加しない
+PROMPT_MIN_REF_TOKENS = 60
+# 文字3-gramのJaccard係数がこれ以上の参照例は重複とみなす
+REF_DUPLICATE_THRESHOLD = 0.85
+
+# モデルのコンテキスト長（入力 + 出力）。前方一致で引き、不明なモデルは DEFAULT_CONTEXT_WINDOW
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4.1": 1047576,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# 文字種ごとの1文字あたりのトークン数（o200k_base）
+_ASCII_RATE = 0.3
+_KANA_RATE = 0.75
+_CJK_RATE = 1.0
+_OTHER_RATE = 1.0
+
+_SENTENCE_END = re.compile(r"(?<=[。！？!?\n])")
+
+_encoders: Dict[str, Optional[Callable[[str], List[int]]]] = {}
+
+
+def _get_encoder(model: Optional[str]) -> Optional[Callable[[str], List[int]]]:
+    """tiktoken のエンコーダ（使えなければNone）"""
+    if tiktoken is None:
+        return None
+    key = model or ""
+    if key not in _encoders:
+        try:
+            encoding = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding("o200k_base")
+        except (KeyError, ValueError):
+            encoding = tiktoken.get_encoding("o200k_base")
+        _encoders[key] = encoding.encode
+    return _encoders[key]
+
+
+def context_window(model: Optional[str]) -> int:
+    """モデルのコンテキスト長（最も長く一致する接頭辞で引く）"""
+    matches = [name for name in MODEL_CONTEXT_WINDOWS if model and model.startswith(name)]
+    if not matches:
+        return DEFAULT_CONTEXT_WINDOW
+    return MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
+
+
+def input_token_budget(model: Optional[str], max_output_tokens: int) -> int:
+    """
+    プロンプト全体に使える入力トークン数
+
+    モデルのコンテキスト長から出力分を引いた値です。PROMPT_INPUT_TOKEN_BUDGET を設定した場合は
+    その値を上限にします（ただしコンテキスト長を超えない）。
+    """
+    available = context_window(model) - max_output_tokens
+    if PROMPT_INPUT_TOKEN_BUDGET > 0:
+        return min(PROMPT_INPUT_TOKEN_BUDGET, available)
+    return available
+
+
+def estimate_tokens(text: str) -> int:
+    """文字種ごとの係数でトークン数を見積もる（tiktoken 不要）"""
+    total = 0.0
+    for ch in text:
+        code = ord(ch)
+        if code < 0x80:
+            total += _ASCII_RATE
+        elif 0x3040 <= code <= 0x30FF:
+            total += _KANA_RATE
+        elif 0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF:
+            total += _CJK_RATE
+        else:
+            total += _OTHER_RATE
+    return int(math.ceil(total))
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """
+    テキストのトークン数を数える
+
+    Args:
+        text: テキスト
+        model: モデル名（tiktoken でエンコーディングを選ぶのに使う）
+
+    Returns:
+        トークン数（tiktoken が無い場合は見積もり）
+    """
+    if not text:
+        return 0
+    encode = _get_encoder(model)
+    if encode is None:
+        return estimate_tokens(text)
+    return len(encode(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: Optional[str] = None) -> str:
+    """
+    文の区切りで max_tokens 以内に切り詰める
+
+    最初の1文だけで max_tokens を超える場合は、その文を文字数で切って「…」を付けます。
+    """
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+
+    kept: List[str] = []
+    used = 0
+    for sentence in _SENTENCE_END.split(text):
+        tokens = count_tokens(sentence, model)
+        if used + tokens > max_tokens:
+            break
+        kept.append(sentence)
+        used += tokens
+
+    if kept:
+        return "".join(kept).rstrip()
+
+    # 1文目が長すぎる: 予算に収まる長さまで文字数を縮める
+    head = text
+    while head and count_tokens(head, model) > max_tokens - 1:
+        head = head[:int(len(head) * 0.8)]
+    return f"{head}…" if head else ""
+
+
+def _trigrams(text: str) -> set:
+    text = "".join(unicodedata.normalize("NFKC", text).lower().split())
+    return {text[i:i + 3] for i in range(max(len(text) - 2, 1))}
+
+
+def pack_refs(
+    refs: Sequence[str],
+    budget_tokens: int,
+    model: Optional[str] = None,
+    max_ref_tokens: int = PROMPT_MAX_REF_TOKENS,
+    ref_overhead_tokens: int = 2
+) -> Dict[str, object]:
+    """
+    参照例を予算内に詰める
+
+    Args:
+        refs: 参照例（類似度の高い順）
+        budget_tokens: 参照例に使えるトークン数
+        model: モデル名
+        max_ref_tokens: 参照例1件あたりの上限
+        ref_overhead_tokens: 1件ごとの区切り（"- " と改行）のトークン数
+
+    Returns:
+        {"refs": 採用した参照例, "tokens": 使ったトークン数,
+         "dropped": 予算不足で外した件数, "duplicates": 重複として外した件数}
+    """
+    packed: List[str] = []
+    seen: List[set] = []
+    used = 0
+    dropped = 0
+    duplicates = 0
+
+    for index, ref in enumerate(refs):
+        if not ref or not ref.strip():
+            continue
+        grams = _trigrams(ref)
+        if any(len(grams & other) / max(1, len(grams | other)) >= REF_DUPLICATE_THRESHOLD for other in seen):
+            duplicates += 1
+            continue
+
+        remaining = budget_tokens - used - ref_overhead_tokens
+        if remaining < PROMPT_MIN_REF_TOKENS:
+            dropped += sum(1 for rest in refs[index:] if rest and rest.strip())
+            break
+
+        limit = min(max_ref_tokens, remaining)
+        text = truncate_to_tokens(ref, limit, model)
+        if not text:
+            dropped += 1
+            continue
+
+        packed.append(text)
+        seen.append(grams)
+        used += count_tokens(text, model) + ref_overhead_tokens
+
+    return {"refs": packed, "tokens": used, "dropped": dropped, "duplicates": duplicates}
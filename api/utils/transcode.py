@@ -0,0 +1,156 @@
+"""
+非同期の音声トランスコード（ffmpeg）
+
+asyncio.create_subprocess_exec で ffmpeg を起動し、エンコード結果を標準出力のパイプから
+直接メモリに受け取ります（一時ファイルを書いて読み直さない）。
+同時に動く ffmpeg の数は FFMPEG_CONCURRENCY で制限し、呼び出し元のタスクが
+キャンセルされた場合（クライアントの切断など）は ffmpeg を kill します。
+"""
+
+import asyncio
+import os
+from typing import Awaitable, List, Optional, TypeVar
+
+FFMPEG_CONCURRENCY = int(os.environ.get("FFMPEG_CONCURRENCY", "2"))
+WHISPER_MAX_BYTES = 25 * 1024 * 1024  # Whisper APIのアップロード上限
+
+# Whisperは16kHzで処理するので、それ以上のサンプルレート・ビットレートは無駄になる
+TRANSCODE_SAMPLE_RATE = 16000
+MIN_BITRATE_KBPS = 16
+MAX_BITRATE_KBPS = 64
+
+T = TypeVar("T")
+
+_semaphore: Optional[asyncio.Semaphore] = None
+_semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+class TranscodeError(Exception):
+    """ffmpeg / ffprobe が失敗した"""
+    pass
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore, _semaphore_loop
+    loop = asyncio.get_running_loop()
+    if _semaphore is None or _semaphore_loop is not loop:
+        _semaphore = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+        _semaphore_loop = loop
+    return _semaphore
+
+
+async def _run(args: List[str]) -> bytes:
+    """コマンドを実行して標準出力を返す（キャンセル時はプロセスをkill）"""
+    async with _get_semaphore():
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+
+    if process.returncode != 0:
+        raise TranscodeError(f"{args[0]} error: {stderr.decode('utf-8', errors='replace').strip()[-2000:]}")
+    return stdout
+
+
+def target_bitrate(duration: float, max_bytes: int = WHISPER_MAX_BYTES, headroom: float = 0.92) -> int:
+    """
+    長さから、1回のエンコードで max_bytes に収まるビットレートを決める
+
+    Args:
+        duration: 音声の長さ（秒）
+        max_bytes: 出力サイズの上限
+        headroom: コンテナのオーバーヘッド分の余裕
+
+    Returns:
+        ビットレート（kbps、MIN_BITRATE_KBPS〜MAX_BITRATE_KBPS）
+    """
+    if duration <= 0:
+        return MAX_BITRATE_KBPS
+    kbps = int(max_bytes * 8 * headroom / duration / 1000)
+    return max(MIN_BITRATE_KBPS, min(MAX_BITRATE_KBPS, kbps))
+
+
+async def probe_duration(audio_path: str) -> float:
+    """ffprobeで音声の長さ（秒）を取得（デコードしない）"""
+    output = await _run([
+        "ffprobe", "-v", "error", "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1", audio_path
+    ])
+    try:
+        return float(output.decode().strip())
+    except ValueError:
+        raise TranscodeError(f"could not read duration of {audio_path}")
+
+
+async def transcode_audio(
+    audio_path: str,
+    bitrate_kbps: int = MAX_BITRATE_KBPS,
+    start: Optional[float] = None,
+    duration: Optional[float] = None,
+    output_format: str = "mp3"
+) -> bytes:
+    """
+    音声を16kHzモノラルにエンコードし、結果のバイト列を返す
+
+    Args:
+        audio_path: 入力ファイル
+        bitrate_kbps: ビットレート（kbps）
+        start: 切り出し開始時刻（秒）
+        duration: 切り出す長さ（秒）
+        output_format: 出力形式（ffmpegの -f）
+
+    Returns:
+        エンコード済みの音声データ
+    """
+    args = ["ffmpeg", "-nostdin", "-v", "error"]
+    if start:
+        args += ["-ss", str(start)]
+    if duration is not None:
+        args += ["-t", str(duration)]
+    args += [
+        "-i", audio_path,
+        "-ac", "1", "-ar", str(TRANSCODE_SAMPLE_RATE), "-b:a", f"{bitrate_kbps}k",
+        "-f", output_format, "-"
+    ]
+    return await _run(args)
+
+
+async def cancel_on_disconnect(request, awaitable: Awaitable[T], poll_interval: float = 0.5) -> T:
+    """
+    クライアントが切断したら処理をキャンセルする
+
+    Args:
+        request: starlette の Request
+        awaitable: 実行する処理
+        poll_interval: 切断を確認する間隔（秒）
+
+    Returns:
+        処理の結果
+
+    Raises:
+        asyncio.CancelledError: クライアントが切断した
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                raise asyncio.CancelledError("client disconnected")
+    finally:
+        if not task.done():
+            task.cancel()
@@ -0,0 +1,367 @@
+"""
+音声区間検出（VAD）による無音の事前除去
+
+講義の録音には長い無音・休憩・空調音などが含まれますが、pyannote と Whisper は
+秒数に比例して時間（と料金）がかかります。ここでは短時間エネルギーで発話区間を求め、
+無音を詰めた音声ファイルと、詰めた後の時刻を元の時刻に戻すための OffsetMap を作ります。
+
+デコードは ffmpeg から 16kHz モノラルの PCM をブロック単位で読み、2時間の音声でも
+メモリに載せるのはフレームごとのエネルギー（30msごとに1値）だけです。
+"""
+
+import inspect
+import os
+import subprocess
+import wave
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+AUDIO_VAD_ENABLED = os.environ.get("AUDIO_VAD_ENABLED", "1") in ("1", "true", "TRUE", "on")
+# 削れる割合がこれ未満なら詰め直さずに元の音声を使う
+AUDIO_VAD_MIN_SAVING = float(os.environ.get("AUDIO_VAD_MIN_SAVING", "0.05"))
+
+SAMPLE_RATE = 16000
+FRAME_SAMPLES = 480  # 30ms
+_BLOCK_FRAMES = 2000  # 1回に読むフレーム数（60秒分）
+
+
+class VADError(Exception):
+    """音声のデコード・エンコードに失敗した"""
+    pass
+
+
+def _decode_pcm(audio_path: str) -> Iterator[np.ndarray]:
+    """ffmpegで16kHzモノラルのint16 PCMにデコードし、ブロックごとに返す"""
+    process = subprocess.Popen(
+        ["ffmpeg", "-nostdin", "-v", "error", "-i", audio_path, "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    try:
+        while True:
+            data = process.stdout.read(_BLOCK_FRAMES * FRAME_SAMPLES * 2)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) - len(data) % 2], dtype=np.int16)
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read().decode("utf-8", errors="replace")
+        process.stderr.close()
+        if process.wait() != 0:
+            raise VADError(f"ffmpeg decode error: {stderr.strip()}")
+
+
+def frame_energies(audio_path: str) -> Tuple[np.ndarray, int]:
+    """
+    30msフレームごとのエネルギー（dBFS）を計算
+
+    Returns:
+        (フレームごとのdBFS, 総サンプル数)
+    """
+    energies: List[np.ndarray] = []
+    leftover = np.zeros(0, dtype=np.int16)
+    total = 0
+    for block in _decode_pcm(audio_path):
+        total += len(block)
+        samples = np.concatenate([leftover, block]) if len(leftover) else block
+        usable = len(samples) - len(samples) % FRAME_SAMPLES
+        frames = samples[:usable].reshape(-1, FRAME_SAMPLES).astype(np.float32) / 32768.0
+        energies.append(10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-10))
+        leftover = samples[usable:]
+    if len(leftover):
+        frame = leftover.astype(np.float32) / 32768.0
+        energies.append(np.array([10.0 * np.log10(np.mean(frame * frame) + 1e-10)], dtype=np.float32))
+    return (np.concatenate(energies) if energies else np.zeros(0, dtype=np.float32)), total
+
+
+def _runs(mask: np.ndarray) -> np.ndarray:
+    """True が連続する区間の [開始, 終了) を (n, 2) で返す"""
+    padded = np.concatenate([[0], mask.astype(np.int8), [0]])
+    edges = np.flatnonzero(np.diff(padded))
+    return edges.reshape(-1, 2)
+
+
+def detect_speech_regions(
+    energies_db: np.ndarray,
+    margin_db: float = 12.0,
+    min_speech: float = 0.25,
+    min_silence: float = 0.8,
+    padding: float = 0.3
+) -> List[Tuple[int, int]]:
+    """
+    フレームエネルギーから発話区間を求める
+
+    しきい値は雑音レベル（下位10%）+ margin_db ですが、全体が発話の録音で
+    発話を捨てないよう、上位5%のレベル - 25dB を上限にします。
+
+    Args:
+        energies_db: フレームごとのdBFS
+        margin_db: 雑音レベルからのマージン
+        min_speech: これより短い発話区間は捨てる（秒）
+        min_silence: これより短い無音は詰めない（秒）
+        padding: 発話区間の前後に残す余白（秒）
+
+    Returns:
+        発話区間の [開始サンプル, 終了サンプル) のリスト
+    """
+    if len(energies_db) == 0:
+        return []
+
+    frame_seconds = FRAME_SAMPLES / SAMPLE_RATE
+    noise_floor = np.percentile(energies_db, 10)
+    threshold = min(noise_floor + margin_db, np.percentile(energies_db, 95) - 25.0)
+    voiced = energies_db > threshold
+
+    # 短い無音を埋める
+    for start, end in _runs(~voiced):
+        if start > 0 and end < len(voiced) and (end - start) * frame_seconds < min_silence:
+            voiced[start:end] = True
+
+    # 短い発話（クリック音など）を捨てる
+    for start, end in _runs(voiced):
+        if (end - start) * frame_seconds < min_speech:
+            voiced[start:end] = False
+
+    # 前後に余白を付けて、重なった区間をまとめる
+    pad_frames = int(round(padding / frame_seconds))
+    regions: List[Tuple[int, int]] = []
+    for start, end in _runs(voiced):
+        start = max(0, start - pad_frames)
+        end = min(len(voiced), end + pad_frames)
+        if regions and start <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+
+    return [(start * FRAME_SAMPLES, end * FRAME_SAMPLES) for start, end in regions]
+
+
+def vad_params_id(**params) -> str:
+    """
+    VADの結果を決める設定の識別子（無音除去後の話者識別結果のキャッシュキーに使う）
+
+    Args:
+        **params: detect_speech_regions のパラメータ（省略したものは既定値）
+    """
+    values = {
+        name: param.default
+        for name, param in inspect.signature(detect_speech_regions).parameters.items()
+        if param.default is not inspect.Parameter.empty
+    }
+    values.update(params)
+    values["min_saving"] = AUDIO_VAD_MIN_SAVING
+    return "vad:" + ",".join(f"{name}={values[name]}" for name in sorted(values))
+
+
+class OffsetMap:
+    """無音を詰めた音声の時刻 ↔ 元の音声の時刻の対応表"""
+
+    def __init__(self, regions: List[Tuple[int, int]], original_samples: int, sample_rate: int = SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.original_samples = original_samples
+        regions = [(start, min(end, original_samples)) for start, end in regions if start < original_samples]
+        self.original_starts = np.array([start for start, _ in regions], dtype=np.int64)
+        self.lengths = np.array([end - start for start, end in regions], dtype=np.int64)
+        self.compact_starts = np.concatenate([[0], np.cumsum(self.lengths)[:-1]]).astype(np.int64) if regions else np.zeros(0, dtype=np.int64)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """キャッシュ保存用の辞書"""
+        return {"regions": self.regions, "original_samples": int(self.original_samples), "sample_rate": self.sample_rate}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "OffsetMap":
+        return cls([tuple(r) for r in data["regions"]], data["original_samples"], data.get("sample_rate", SAMPLE_RATE))
+
+    @property
+    def regions(self) -> List[Tuple[int, int]]:
+        return [(int(s), int(s + n)) for s, n in zip(self.original_starts, self.lengths)]
+
+    @property
+    def original_duration(self) -> float:
+        return self.original_samples / self.sample_rate
+
+    @property
+    def compact_duration(self) -> float:
+        return float(self.lengths.sum()) / self.sample_rate
+
+    @property
+    def kept_ratio(self) -> float:
+        return self.compact_duration / self.original_duration if self.original_samples else 1.0
+
+    def _region_index(self, compact_sample: float) -> int:
+        index = int(np.searchsorted(self.compact_starts, compact_sample, side="right")) - 1
+        return min(max(index, 0), len(self.lengths) - 1)
+
+    def _to_original_in(self, index: int, t: float) -> float:
+        offset = min(max(t * self.sample_rate - self.compact_starts[index], 0), self.lengths[index])
+        return float(self.original_starts[index] + offset) / self.sample_rate
+
+    def to_original(self, t: float) -> float:
+        """詰めた後の時刻（秒）を元の時刻に変換"""
+        if len(self.lengths) == 0:
+            return t
+        return self._to_original_in(self._region_index(t * self.sample_rate), t)
+
+    def split_range(self, start: float, end: float) -> List[Tuple[float, float]]:
+        """
+        詰めた後の区間を元の時刻の区間に変換（詰めた継ぎ目で分割）
+
+        Args:
+            start: 開始時刻（秒、詰めた後）
+            end: 終了時刻（秒、詰めた後）
+
+        Returns:
+            元の時刻での (start, end) のリスト
+        """
+        if len(self.lengths) == 0:
+            return [(start, end)]
+        first = self._region_index(start * self.sample_rate)
+        last = self._region_index(max(start, end) * self.sample_rate - 1e-6)
+        pieces = []
+        for index in range(first, last + 1):
+            region_start = self.compact_starts[index] / self.sample_rate
+            region_end = (self.compact_starts[index] + self.lengths[index]) / self.sample_rate
+            piece_start = max(start, region_start)
+            piece_end = min(end, region_end)
+            if piece_end > piece_start:
+                pieces.append((self._to_original_in(index, piece_start), self._to_original_in(index, piece_end)))
+        return pieces
+
+
+def _write_compacted(audio_path: str, output_path: str, regions: List[Tuple[int, int]], bitrate: str):
+    """発話区間のサンプルだけを出力ファイルに書き出す（.wav 以外はffmpegでエンコード）"""
+    if output_path.endswith(".wav"):
+        writer = wave.open(output_path, "wb")
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(SAMPLE_RATE)
+        write = writer.writeframes
+        encoder = None
+    else:
+        encoder = subprocess.Popen(
+            ["ffmpeg", "-nostdin", "-v", "error", "-f", "s16le", "-ar", str(SAMPLE_RATE), "-ac", "1", "-i", "pipe:0",
+             "-b:a", bitrate, "-y", output_path],
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        write = encoder.stdin.write
+
+    try:
+        position = 0
+        region = 0
+        for block in _decode_pcm(audio_path):
+            block_end = position + len(block)
+            while region < len(regions) and regions[region][0] < block_end:
+                start = max(regions[region][0], position)
+                end = min(regions[region][1], block_end)
+                if end > start:
+                    write(block[start - position:end - position].tobytes())
+                if regions[region][1] <= block_end:
+                    region += 1
+                else:
+                    break
+            position = block_end
+    finally:
+        if encoder is None:
+            writer.close()
+        else:
+            encoder.stdin.close()
+            stderr = encoder.stderr.read().decode("utf-8", errors="replace")
+            encoder.stderr.close()
+            if encoder.wait() != 0:
+                raise VADError(f"ffmpeg encode error: {stderr.strip()}")
+
+
+def plan_compaction(audio_path: str, **params) -> Optional[OffsetMap]:
+    """
+    発話区間を検出し、無音を詰める場合の OffsetMap を返す（ファイルは書き出さない）
+
+    Args:
+        audio_path: 元の音声ファイル
+        **params: detect_speech_regions のパラメータ
+
+    Returns:
+        OffsetMap。発話が見つからない、または削れる割合が AUDIO_VAD_MIN_SAVING 未満の場合はNone
+    """
+    energies, total_samples = frame_energies(audio_path)
+    regions = detect_speech_regions(energies, **params)
+    offset_map = OffsetMap(regions, total_samples)
+
+    if not regions or offset_map.kept_ratio > 1.0 - AUDIO_VAD_MIN_SAVING:
+        return None
+    return offset_map
+
+
+def write_compacted_audio(audio_path: str, output_path: str, offset_map: OffsetMap, bitrate: str = "64k"):
+    """
+    plan_compaction の結果に従って無音を詰めた音声ファイルを書き出す
+
+    Args:
+        audio_path: 元の音声ファイル
+        output_path: 出力先（.wav なら16kHzモノラルPCM、それ以外はffmpegで bitrate にエンコード）
+        offset_map: plan_compaction（またはキャッシュから復元）した OffsetMap
+        bitrate: エンコード時のビットレート
+    """
+    _write_compacted(audio_path, output_path, offset_map.regions, bitrate)
+
+
+def compact_audio(audio_path: str, output_path: str, bitrate: str = "64k", **params) -> Optional[OffsetMap]:
+    """
+    無音を詰めた音声ファイルを作る
+
+    Args:
+        audio_path: 元の音声ファイル
+        output_path: 出力先（.wav なら16kHzモノラルPCM、それ以外はffmpegで bitrate にエンコード）
+        bitrate: エンコード時のビットレート
+        **params: detect_speech_regions のパラメータ
+
+    Returns:
+        OffsetMap。発話が見つからない、または削れる割合が AUDIO_VAD_MIN_SAVING 未満の場合は
+        ファイルを作らずにNone（元の音声をそのまま使う）
+    """
+    offset_map = plan_compaction(audio_path, **params)
+    if offset_map is not None:
+        write_compacted_audio(audio_path, output_path, offset_map, bitrate)
+    return offset_map
+
+
+def compact_audio_cached(audio_path: str, output_path: str, audio_hash: str, bitrate: str = "64k", **params) -> Optional[OffsetMap]:
+    """
+    compact_audio と同じですが、発話区間の検出結果を音声解析キャッシュに (audio_hash, VAD設定) で保存し、
+    同じ録音の2回目以降はデコードとエネルギー計算を省きます（詰めた音声の書き出しは毎回行う）。
+
+    Args:
+        audio_path: 元の音声ファイル
+        output_path: 出力先
+        audio_hash: 元の音声ファイルのsha256
+        bitrate: エンコード時のビットレート
+        **params: detect_speech_regions のパラメータ
+
+    Returns:
+        OffsetMap（無音を詰めない場合はNone）
+    """
+    from .audio_cache import get_audio_cache
+
+    cache = get_audio_cache()
+    params_id = vad_params_id(**params)
+    cached = None
+    if cache is not None:
+        try:
+            cached = cache.get_vad_map(audio_hash, params_id)
+        except Exception as e:
+            print(f"⚠️ VADキャッシュを参照できません: {e}")
+
+    if cached is not None:
+        offset_map = OffsetMap.from_dict(cached["offset_map"]) if cached["offset_map"] else None
+    else:
+        offset_map = plan_compaction(audio_path, **params)
+        if cache is not None:
+            try:
+                cache.put_vad_map(audio_hash, params_id, offset_map.to_dict() if offset_map is not None else None)
+            except Exception as e:
+                print(f"⚠️ VADキャッシュに保存できません: {e}")
+
+    if offset_map is not None:
+        write_compacted_audio(audio_path, output_path, offset_map, bitrate)
+    return offset_map
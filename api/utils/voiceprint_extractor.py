@@ -6,25 +6,80 @@ SpeechBrainを使用して音声ファイルから声紋（voiceprint/speaker em
 
 import os
 import logging
-from typing import Optional, Tuple, Dict, Any
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple, Dict, Any, List
 import numpy as np
 import torch
 import torchaudio
 from pathlib import Path
 
+from .audio_cache import file_sha256, get_audio_cache
+
 logger = logging.getLogger(__name__)
 
+VOICEPRINT_MODEL_ID = "speechbrain/spkrec-ecapa-voxceleb"
+
+# CPU推論の設定
+# eager: float32のまま / torchscript: エンコーダをTorchScript化してfreeze
+# （動的int8量子化は対象がnn.Linearだけで、Conv1d/BatchNormで構成されるECAPA-TDNNには効かないため提供しない）
+VOICEPRINT_INFERENCE_MODE = os.environ.get("VOICEPRINT_INFERENCE_MODE", "eager")
+INFERENCE_MODES = ("eager", "torchscript")
+
+
+def default_num_threads() -> int:
+    """
+    ワーカー1つあたりのintra-opスレッド数
+
+    VOICEPRINT_NUM_THREADS が無ければ、CPUコア数をuvicornのワーカー数（WEB_CONCURRENCY）で
+    割った値にします。複数リクエストが同時に推論してもコアを奪い合わないようにするためです。
+    """
+    configured = os.environ.get("VOICEPRINT_NUM_THREADS")
+    if configured:
+        return max(1, int(configured))
+    workers = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+    return max(1, (os.cpu_count() or 1) // workers)
+
 
 class VoiceprintExtractor:
     """声紋抽出クラス"""
 
-    def __init__(self):
-        """初期化。SpeechBrainモデルをロード"""
+    def __init__(self, inference_mode: Optional[str] = None, num_threads: Optional[int] = None):
+        """
+        初期化（モデルは初回使用時にロード）
+
+        Args:
+            inference_mode: eager / torchscript（省略時は VOICEPRINT_INFERENCE_MODE）
+            num_threads: CPU推論のスレッド数（省略時は default_num_threads()）
+        """
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.model = None
+        self.inference_mode = inference_mode or VOICEPRINT_INFERENCE_MODE
+        if self.inference_mode not in INFERENCE_MODES:
+            raise ValueError(f"Unknown VOICEPRINT_INFERENCE_MODE: {self.inference_mode}")
+        self.num_threads = num_threads or default_num_threads()
         self.sample_rate = 16000  # SpeechBrainの推奨サンプルレート
+        self.batch_size = int(os.environ.get("VOICEPRINT_BATCH_SIZE", "16"))
+        self.min_segment_seconds = 0.25  # これより短いセグメントは声紋が不安定なため除外
+
+        # デコード・リサンプリング済み波形のキャッシュ（長時間音声はメモリを食うので1件のみ）
+        # 複数リクエストのスレッドから使われるため、読み書きは _waveform_lock で守る
+        self._waveform_cache: "OrderedDict[Tuple[str, float, int], Tuple[torch.Tensor, int]]" = OrderedDict()
+        self._waveform_cache_size = 1
+        self._waveform_lock = threading.Lock()
+
+        # 入力サンプルレート → Resample のキャッシュ（_resampler_lock で守る）
+        self._resamplers: Dict[int, torchaudio.transforms.Resample] = {}
+        self._resampler_lock = threading.Lock()
+
+        logger.info(f"VoiceprintExtractor initialized on device: {self.device} (mode: {self.inference_mode})")
 
-        logger.info(f"VoiceprintExtractor initialized on device: {self.device}")
+    @property
+    def cache_model_id(self) -> str:
+        """音声解析キャッシュのキーに使うモデルID（TorchScript化で出力がわずかに変わるため推論モードを含める）"""
+        if self.inference_mode == "eager":
+            return VOICEPRINT_MODEL_ID
+        return f"{VOICEPRINT_MODEL_ID}#{self.inference_mode}"
 
     def _load_model(self):
         """遅延ロード：初回使用時にモデルをロード"""
@@ -35,28 +90,82 @@ class VoiceprintExtractor:
             from speechbrain.pretrained import EncoderClassifier
 
             # ECAPA-TDNN モデルをロード（192次元の声紋ベクトル）
+            if self.device == "cpu":
+                torch.set_num_threads(self.num_threads)
+
             self.model = EncoderClassifier.from_hparams(
-                source="speechbrain/spkrec-ecapa-voxceleb",
+                source=VOICEPRINT_MODEL_ID,
                 savedir="models/speaker_recognition",
                 run_opts={"device": self.device}
             )
-            logger.info("SpeechBrain ECAPA-TDNN model loaded successfully")
+            self.model.eval()
+            logger.info(f"SpeechBrain ECAPA-TDNN model loaded successfully (threads: {torch.get_num_threads()})")
         except Exception as e:
             logger.error(f"Failed to load SpeechBrain model: {e}")
             raise
 
-    def _load_audio(self, audio_path: str) -> Tuple[torch.Tensor, int]:
+        if self.device == "cpu" and self.inference_mode != "eager":
+            self._optimize_encoder()
+
+    def _optimize_encoder(self):
+        """
+        CPU向けにエンコーダ（embedding_model）を置き換える
+
+        torchscript: TorchScript化してfreeze（Pythonのオーバーヘッドと演算の融合）
+        変換に失敗した場合はeagerのまま続行します。
+        """
+        encoder = self.model.mods.embedding_model
+        try:
+            optimized = torch.jit.freeze(torch.jit.script(encoder.eval()))
+            self.model.mods.embedding_model = optimized
+            logger.info(f"Voiceprint encoder optimized for CPU: {self.inference_mode}")
+        except Exception as e:
+            logger.warning(f"Failed to apply {self.inference_mode} to the voiceprint encoder, using eager: {e}")
+            self.inference_mode = "eager"
+
+    def warm_up(self):
+        """モデルをロードし、ダミー音声で1回推論しておく（初回リクエストの待ち時間をなくす）"""
+        self._load_model()
+        self._encode_waveforms([torch.randn(self.sample_rate) * 0.01])
+        logger.info("VoiceprintExtractor warmed up")
+
+    def _get_resampler(self, source_rate: int) -> torchaudio.transforms.Resample:
+        """入力サンプルレートごとにResample（フィルタカーネル）を作り回す"""
+        with self._resampler_lock:
+            resampler = self._resamplers.get(source_rate)
+            if resampler is None:
+                resampler = torchaudio.transforms.Resample(source_rate, self.sample_rate)
+                self._resamplers[source_rate] = resampler
+            return resampler
+
+    def _load_audio(
+        self,
+        audio_path: str,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None
+    ) -> Tuple[torch.Tensor, int]:
         """
         音声ファイルをロード
 
+        時間範囲を指定した場合は、メタデータのサンプルレートからフレーム位置を求め、
+        その範囲だけをデコードしてからリサンプリングします。
+
         Args:
             audio_path: 音声ファイルのパス
+            start_time: 読み込み開始時刻（秒）。Noneの場合は先頭から
+            end_time: 読み込み終了時刻（秒）。Noneの場合は最後まで
 
         Returns:
             (waveform, sample_rate): 波形データとサンプルレート
         """
         try:
-            waveform, sr = torchaudio.load(audio_path)
+            if start_time is None and end_time is None:
+                waveform, sr = torchaudio.load(audio_path)
+            else:
+                source_rate = torchaudio.info(audio_path).sample_rate
+                frame_offset = int((start_time or 0.0) * source_rate)
+                num_frames = int((end_time - (start_time or 0.0)) * source_rate) if end_time is not None else -1
+                waveform, sr = torchaudio.load(audio_path, frame_offset=frame_offset, num_frames=num_frames)
 
             # ステレオをモノラルに変換
             if waveform.shape[0] > 1:
@@ -64,8 +173,7 @@ class VoiceprintExtractor:
 
             # サンプルレートを16kHzにリサンプリング
             if sr != self.sample_rate:
-                resampler = torchaudio.transforms.Resample(sr, self.sample_rate)
-                waveform = resampler(waveform)
+                waveform = self._get_resampler(sr)(waveform)
                 sr = self.sample_rate
 
             return waveform, sr
@@ -73,6 +181,181 @@ class VoiceprintExtractor:
             logger.error(f"Failed to load audio file {audio_path}: {e}")
             raise
 
+    def _waveform_cache_key(self, audio_path: str) -> Tuple[str, float, int]:
+        stat = os.stat(audio_path)
+        return (os.path.abspath(audio_path), stat.st_mtime, stat.st_size)
+
+    def _cached_waveform(self, audio_path: str) -> Optional[Tuple[torch.Tensor, int]]:
+        key = self._waveform_cache_key(audio_path)
+        with self._waveform_lock:
+            cached = self._waveform_cache.get(key)
+            if cached is not None:
+                self._waveform_cache.move_to_end(key)
+            return cached
+
+    def load_waveform(self, audio_path: str) -> Tuple[torch.Tensor, int]:
+        """
+        音声ファイルをロード（キャッシュ付き）
+
+        同じファイルから複数セグメントを切り出すときに、デコードとリサンプリングを
+        1回で済ませるために使います。キーはパス・更新時刻・サイズです。
+
+        Args:
+            audio_path: 音声ファイルのパス
+
+        Returns:
+            (waveform, sample_rate): 16kHzモノラルの波形データとサンプルレート
+        """
+        cached = self._cached_waveform(audio_path)
+        if cached is not None:
+            return cached
+
+        # デコードはロックの外で行う（他のリクエストを待たせない）
+        key = self._waveform_cache_key(audio_path)
+        loaded = self._load_audio(audio_path)
+        with self._waveform_lock:
+            self._waveform_cache[key] = loaded
+            while len(self._waveform_cache) > self._waveform_cache_size:
+                self._waveform_cache.popitem(last=False)
+        return loaded
+
+    def clear_waveform_cache(self, audio_path: Optional[str] = None):
+        """
+        波形キャッシュを破棄（リクエスト終了時にメモリを解放する）
+
+        Args:
+            audio_path: 指定した場合はそのファイルの波形だけを破棄する（同時に処理中の
+                        他のリクエストの波形は残す）。Noneの場合はすべて破棄する
+        """
+        with self._waveform_lock:
+            if audio_path is None:
+                self._waveform_cache.clear()
+                return
+            path = os.path.abspath(audio_path)
+            for key in [key for key in self._waveform_cache if key[0] == path]:
+                del self._waveform_cache[key]
+
+    def _encode_waveforms(self, waveforms: List[torch.Tensor]) -> List[np.ndarray]:
+        """
+        長さの異なる波形をゼロ詰めでバッチにまとめ、encode_batchで一括エンコード
+
+        Args:
+            waveforms: 1次元の波形テンソルのリスト
+
+        Returns:
+            正規化済みの声紋ベクトルのリスト
+        """
+        results: List[np.ndarray] = []
+
+        for i in range(0, len(waveforms), self.batch_size):
+            chunk = waveforms[i:i + self.batch_size]
+            lengths = torch.tensor([w.shape[0] for w in chunk], dtype=torch.float32)
+            max_len = int(lengths.max().item())
+
+            batch = torch.zeros(len(chunk), max_len)
+            for row, w in enumerate(chunk):
+                batch[row, :w.shape[0]] = w
+
+            # 相対長（1.0 = 最長）を渡すとパディング部分は統計プーリングから除外される
+            wav_lens = lengths / max_len
+
+            with torch.inference_mode():
+                embeddings = self.model.encode_batch(batch.to(self.device), wav_lens.to(self.device))
+                embeddings_np = embeddings.squeeze(1).cpu().numpy()
+
+            norms = np.linalg.norm(embeddings_np, axis=1, keepdims=True)
+            results.extend(embeddings_np / norms)
+
+        return results
+
+    def extract_voiceprints(
+        self,
+        audio_path: str,
+        segments: List[Tuple[float, float]],
+        audio_hash: Optional[str] = None
+    ) -> List[Optional[np.ndarray]]:
+        """
+        1つの音声ファイルから複数セグメントの声紋をまとめて抽出
+
+        音声のデコード・リサンプリングは1回だけ行い、各セグメントは波形のビュー
+        として切り出して、1つのパディング済みバッチでエンコードします。
+        音声解析キャッシュが有効な場合、(音声のsha256, モデル, 時間範囲) が一致する
+        セグメントはキャッシュから返し、すべて揃っていればモデルも音声もロードしません。
+
+        Args:
+            audio_path: 音声ファイルのパス
+            segments: (start_time, end_time) のリスト（秒）
+            audio_hash: 音声ファイルのsha256（計算済みの場合）。Noneならここで計算
+
+        Returns:
+            segmentsと同じ順序の192次元声紋ベクトルのリスト。
+            短すぎるセグメントはNone
+        """
+        results: List[Optional[np.ndarray]] = [None] * len(segments)
+        pending = list(range(len(segments)))
+
+        cache = get_audio_cache()
+        if cache is not None and segments:
+            audio_hash = audio_hash or file_sha256(audio_path)
+            try:
+                cached = cache.get_voiceprints(audio_hash, self.cache_model_id, segments)
+            except Exception as e:
+                logger.warning(f"Voiceprint cache lookup failed: {e}")
+                cached = {}
+            pending = []
+            for index, (start_time, end_time) in enumerate(segments):
+                vector = cached.get((int(round(start_time * 1000)), int(round(end_time * 1000))))
+                if vector is not None:
+                    results[index] = vector
+                else:
+                    pending.append(index)
+            if not pending:
+                logger.info(f"Voiceprints served from cache: {len(segments)} segments")
+                return results
+
+        self._load_model()
+
+        try:
+            waveform, sr = self.load_waveform(audio_path)
+            total = waveform.shape[1]
+            min_samples = int(self.min_segment_seconds * sr)
+
+            slices: List[torch.Tensor] = []
+            positions: List[int] = []
+            for index in pending:
+                start_time, end_time = segments[index]
+                start_sample = max(0, int(start_time * sr))
+                end_sample = min(total, int(end_time * sr))
+                if end_sample - start_sample < min_samples:
+                    continue
+                slices.append(waveform[0, start_sample:end_sample])
+                positions.append(index)
+
+            if slices:
+                for index, embedding in zip(positions, self._encode_waveforms(slices)):
+                    results[index] = embedding
+
+                if cache is not None:
+                    try:
+                        cache.put_voiceprints(
+                            audio_hash,
+                            self.cache_model_id,
+                            [(*segments[index], results[index]) for index in positions]
+                        )
+                    except Exception as e:
+                        logger.warning(f"Failed to store voiceprints in cache: {e}")
+
+            logger.info(
+                f"Voiceprints extracted: {len(slices)}/{len(segments)} segments in one pass "
+                f"({len(segments) - len(pending)} from cache)"
+            )
+
+            return results
+
+        except Exception as e:
+            logger.error(f"Failed to extract voiceprints from {audio_path}: {e}")
+            raise
+
     def extract_voiceprint(
         self,
         audio_path: str,
@@ -94,16 +377,22 @@ class VoiceprintExtractor:
 
         try:
             # 音声をロード
-            waveform, sr = self._load_audio(audio_path)
-
-            # 時間範囲を指定された場合はトリミング
-            if start_time is not None or end_time is not None:
-                start_sample = int(start_time * sr) if start_time is not None else 0
-                end_sample = int(end_time * sr) if end_time is not None else waveform.shape[1]
-                waveform = waveform[:, start_sample:end_sample]
+            # 全体がキャッシュ済みならスライス（ビュー）、未ロードなら指定範囲だけをデコード
+            has_range = start_time is not None or end_time is not None
+            cached = self._cached_waveform(audio_path)
+            if has_range and cached is None:
+                waveform, sr = self._load_audio(audio_path, start_time, end_time)
+            else:
+                waveform, sr = cached if cached is not None else self.load_waveform(audio_path)
+
+                # 時間範囲を指定された場合はトリミング
+                if has_range:
+                    start_sample = int(start_time * sr) if start_time is not None else 0
+                    end_sample = int(end_time * sr) if end_time is not None else waveform.shape[1]
+                    waveform = waveform[:, start_sample:end_sample]
 
             # 声紋を抽出
-            with torch.no_grad():
+            with torch.inference_mode():
                 waveform = waveform.to(self.device)
                 embedding = self.model.encode_batch(waveform)
                 embedding_np = embedding.squeeze().cpu().numpy()
@@ -184,6 +473,9 @@ class VoiceprintExtractor:
         """
         音声ファイルの長さを取得
 
+        メタデータ（ヘッダー）から計算し、音声はデコードしません。
+        フレーム数がヘッダーに無い形式（一部のmp3など）のみ波形をロードします。
+
         Args:
             audio_path: 音声ファイルのパス
 
@@ -191,7 +483,11 @@ class VoiceprintExtractor:
             音声の長さ（秒）
         """
         try:
-            waveform, sr = self._load_audio(audio_path)
+            info = torchaudio.info(audio_path)
+            if info.num_frames > 0 and info.sample_rate > 0:
+                return int(info.num_frames / info.sample_rate)
+
+            waveform, sr = self.load_waveform(audio_path)
             duration_seconds = int(waveform.shape[1] / sr)
             return duration_seconds
         except Exception as e:
@@ -207,10 +503,18 @@ def get_voiceprint_extractor() -> VoiceprintExtractor:
     """
     VoiceprintExtractorのシングルトンインスタンスを取得
 
+    AUDIO_MODEL_SOCKET が設定されている場合はモデルサーバーへのプロキシを返します。
+
     Returns:
         VoiceprintExtractor instance
     """
     global _extractor_instance
     if _extractor_instance is None:
-        _extractor_instance = VoiceprintExtractor()
+        socket_path = os.environ.get("AUDIO_MODEL_SOCKET")
+        if socket_path:
+            # モデルサーバー（api.utils.model_server）に推論を委譲
+            from .model_server import RemoteVoiceprintExtractor
+            _extractor_instance = RemoteVoiceprintExtractor(socket_path)
+        else:
+            _extractor_instance = VoiceprintExtractor()
     return _extractor_instance
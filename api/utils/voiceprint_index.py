@@ -0,0 +1,160 @@
+"""
+声紋インデックス
+
+ユーザーごとに登録済みの声紋（is_active のもの）を N×192 の正規化済み行列として
+メモリに保持し、録音中の全話者 × 全登録声紋の類似度を1回の行列積で計算します。
+登録・削除・サンプル追加時に無効化し、複数ワーカー構成でも TTL 経過後に読み直します。
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+VOICEPRINT_INDEX_TTL = float(os.environ.get("VOICEPRINT_INDEX_TTL", "300"))
+# 重心更新で過去サンプルに与える重みの上限（声の経年変化に追従できるように）
+VOICEPRINT_MAX_SAMPLE_WEIGHT = int(os.environ.get("VOICEPRINT_MAX_SAMPLE_WEIGHT", "50"))
+
+
+def parse_embedding(value: Any) -> np.ndarray:
+    """Supabaseから返る声紋（リスト、またはpgvectorの "[...]" 文字列）をベクトルに変換"""
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def update_centroid(centroid: np.ndarray, sample_count: int, sample: np.ndarray) -> Tuple[np.ndarray, int]:
+    """
+    声紋の重心に新しいサンプルを加える（逐次平均）
+
+    過去サンプルの重みは VOICEPRINT_MAX_SAMPLE_WEIGHT で頭打ちにし、
+    それ以降は指数移動平均として振る舞います。
+
+    Args:
+        centroid: 現在の声紋（正規化済み）
+        sample_count: 現在のサンプル数
+        sample: 新しい声紋サンプル
+
+    Returns:
+        (更新後の正規化済み声紋, 更新後のサンプル数)
+    """
+    weight = min(max(sample_count, 1), VOICEPRINT_MAX_SAMPLE_WEIGHT)
+    sample = sample / np.linalg.norm(sample)
+    updated = (centroid * weight + sample) / (weight + 1)
+    updated = updated / np.linalg.norm(updated)
+    return updated.astype(np.float32), sample_count + 1
+
+
+class VoiceprintIndex:
+    """1ユーザー分の登録声紋（N×192の正規化済み行列）"""
+
+    def __init__(self, rows: List[Dict[str, Any]]):
+        self.ids: List[str] = [row["id"] for row in rows]
+        self.names: List[str] = [row.get("voiceprint_name", "") for row in rows]
+        self.sample_counts: List[int] = [row.get("sample_count") or 1 for row in rows]
+        if rows:
+            self.matrix = _normalize_rows(np.stack([parse_embedding(row["embedding"]) for row in rows]))
+        else:
+            self.matrix = np.zeros((0, 192), dtype=np.float32)
+        self.loaded_at = time.time()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def score(self, speaker_embeddings: Dict[str, np.ndarray]) -> Tuple[List[str], np.ndarray]:
+        """
+        各話者と全登録声紋の類似度を行列積で計算
+
+        Args:
+            speaker_embeddings: {speaker_id: 話者の平均声紋}
+
+        Returns:
+            (話者IDのリスト, 類似度行列 M×N)。類似度は compare_voiceprints と同じく 0.0-1.0
+        """
+        speaker_ids = list(speaker_embeddings)
+        if not speaker_ids or len(self) == 0:
+            return speaker_ids, np.zeros((len(speaker_ids), len(self)), dtype=np.float32)
+        speakers = _normalize_rows(np.stack([np.asarray(speaker_embeddings[s], dtype=np.float32) for s in speaker_ids]))
+        return speaker_ids, (speakers @ self.matrix.T + 1.0) / 2.0
+
+    def best_match(self, speaker_embeddings: Dict[str, np.ndarray]) -> Optional[Dict[str, Any]]:
+        """
+        最も類似度の高い (話者, 登録声紋) の組を返す
+
+        Args:
+            speaker_embeddings: {speaker_id: 話者の平均声紋}
+
+        Returns:
+            {"speaker_id", "voiceprint_id", "score", "speaker_scores"}。登録声紋が無ければNone
+        """
+        speaker_ids, scores = self.score(speaker_embeddings)
+        if scores.size == 0:
+            return None
+        speaker_row, voiceprint_col = np.unravel_index(int(np.argmax(scores)), scores.shape)
+        return {
+            "speaker_id": speaker_ids[speaker_row],
+            "voiceprint_id": self.ids[voiceprint_col],
+            "score": float(scores[speaker_row, voiceprint_col]),
+            "speaker_scores": dict(zip(speaker_ids, scores.max(axis=1).tolist()))
+        }
+
+
+class VoiceprintIndexStore:
+    """user_id → VoiceprintIndex のキャッシュ"""
+
+    def __init__(self, ttl: float = VOICEPRINT_INDEX_TTL):
+        self.ttl = ttl
+        self._indexes: Dict[str, VoiceprintIndex] = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str, loader: Callable[[str], List[Dict[str, Any]]]) -> VoiceprintIndex:
+        """
+        ユーザーの声紋インデックスを取得（未ロードまたはTTL切れなら loader で読み直す）
+
+        Args:
+            user_id: ユーザーID
+            loader: user_id から声紋の行（id, voiceprint_name, embedding, sample_count）を返す関数
+
+        Returns:
+            VoiceprintIndex
+        """
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None and time.time() - index.loaded_at < self.ttl:
+                return index
+
+        index = VoiceprintIndex(loader(user_id))
+        with self._lock:
+            self._indexes[user_id] = index
+        return index
+
+    def invalidate(self, user_id: str):
+        """登録・削除・更新後に呼び、次回アクセスで読み直させる"""
+        with self._lock:
+            self._indexes.pop(user_id, None)
+
+
+# シングルトンインスタンス
+_store_instance: Optional[VoiceprintIndexStore] = None
+
+
+def get_voiceprint_index_store() -> VoiceprintIndexStore:
+    """
+    VoiceprintIndexStoreのシングルトンインスタンスを取得
+
+    Returns:
+        VoiceprintIndexStore instance
+    """
+    global _store_instance
+    if _store_instance is None:
+        _store_instance = VoiceprintIndexStore()
+    return _store_instance
@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
 """
-参照例をSupabaseのknowledge_baseテーブルにインポートするスクリプト
+参照例をSupabaseのknowledge_baseテーブルに一括インポートするスクリプト
 
 使用方法:
     python scripts/import_references_to_supabase.py
+    python scripts/import_references_to_supabase.py data/comments.csv
+    python scripts/import_references_to_supabase.py data/comments.ndjson --no-auto-tag
 
 前提条件:
-    - .envファイルにSUPABASE_URLとSUPABASE_ANON_KEYが設定されていること
-    - Supabaseでknowledge_baseテーブルが作成されていること
-    - data/sample_comments.jsonが存在すること
+    - .envファイルにSUPABASE_URLとSUPABASE_ANON_KEY、OPENAI_API_KEYが設定されていること
+    - Supabaseでknowledge_baseテーブルが作成されていること（pgvector拡張済み）
+    - 入力ファイル（CSV / JSON / NDJSON、デフォルトはdata/sample_comments.json）が存在すること
+
+Embeddingはバッチ生成、タグ付けは並列実行し、チャンク単位でupsertします。
 """
 
-import json
+import argparse
 import os
 import sys
 from pathlib import Path
@@ -39,10 +43,24 @@ def load_env():
 load_env()
 
 from supabase import create_client, Client
+from api.utils.bulk_import import parse_references, import_references
 
 def main():
     """メイン処理"""
 
+    parser = argparse.ArgumentParser(description="参照例をknowledge_baseに一括インポート")
+    parser.add_argument(
+        "path",
+        nargs="?",
+        type=Path,
+        default=ROOT / "data" / "sample_comments.json",
+        help="入力ファイル（CSV / JSON / NDJSON、デフォルト: data/sample_comments.json）"
+    )
+    parser.add_argument("--format", choices=["csv", "json", "ndjson"], help="入力フォーマット（デフォルト: 拡張子から判定）")
+    parser.add_argument("--no-auto-tag", action="store_true", help="タグが空の行をLLMで自動タグ付けしない")
+    parser.add_argument("--overwrite", action="store_true", help="既存のreference_idを上書きする（デフォルトはスキップ）")
+    args = parser.parse_args()
+
     # 環境変数の確認
     supabase_url = os.environ.get("SUPABASE_URL")
     supabase_key = os.environ.get("SUPABASE_ANON_KEY")
@@ -60,77 +78,43 @@ def main():
         print(f"エラー: Supabaseへの接続に失敗しました: {e}")
         sys.exit(1)
 
-    # sample_comments.jsonの読み込み
-    sample_path = ROOT / "data" / "sample_comments.json"
-    if not sample_path.exists():
-        print(f"エラー: {sample_path} が見つかりません")
+    # 入力ファイルの読み込み
+    if not args.path.exists():
+        print(f"エラー: {args.path} が見つかりません")
         sys.exit(1)
 
     try:
-        with open(sample_path, "r", encoding="utf-8") as f:
-            samples = json.load(f)
-        print(f"✓ {sample_path} を読み込みました（{len(samples)}件）")
+        rows, parse_errors = parse_references(args.path.read_bytes(), filename=args.path.name, fmt=args.format)
+        print(f"✓ {args.path} を読み込みました（{len(rows)}件、解析エラー{len(parse_errors)}件）")
     except Exception as e:
-        print(f"エラー: JSONファイルの読み込みに失敗しました: {e}")
+        print(f"エラー: ファイルの読み込みに失敗しました: {e}")
         sys.exit(1)
 
-    # 既存データの確認
-    try:
-        response = supabase.table("knowledge_base").select("reference_id").execute()
-        existing_ids = set(item["reference_id"] for item in response.data)
-        print(f"✓ 既存の参照例: {len(existing_ids)}件")
-    except Exception as e:
-        print(f"警告: 既存データの確認に失敗しました: {e}")
-        existing_ids = set()
-
     # データのインポート
-    inserted_count = 0
-    skipped_count = 0
-    error_count = 0
-
-    for sample in samples:
-        reference_id = sample.get("id")
-
-        if not reference_id:
-            print(f"警告: IDがないデータをスキップしました: {sample}")
-            skipped_count += 1
-            continue
-
-        # 既に存在する場合はスキップ
-        if reference_id in existing_ids:
-            print(f"  スキップ: {reference_id}（既に存在）")
-            skipped_count += 1
-            continue
-
-        # データの挿入
-        try:
-            data = {
-                "reference_id": reference_id,
-                "type": sample.get("type"),
-                "text": sample.get("text"),
-                "tags": sample.get("tags", []),
-                "source": sample.get("source", "professor_examples")
-            }
-
-            supabase.table("knowledge_base").insert(data).execute()
-            print(f"  ✓ 挿入: {reference_id}")
-            inserted_count += 1
+    result = import_references(
+        supabase,
+        rows,
+        auto_tag=not args.no_auto_tag,
+        skip_existing=not args.overwrite
+    )
+    errors = sorted(parse_errors + result["errors"], key=lambda e: e["row"] or 0)
 
-        except Exception as e:
-            print(f"  ✗ エラー: {reference_id} - {e}")
-            error_count += 1
+    for error in errors:
+        print(f"  ✗ 行{error['row']} ({error['id'] or 'IDなし'}): {error['error']}")
 
     # 結果のサマリー
     print("\n" + "="*60)
     print("インポート完了")
     print("="*60)
-    print(f"  挿入: {inserted_count}件")
-    print(f"  スキップ: {skipped_count}件")
-    print(f"  エラー: {error_count}件")
-    print(f"  合計: {len(samples)}件")
+    print(f"  保存: {result['upserted']}件")
+    print(f"  自動タグ付け: {result['auto_tagged']}件")
+    print(f"  スキップ: {result['skipped']}件")
+    print(f"  エラー: {len(errors)}件")
+    print(f"  合計: {result['total'] + len(parse_errors)}件")
+    print(f"  所要時間: {result['elapsed_ms'] / 1000:.1f}秒")
     print("="*60)
 
-    if error_count > 0:
+    if errors:
         print("\n⚠️  エラーが発生したデータがあります。上記のログを確認してください。")
         sys.exit(1)
     else:
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Embeddingの量子化・次元削減による検索精度とサイズを計測するスクリプト
+
+参照例（data/sample_comments.json）とレポート（data/reports/*.txt）を文単位の
+段落に分けてEmbedding化し、float32・全次元を基準として、
+各設定での近傍検索の recall@k とベクトル1件あたりのサイズを比較します。
+
+使い方:
+    python tools/bench_embedding_precision.py
+    python tools/bench_embedding_precision.py --k 5 --dims 1024 512 256
+"""
+
+import argparse
+import glob
+import json
+import pathlib
+import sys
+import time
+from typing import List, Tuple
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from api.utils.embedding import (
+    _request_embeddings,
+    pack_embedding,
+    to_transport,
+    truncate_embedding,
+    unpack_embedding,
+)
+
+
+def load_corpus() -> List[str]:
+    """参照例とレポート段落を読み込む"""
+    texts = []
+    sample_path = ROOT / "data" / "sample_comments.json"
+    if sample_path.exists():
+        texts.extend(item["text"] for item in json.loads(sample_path.read_text(encoding="utf-8")))
+    for path in sorted(glob.glob(str(ROOT / "data" / "reports" / "*.txt"))):
+        paragraphs = pathlib.Path(path).read_text(encoding="utf-8").split("\n\n")
+        texts.extend(p.strip() for p in paragraphs if len(p.strip()) > 20)
+    return texts
+
+
+def cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    na = sum(x * x for x in a) ** 0.5
+    nb = sum(y * y for y in b) ** 0.5
+    return dot / (na * nb) if na and nb else 0.0
+
+
+def top_k(vectors: List[List[float]], query_index: int, k: int) -> List[int]:
+    scored = [
+        (cosine(vectors[query_index], v), i)
+        for i, v in enumerate(vectors) if i != query_index
+    ]
+    return [i for _, i in sorted(scored, reverse=True)[:k]]
+
+
+def recall_at_k(baseline: List[List[float]], candidate: List[List[float]], k: int) -> float:
+    """基準の上位k件のうち、候補の上位k件に含まれる割合の平均"""
+    total = 0.0
+    for q in range(len(baseline)):
+        expected = set(top_k(baseline, q, k))
+        actual = set(top_k(candidate, q, k))
+        total += len(expected & actual) / max(1, len(expected))
+    return total / max(1, len(baseline))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embeddingの量子化・次元削減ベンチマーク")
+    parser.add_argument("--k", type=int, default=5, help="recall@k の k (デフォルト: 5)")
+    parser.add_argument("--dims", type=int, nargs="*", default=[1024, 512, 256], help="切り詰める次元数")
+    args = parser.parse_args()
+
+    texts = load_corpus()
+    if len(texts) <= args.k:
+        print(f"❌ コーパスが小さすぎます（{len(texts)}件）")
+        sys.exit(1)
+
+    print(f"📚 コーパス: {len(texts)}件")
+    started = time.time()
+    baseline = _request_embeddings(texts)
+    print(f"⏱  Embedding生成: {time.time() - started:.1f}秒 ({len(baseline[0])}次元)\n")
+
+    configs: List[Tuple[str, int, str]] = [("float32", len(baseline[0]), "float32")]
+    for dtype in ("float16", "int8"):
+        configs.append((dtype, len(baseline[0]), dtype))
+    for dims in args.dims:
+        if dims < len(baseline[0]):
+            configs.append((f"float16/{dims}d", dims, "float16"))
+
+    base_json = len(json.dumps(baseline[0]))
+    print(f"{'設定':<16}{'recall@' + str(args.k):>10}{'保存(bytes)':>14}{'JSON(bytes)':>14}{'削減率':>8}")
+    for name, dims, dtype in configs:
+        vectors: List[List[float]] = []
+        for v in baseline:
+            v = truncate_embedding(v, dims)
+            vectors.append(unpack_embedding(pack_embedding(v, dtype), dtype))
+        stored = len(pack_embedding(vectors[0], dtype))
+        payload = len(json.dumps(to_transport(vectors[0], dtype)))
+        recall = recall_at_k(baseline, vectors, args.k)
+        print(f"{name:<16}{recall:>10.3f}{stored:>14}{payload:>14}{base_json / payload:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
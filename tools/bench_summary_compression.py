@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+要約前の抽出型圧縮（TextRank）の品質とレイテンシを比較するスクリプト
+
+data/reports/*.txt の各レポートを予算ごとに圧縮し、次を表示します。
+- 圧縮にかかった時間、トークン数（原文 → 抜粋）
+- 抜粋と原文のローカルEmbeddingのコサイン類似度（内容の網羅度の目安）
+- 原文の数値・固有名詞のうち抜粋に残った割合
+
+--llm を付けると、原文と抜粋それぞれで実際に要約を生成し（OPENAI_API_KEY が必要）、
+要約のレイテンシと、2つの要約どうしの類似度も比較します。
+
+使い方:
+    python tools/bench_summary_compression.py
+    python tools/bench_summary_compression.py --budgets 2000 4000 --llm
+"""
+
+import argparse
+import glob
+import os
+import pathlib
+import sys
+import time
+from typing import List, Optional, Tuple
+
+import requests
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from api.utils.local_embedding import LocalEmbeddingBackend
+from api.utils.prompt_registry import get_prompt_registry
+from api.utils.summary_compression import _ENTITY_OR_NUMBER, compress_for_summary
+
+
+def load_reports(pattern: str) -> List[Tuple[str, str]]:
+    reports = []
+    for path in sorted(glob.glob(pattern)):
+        text = pathlib.Path(path).read_text(encoding="utf-8").strip()
+        if text:
+            reports.append((pathlib.Path(path).name, text))
+    return reports
+
+
+def similarity(a: str, b: str) -> float:
+    backend = LocalEmbeddingBackend().fit([a, b])
+    vectors = backend.embed_matrix([a, b])
+    return float(vectors[0] @ vectors[1])
+
+
+def entity_recall(original: str, condensed: str) -> float:
+    entities = {m.group(0) for m in _ENTITY_OR_NUMBER.finditer(original) if not m.group(0).isdigit()}
+    if not entities:
+        return 1.0
+    return sum(1 for e in entities if e in condensed) / len(entities)
+
+
+def summarize(text: str, model: str) -> Tuple[Optional[str], float]:
+    """本番と同じプロンプトで要約を生成し、(要約, 秒) を返す"""
+    prompts = get_prompt_registry()
+    started = time.perf_counter()
+    resp = requests.post(
+        "https://api.openai.com/v1/chat/completions",
+        headers={"Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}", "Content-Type": "application/json"},
+        json={
+            "model": model,
+            "messages": [
+                {"role": "system", "content": prompts.get("summary_system").static_prefix},
+                {"role": "user", "content": prompts.render("summary_final", text=text)},
+            ],
+            "temperature": 0.3,
+            "max_tokens": 2000,
+        },
+        timeout=120,
+    )
+    resp.raise_for_status()
+    content = resp.json().get("choices", [{}])[0].get("message", {}).get("content")
+    return content, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="要約前の抽出型圧縮の品質とレイテンシ比較")
+    parser.add_argument("--reports", default=str(ROOT / "data" / "reports" / "*.txt"), help="レポートのglob")
+    parser.add_argument("--budgets", type=int, nargs="*", default=[1000, 2000, 4000], help="抜粋のトークン予算")
+    parser.add_argument("--llm", action="store_true", help="実際に要約を生成して比較する")
+    parser.add_argument("--model", default=os.environ.get("SUMMARY_MODEL", "gpt-4o"), help="要約に使うモデル")
+    args = parser.parse_args()
+
+    reports = load_reports(args.reports)
+    if not reports:
+        print(f"❌ レポートが見つかりません: {args.reports}")
+        sys.exit(1)
+    if args.llm and not os.environ.get("OPENAI_API_KEY"):
+        print("❌ --llm には OPENAI_API_KEY が必要です")
+        sys.exit(1)
+
+    print(f"{'レポート':<28}{'予算':>6}{'原文':>8}{'抜粋':>8}{'文':>10}{'圧縮ms':>8}{'類似度':>8}{'固有名詞':>8}"
+          + (f"{'要約秒(原文→抜粋)':>20}{'要約類似度':>10}" if args.llm else ""))
+    for name, text in reports:
+        full_summary = None
+        if args.llm:
+            full_summary, full_seconds = summarize(text, args.model)
+        for budget in args.budgets:
+            started = time.perf_counter()
+            result = compress_for_summary(text, budget, model=args.model)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            line = (
+                f"{name[:27]:<28}{budget:>6}{result['original_tokens']:>8}{result['tokens']:>8}"
+                f"{result['kept_sentences']:>5}/{result['total_sentences']:<4}{elapsed_ms:>8.0f}"
+                f"{similarity(text, result['text']):>8.3f}{entity_recall(text, result['text']):>8.0%}"
+            )
+            if args.llm:
+                if result["compressed"]:
+                    summary, seconds = summarize(result["text"], args.model)
+                    line += f"{full_seconds:>11.1f} → {seconds:<6.1f}{similarity(full_summary or '', summary or ''):>10.3f}"
+                else:
+                    line += f"{'（圧縮なし）':>20}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
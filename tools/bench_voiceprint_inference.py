@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+声紋抽出のCPU推論モードを比較するスクリプト
+
+音声ファイルを一定長のセグメントに区切り、推論モード（eager / torchscript）と
+スレッド数ごとに声紋をまとめて抽出して、1秒あたりの声紋数と、
+float32（eager）を基準としたコサイン類似度のずれを表示します。
+
+使い方:
+    python tools/bench_voiceprint_inference.py data/audio/lecture.wav
+    python tools/bench_voiceprint_inference.py lecture.wav --segment-seconds 3 --threads 1 2 4
+"""
+
+import argparse
+import pathlib
+import sys
+import time
+from typing import List, Tuple
+
+import numpy as np
+import torch
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from api.utils.voiceprint_extractor import INFERENCE_MODES, VoiceprintExtractor
+
+
+def make_segments(duration: float, segment_seconds: float, limit: int) -> List[Tuple[float, float]]:
+    segments = []
+    start = 0.0
+    while start + segment_seconds <= duration and len(segments) < limit:
+        segments.append((start, start + segment_seconds))
+        start += segment_seconds
+    return segments
+
+
+def run(extractor: VoiceprintExtractor, audio_path: str, segments: List[Tuple[float, float]]) -> Tuple[np.ndarray, float]:
+    """ウォームアップ後に全セグメントを抽出し、(声紋行列, 経過秒) を返す"""
+    extractor.warm_up()
+    waveform, sr = extractor.load_waveform(audio_path)  # デコード時間は計測から除く
+    slices = [waveform[0, int(s * sr):int(e * sr)] for s, e in segments]
+    started = time.perf_counter()
+    vectors = extractor._encode_waveforms(slices)
+    elapsed = time.perf_counter() - started
+    return np.stack(vectors), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="声紋抽出のCPU推論モード比較")
+    parser.add_argument("audio", help="音声ファイル")
+    parser.add_argument("--segment-seconds", type=float, default=3.0, help="セグメント長（秒）")
+    parser.add_argument("--max-segments", type=int, default=200, help="最大セグメント数")
+    parser.add_argument("--modes", nargs="*", default=list(INFERENCE_MODES), choices=INFERENCE_MODES, help="比較する推論モード")
+    parser.add_argument("--threads", type=int, nargs="*", default=[1, 2, 4], help="比較するスレッド数")
+    args = parser.parse_args()
+
+    baseline_extractor = VoiceprintExtractor(inference_mode="eager")
+    duration = baseline_extractor.get_audio_duration(args.audio)
+    segments = make_segments(duration, args.segment_seconds, args.max_segments)
+    if not segments:
+        print(f"❌ 音声が短すぎます（{duration}秒）")
+        sys.exit(1)
+
+    print(f"🎧 {args.audio}: {duration}秒, {len(segments)}セグメント × {args.segment_seconds}秒\n")
+    baseline, _ = run(baseline_extractor, args.audio, segments)
+
+    print(f"{'モード':<14}{'スレッド':>8}{'声紋/秒':>10}{'cos平均':>10}{'cos最小':>10}")
+    for mode in args.modes:
+        for threads in args.threads:
+            # torch.set_num_threads はプロセス全体の設定なので、計測ごとに設定し直す
+            torch.set_num_threads(threads)
+            extractor = VoiceprintExtractor(inference_mode=mode, num_threads=threads)
+            vectors, elapsed = run(extractor, args.audio, segments)
+            cosine = np.sum(vectors * baseline, axis=1)
+            label = extractor.inference_mode if extractor.inference_mode == mode else f"{mode}→eager"
+            print(f"{label:<14}{threads:>8}{len(segments) / elapsed:>10.1f}{cosine.mean():>10.4f}{cosine.min():>10.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+OpenAI Batch API クライアントの動作確認（ネットワーク・APIキー不要、CI用）
+
+tools/openai_batch_standin.py のスタンドインサーバーを同じプロセスで起動し、
+api/utils/openai_batch.py の手順（アップロード → バッチ作成 → 待機 → 結果の取り込み）を
+通しで実行して、次を確認します。
+
+- 最初のアップロードが500エラーでも、リトライで同じ内容が送られてバッチを作成できる
+- 全リクエストの結果が custom_id ごとに返り、500エラーの行は error として取り込まれる
+- 上限を超える入力は複数のバッチに分割される
+- キャンセルしたバッチは cancelled で終了する
+
+使い方:
+    python tools/check_openai_batch.py
+
+失敗した確認があれば終了コード1で終了します。
+"""
+
+import pathlib
+import sys
+import tempfile
+import threading
+from typing import List
+
+from openai_batch_standin import serve
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from api.utils.openai_batch import OpenAIBatchClient, batch_line, split_batches
+
+REQUESTS = 6
+FAIL_EVERY = 3
+
+
+def chat_body(index: int) -> dict:
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [{"role": "user", "content": f"レポート{index}へのコメントを書いてください。"}],
+        "max_tokens": 50,
+    }
+
+
+def main():
+    server = serve(port=0, fail_every=FAIL_EVERY, fail_uploads=1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    print(f"🧪 スタンドイン: {base_url}")
+
+    client = OpenAIBatchClient("test", base_url=base_url, timeout=10)
+    failures: List[str] = []
+
+    def check(condition: bool, message: str):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    lines = [batch_line(f"req-{i}", chat_body(i)) for i in range(1, REQUESTS + 1)]
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            batch = client.submit(lines, pathlib.Path(tmp) / "input.jsonl", metadata={"job": "check"})
+            check(batch["request_counts"]["total"] == REQUESTS, f"アップロードの失敗をリトライしてバッチを作成（{batch['request_counts']['total']}件）")
+            batch = client.wait(batch["id"], poll_interval=0.05, timeout=10)
+            check(batch["status"] == "completed", f"バッチが完了（status={batch['status']}）")
+            results = client.results(batch)
+            check(sorted(results) == sorted(line["custom_id"] for line in lines), f"全リクエストの結果を取得（{len(results)}件）")
+            errors = [custom_id for custom_id, result in results.items() if result["error"]]
+            check(len(errors) == REQUESTS // FAIL_EVERY, f"500エラーの行を error として取り込み（{len(errors)}件）")
+            check(all(r["content"] for r in results.values() if not r["error"]), "成功した行に本文がある")
+
+            cancelled = client.submit(lines[:1], pathlib.Path(tmp) / "cancel.jsonl")
+            client.cancel(cancelled["id"])
+            cancelled = client.wait(cancelled["id"], poll_interval=0.05, timeout=10)
+            check(cancelled["status"] == "cancelled", f"キャンセルしたバッチが終了（status={cancelled['status']}）")
+        except Exception as e:
+            check(False, f"例外: {e.__class__.__name__}: {e}")
+
+    chunks = split_batches(lines, max_requests=4)
+    check([len(c) for c in chunks] == [4, 2], f"上限で分割（{[len(c) for c in chunks]}）")
+
+    server.shutdown()
+    if failures:
+        print(f"\n❌ {len(failures)}件の確認に失敗しました")
+        sys.exit(1)
+    print("\n✅ すべての確認に成功しました")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+OpenAI Batch API のローカルのスタンドインサーバー（ネットワークの無いCI・動作確認用）
+
+tools/run_batch_api.py と api/utils/openai_batch.py が使う Files API と Batches API の
+エンドポイントだけを、標準ライブラリのHTTPサーバーで再現します。
+
+- POST /v1/files                  入力ファイルのアップロード（multipart/form-data）
+- GET  /v1/files/{id}/content     ファイルの内容
+- POST /v1/batches                バッチの作成
+- GET  /v1/batches/{id}           バッチの状態（取得するたびに validating → in_progress → completed と進む）
+- POST /v1/batches/{id}/cancel    キャンセル
+
+Chat Completionsの応答は、モデル名とプロンプトの冒頭から決まる固定の文章です。
+--fail-every N を付けると N 件ごとに1件を500エラーにして、失敗時の取り込みを試せます。
+--fail-uploads N を付けると最初の N 回のアップロードを（本文を読んだうえで）500エラーにして、
+アップロードのリトライを試せます。tools/check_openai_batch.py がこのサーバーで一連の手順を確認します。
+
+使い方:
+    python tools/openai_batch_standin.py --port 8199
+    OPENAI_API_KEY=test python tools/run_batch_api.py --openai-base-url http://127.0.0.1:8199/v1 --poll-interval 1
+"""
+
+import argparse
+import json
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+# 完了までに必要な状態取得の回数
+POLLS_TO_COMPLETE = 2
+
+
+class StandinState:
+    """アップロードされたファイルとバッチ（メモリ上）"""
+
+    def __init__(self, fail_every: int = 0, fail_uploads: int = 0):
+        self.fail_every = fail_every
+        self.fail_uploads = fail_uploads
+        self.files: Dict[str, Dict] = {}
+        self.batches: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+
+    def take_upload_failure(self) -> bool:
+        """--fail-uploads の残り回数があれば1回分消費してTrue"""
+        with self.lock:
+            if self.fail_uploads > 0:
+                self.fail_uploads -= 1
+                return True
+            return False
+
+    def add_file(self, filename: str, content: bytes, purpose: str) -> Dict:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        meta = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+        }
+        with self.lock:
+            self.files[file_id] = {"meta": meta, "content": content}
+        return meta
+
+    def create_batch(self, payload: Dict) -> Tuple[int, Dict]:
+        input_file_id = payload.get("input_file_id")
+        if input_file_id not in self.files:
+            return 404, _error(f"No such File object: {input_file_id}")
+        if payload.get("endpoint") != "/v1/chat/completions":
+            return 400, _error(f"Unsupported endpoint: {payload.get('endpoint')}")
+
+        lines = [l for l in self.files[input_file_id]["content"].decode("utf-8").splitlines() if l.strip()]
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex[:24]}",
+            "object": "batch",
+            "endpoint": payload["endpoint"],
+            "input_file_id": input_file_id,
+            "completion_window": payload.get("completion_window", "24h"),
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "errors": None,
+            "created_at": int(time.time()),
+            "metadata": payload.get("metadata"),
+            "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+            "_polls": 0,
+        }
+        with self.lock:
+            self.batches[batch["id"]] = batch
+        return 200, _public(batch)
+
+    def poll_batch(self, batch_id: str) -> Optional[Dict]:
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return None
+            if batch["status"] in ("validating", "in_progress"):
+                batch["_polls"] += 1
+                if batch["_polls"] >= POLLS_TO_COMPLETE:
+                    self._complete(batch)
+                else:
+                    batch["status"] = "in_progress"
+            return _public(batch)
+
+    def cancel_batch(self, batch_id: str) -> Optional[Dict]:
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return None
+            if batch["status"] not in ("completed", "failed", "expired", "cancelled"):
+                batch["status"] = "cancelled"
+            return _public(batch)
+
+    def _complete(self, batch: Dict):
+        """入力の各行を処理して出力ファイルとエラーファイルを作る（lock内で呼ぶ）"""
+        outputs, errors = [], []
+        content = self.files[batch["input_file_id"]]["content"].decode("utf-8")
+        for index, raw in enumerate(l for l in content.splitlines() if l.strip()):
+            request = json.loads(raw)
+            custom_id = request.get("custom_id")
+            body = request.get("body") or {}
+            if not body.get("messages"):
+                errors.append({"id": f"batch_req_{index}", "custom_id": custom_id, "response": None,
+                               "error": {"code": "invalid_request", "message": "messages is required"}})
+                continue
+            if self.fail_every and (index + 1) % self.fail_every == 0:
+                outputs.append({"id": f"batch_req_{index}", "custom_id": custom_id, "error": None,
+                                "response": {"status_code": 500, "request_id": uuid.uuid4().hex,
+                                             "body": _error("The server had an error processing your request.")}})
+                continue
+            outputs.append({"id": f"batch_req_{index}", "custom_id": custom_id, "error": None,
+                            "response": {"status_code": 200, "request_id": uuid.uuid4().hex,
+                                         "body": _completion(body)}})
+
+        failed = len(errors) + sum(1 for o in outputs if o["response"]["status_code"] != 200)
+        batch["request_counts"]["completed"] = batch["request_counts"]["total"] - failed
+        batch["request_counts"]["failed"] = failed
+        for key, rows in (("output_file_id", outputs), ("error_file_id", errors)):
+            if rows:
+                data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows).encode("utf-8")
+                file_id = f"file-{uuid.uuid4().hex[:24]}"
+                self.files[file_id] = {"meta": {"id": file_id, "object": "file", "bytes": len(data),
+                                                "purpose": "batch_output", "filename": f"{key}.jsonl"},
+                                       "content": data}
+                batch[key] = file_id
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+
+
+def _public(batch: Dict) -> Dict:
+    return {k: v for k, v in batch.items() if not k.startswith("_")}
+
+
+def _error(message: str) -> Dict:
+    return {"error": {"message": message, "type": "invalid_request_error"}}
+
+
+def _completion(body: Dict) -> Dict:
+    """決まった形の Chat Completions 応答（要約プロンプトには 1️⃣ 形式の見出しを付ける）"""
+    messages = body["messages"]
+    prompt = messages[-1].get("content", "")
+    head = " ".join(prompt.split())[:40]
+    if "1️⃣" in "".join(m.get("content", "") for m in messages):
+        text = f"スタンドインの要約です（{head}）\n\n1️⃣ 主要な論点\n\n本文の要点です。\n\n2️⃣ 実践的な視点\n\n実践の示唆です。"
+    else:
+        text = f"スタンドインのコメントです（{body.get('model')}）。{head}"
+    prompt_tokens = len(prompt) // 2
+    completion_tokens = len(text) // 2
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+def _parse_multipart(content_type: str, body: bytes) -> Dict[str, Tuple[Optional[str], bytes]]:
+    """multipart/form-data を name → (filename, 内容) にする"""
+    message = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body
+    )
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        fields[name] = (part.get_filename(), part.get_payload(decode=True) or b"")
+    return fields
+
+
+def make_handler(state: StandinState):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status: int, payload, content_type: str = "application/json"):
+            data = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        def do_GET(self):
+            parts = self.path.strip("/").split("/")
+            if parts[:2] == ["v1", "batches"] and len(parts) == 3:
+                batch = state.poll_batch(parts[2])
+                return self._send(200, batch) if batch else self._send(404, _error("No such Batch"))
+            if parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content":
+                stored = state.files.get(parts[2])
+                if stored is None:
+                    return self._send(404, _error("No such File object"))
+                return self._send(200, stored["content"], "application/octet-stream")
+            self._send(404, _error(f"Unknown path: {self.path}"))
+
+        def do_POST(self):
+            parts = self.path.strip("/").split("/")
+            body = self._body()
+            if parts == ["v1", "files"]:
+                fields = _parse_multipart(self.headers.get("Content-Type", ""), body)
+                if "file" not in fields:
+                    return self._send(400, _error("file is required"))
+                if state.take_upload_failure():
+                    return self._send(500, _error("The server had an error while processing the upload."))
+                filename, content = fields["file"]
+                if not content.strip():
+                    return self._send(400, _error("The uploaded file is empty."))
+                purpose = fields.get("purpose", (None, b""))[1].decode("utf-8")
+                return self._send(200, state.add_file(filename or "upload.jsonl", content, purpose))
+            if parts == ["v1", "batches"]:
+                status, payload = state.create_batch(json.loads(body or b"{}"))
+                return self._send(status, payload)
+            if parts[:2] == ["v1", "batches"] and len(parts) == 4 and parts[3] == "cancel":
+                batch = state.cancel_batch(parts[2])
+                return self._send(200, batch) if batch else self._send(404, _error("No such Batch"))
+            self._send(404, _error(f"Unknown path: {self.path}"))
+
+    return Handler
+
+
+def serve(host: str = "127.0.0.1", port: int = 8199, fail_every: int = 0, fail_uploads: int = 0) -> ThreadingHTTPServer:
+    """サーバーを作成する（serve_forever() は呼び出し側で実行。port=0 なら空いているポート）"""
+    return ThreadingHTTPServer((host, port), make_handler(StandinState(fail_every, fail_uploads)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI Batch API のローカルのスタンドインサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8199)
+    parser.add_argument("--fail-every", type=int, default=0, help="N件ごとに1件を500エラーにする（0は無効）")
+    parser.add_argument("--fail-uploads", type=int, default=0, help="最初のN回のアップロードを500エラーにする")
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.fail_every, args.fail_uploads)
+    print(f"🧪 Batch API スタンドイン: http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+実レポートを OpenAI Batch API で一括生成するスクリプト（期末レポートの夜間バッチ用）
+
+tools/run_batch_eval.py と同じレポートを同じCSV形式で出力しますが、LLMを同期呼び出しせず、
+全レポートのコメント・要約のリクエストを Batch API にまとめて送ります（料金が半額、
+通常のレート制限も消費しない）。結果は最大24時間後に返ります。
+
+1. 準備: レポートごとに API の /generate_direct/batch/compile で /generate_direct と同じ
+   リクエスト本文（参照例の検索、Rubric、プロンプトの組み立てまで）を受け取る
+2. 送信: JSONL にまとめてアップロードし、バッチを作成する（上限を超える場合は分割）
+3. 待機: バッチが終了するまでポーリングする
+4. 取り込み: 結果を /generate_direct/batch/assemble に渡して /generate_direct と同じ形式に戻し、
+   data/eval/generated_YYYYMMDD_HHMMSS.csv に書き出す
+
+途中の状態はジョブのディレクトリ（data/eval/batch_YYYYMMDD_HHMMSS/）の manifest.json に
+保存するので、スクリプトを止めても --resume で待機から再開できます。
+
+使い方:
+    # 実レポート（TXT）を data/reports/ に配置
+    python tools/run_batch_api.py --api http://127.0.0.1:8010
+
+    # 中断したジョブを再開
+    python tools/run_batch_api.py --api http://127.0.0.1:8010 --resume data/eval/batch_20250120_230000
+
+    # ネットワークの無い環境での動作確認（ローカルのスタンドインサーバー）
+    python tools/openai_batch_standin.py --port 8199 &
+    OPENAI_API_KEY=test python tools/run_batch_api.py --openai-base-url http://127.0.0.1:8199/v1 --poll-interval 1
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import pathlib
+import sys
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import requests
+
+from run_batch_eval import print_next_steps, result_row, write_results_csv
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from api.utils.openai_batch import (
+    BATCH_POLL_INTERVAL,
+    OPENAI_BASE_URL,
+    BatchError,
+    OpenAIBatchClient,
+    batch_line,
+    split_batches,
+)
+
+MANIFEST = "manifest.json"
+RESULTS = "results.json"
+# 1レポートあたりのリクエスト（custom_id の接尾辞）
+KINDS = ("comment", "summary")
+
+
+def text_sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def load_manifest(job_dir: pathlib.Path) -> Dict:
+    with open(job_dir / MANIFEST, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(job_dir: pathlib.Path, manifest: Dict):
+    tmp = job_dir / f"{MANIFEST}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    tmp.replace(job_dir / MANIFEST)
+
+
+def compile_reports(api_url: str, report_files: List[str], report_type: str) -> List[Dict]:
+    """レポートごとに /generate_direct と同じリクエスト本文を組み立てる"""
+    url = f"{api_url.rstrip('/')}/generate_direct/batch/compile"
+    entries = []
+    for i, report_file in enumerate(report_files, 1):
+        report_path = pathlib.Path(report_file)
+        print(f"[{i}/{len(report_files)}] 準備中: {report_path.stem}...", end=" ", flush=True)
+        report_text = report_path.read_text(encoding="utf-8").strip()
+        if not report_text:
+            print("⚠️  空ファイル（スキップ）")
+            continue
+        try:
+            response = requests.post(url, json={"text": report_text, "type": report_type}, timeout=60)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            print(f"❌ APIエラー: {e}")
+            continue
+        entries.append({
+            "id": f"{i:05d}",
+            "report_file": str(report_path.resolve()),
+            "sha256": text_sha256(report_text),
+            "type": report_type,
+            "compiled": response.json(),
+        })
+        print("✅")
+    return entries
+
+
+def batch_lines(entries: List[Dict]) -> List[Dict]:
+    return [
+        batch_line(f"{entry['id']}-{kind}", entry["compiled"]["requests"][kind])
+        for entry in entries
+        for kind in KINDS
+    ]
+
+
+def submit_batches(client: OpenAIBatchClient, job_dir: pathlib.Path, manifest: Dict):
+    """未送信のバッチを送信する（送信するたびに manifest に記録）"""
+    chunks = split_batches(batch_lines(manifest["entries"]))
+    manifest["batch_count"] = len(chunks)
+    for n, chunk in enumerate(chunks, 1):
+        if n <= len(manifest["batches"]):
+            continue
+        batch = client.submit(chunk, job_dir / f"input_{n:03d}.jsonl", metadata={"job": job_dir.name})
+        manifest["batches"].append(batch["id"])
+        save_manifest(job_dir, manifest)
+        print(f"📤 バッチ {n}/{len(chunks)} を送信しました: {batch['id']}（{len(chunk)}件）")
+
+
+def wait_batches(client: OpenAIBatchClient, manifest: Dict, poll_interval: float) -> Dict[str, Dict]:
+    """すべてのバッチの終了を待ち、custom_id → 結果 を返す"""
+    results: Dict[str, Dict] = {}
+
+    def show(batch: Dict):
+        counts = batch.get("request_counts") or {}
+        print(f"⏳ {batch['id']}: {batch.get('status')} "
+              f"（完了 {counts.get('completed', 0)} / 失敗 {counts.get('failed', 0)} / 全 {counts.get('total', 0)}）")
+
+    for batch_id in manifest["batches"]:
+        batch = client.wait(batch_id, poll_interval=poll_interval, on_update=show)
+        if batch.get("status") != "completed":
+            print(f"⚠️  {batch_id} は {batch.get('status')} で終了しました（完了分のみ取り込みます）")
+        results.update(client.results(batch))
+    return results
+
+
+def ingest(api_url: str, manifest: Dict, results: Dict[str, Dict]) -> List[Dict]:
+    """Batch APIの結果を /generate_direct と同じ形式に戻し、CSVの行にする"""
+    url = f"{api_url.rstrip('/')}/generate_direct/batch/assemble"
+    rows = []
+    for entry in manifest["entries"]:
+        report_path = pathlib.Path(entry["report_file"])
+        report_text = report_path.read_text(encoding="utf-8").strip()
+        if text_sha256(report_text) != entry["sha256"]:
+            print(f"⚠️  {report_path.name}: 準備後にレポートが変更されています（準備時の生成結果を取り込みます）")
+
+        comment = results.get(f"{entry['id']}-comment") or {"error": "結果がありません（バッチの期限切れ・キャンセル）"}
+        summary = results.get(f"{entry['id']}-summary") or {"error": "結果がありません（バッチの期限切れ・キャンセル）"}
+        compiled = entry["compiled"]
+        try:
+            response = requests.post(url, json={
+                "text": report_text,
+                "type": entry["type"],
+                "used_refs": compiled.get("used_refs", []),
+                "prompt_tokens": compiled.get("prompt_tokens"),
+                "comment": comment.get("content"),
+                "comment_error": comment.get("error"),
+                "summary": summary.get("content"),
+                "summary_error": summary.get("error"),
+            }, timeout=60)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            print(f"❌ {report_path.name}: 取り込みに失敗しました: {e}")
+            continue
+        rows.append(result_row(report_path, report_text, response.json()))
+    return rows
+
+
+def run_batch_api(
+    api_url: str,
+    client: OpenAIBatchClient,
+    reports_dir: Optional[pathlib.Path] = None,
+    output_dir: Optional[pathlib.Path] = None,
+    report_type: str = "reflection",
+    resume: Optional[pathlib.Path] = None,
+    poll_interval: float = BATCH_POLL_INTERVAL
+) -> pathlib.Path:
+    """準備 → 送信 → 待機 → 取り込みを行い、CSVのパスを返す"""
+    if reports_dir is None:
+        reports_dir = ROOT / "data" / "reports"
+    if output_dir is None:
+        output_dir = ROOT / "data" / "eval"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    if resume:
+        job_dir = resume
+        manifest = load_manifest(job_dir)
+        print(f"🔁 ジョブを再開します: {job_dir}（送信済み {len(manifest['batches'])}バッチ）")
+    else:
+        report_files = sorted(glob.glob(str(reports_dir / "*.txt")))
+        if not report_files:
+            print(f"❌ レポートファイルが見つかりません: {reports_dir}")
+            print("   data/reports/*.txt に実レポートを配置してください")
+            sys.exit(1)
+        print(f"📁 レポートファイル: {len(report_files)}件見つかりました")
+
+        job_dir = output_dir / f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        job_dir.mkdir(parents=True, exist_ok=True)
+        manifest = {
+            "created_at": datetime.now().isoformat(),
+            "entries": compile_reports(api_url, report_files, report_type),
+            "batches": [],
+        }
+        if not manifest["entries"]:
+            print("\n❌ 準備できたレポートがありません")
+            sys.exit(1)
+        save_manifest(job_dir, manifest)
+        print(f"💾 ジョブ: {job_dir}\n")
+
+    results_path = job_dir / RESULTS
+    if results_path.exists():
+        with open(results_path, "r", encoding="utf-8") as f:
+            results = json.load(f)
+    else:
+        submit_batches(client, job_dir, manifest)
+        results = wait_batches(client, manifest, poll_interval)
+        with open(results_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False)
+
+    failed = sum(1 for r in results.values() if r.get("error"))
+    print(f"\n📥 結果: {len(results)}件（失敗 {failed}件、失敗分は定型のコメント・要約になります）")
+    rows = ingest(api_url, manifest, results)
+    if not rows:
+        print("\n❌ 生成結果がありません")
+        sys.exit(1)
+    return write_results_csv(rows, output_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="実レポートを OpenAI Batch API で一括生成")
+    parser.add_argument(
+        "--api",
+        default="http://127.0.0.1:8010",
+        help="APIベースURL (デフォルト: http://127.0.0.1:8010)"
+    )
+    parser.add_argument(
+        "--reports-dir",
+        type=pathlib.Path,
+        help="レポートファイルのディレクトリ (デフォルト: data/reports)"
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=pathlib.Path,
+        help="出力ディレクトリ (デフォルト: data/eval)"
+    )
+    parser.add_argument("--type", default="reflection", choices=["reflection", "final"], help="レポートタイプ")
+    parser.add_argument("--resume", type=pathlib.Path, help="再開するジョブのディレクトリ")
+    parser.add_argument("--poll-interval", type=float, default=BATCH_POLL_INTERVAL, help="ポーリング間隔（秒）")
+    parser.add_argument("--openai-base-url", default=OPENAI_BASE_URL, help="OpenAI APIのベースURL（スタンドインサーバー用）")
+
+    args = parser.parse_args()
+
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        print("❌ OPENAI_API_KEY が必要です")
+        sys.exit(1)
+
+    # API疎通確認
+    try:
+        health_url = f"{args.api.rstrip('/')}/health"
+        response = requests.get(health_url, timeout=5)
+        if response.status_code != 200:
+            print(f"❌ APIが応答しません: {health_url}")
+            sys.exit(1)
+    except requests.exceptions.RequestException as e:
+        print(f"❌ APIに接続できません: {health_url}")
+        print(f"   エラー: {e}")
+        print("   APIが起動しているか確認してください")
+        sys.exit(1)
+
+    client = OpenAIBatchClient(api_key, base_url=args.openai_base_url)
+    try:
+        output_file = run_batch_api(
+            args.api, client, args.reports_dir, args.output_dir, args.type, args.resume, args.poll_interval
+        )
+    except BatchError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+    print("\n✅ 完了")
+    print(f"📄 {output_file}")
+    print_next_steps(output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -23,6 +23,14 @@ import requests
 
 ROOT = pathlib.Path(__file__).resolve().parents[1]
 
+FIELDNAMES = [
+    "report_file", "report_name", "report_length",
+    "ai_comment", "rubric_理解度", "rubric_論理性", "rubric_独自性", 
+    "rubric_実践性", "rubric_表現力", "rubric_total",
+    "llm_used", "llm_error", "prompt_version", "model_version", "generated_at",
+    "summary", "summary_llm_used", "summary_error"
+]
+
 
 def generate_comment(api_url: str, text: str, report_type: str = "reflection") -> Optional[Dict]:
     """APIを呼び出してコメント生成"""
@@ -41,6 +49,49 @@ def generate_comment(api_url: str, text: str, report_type: str = "reflection") -
         return None
 
 
+def result_row(report_path: pathlib.Path, report_text: str, result: Dict) -> Dict:
+    """/generate_direct の応答をCSVの1行にする（tools/run_batch_api.py と共通）"""
+    rubric = result.get("rubric", {})
+    return {
+        "report_file": report_path.name,
+        "report_name": report_path.stem,
+        "report_length": len(report_text),
+        "ai_comment": result.get("ai_comment", ""),
+        "rubric_理解度": rubric.get("理解度", 0),
+        "rubric_論理性": rubric.get("論理性", 0),
+        "rubric_独自性": rubric.get("独自性", 0),
+        "rubric_実践性": rubric.get("実践性", 0),
+        "rubric_表現力": rubric.get("表現力", 0),
+        "rubric_total": sum(rubric.values()),
+        "llm_used": result.get("llm_used", False),
+        "llm_error": result.get("llm_error", ""),
+        "prompt_version": result.get("prompt_version", ""),
+        "model_version": result.get("model_version", ""),
+        "generated_at": datetime.now().isoformat(),
+        "summary": (result.get("summary") or {}).get("formatted", ""),
+        "summary_llm_used": result.get("summary_llm_used", False),
+        "summary_error": result.get("summary_error", ""),
+    }
+
+
+def write_results_csv(results: List[Dict], output_dir: pathlib.Path) -> pathlib.Path:
+    """結果を data/eval/generated_YYYYMMDD_HHMMSS.csv に書き出す"""
+    output_file = output_dir / f"generated_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    
+    with open(output_file, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(results)
+    return output_file
+
+
+def print_next_steps(output_file: pathlib.Path):
+    print("\n次のステップ:")
+    print(f"  1. 生成結果を確認: {output_file}")
+    print(f"  2. 教授による手動評価: data/evaluation_sheet_template.csv をコピーして記入")
+    print(f"  3. 差分分析: python scripts/compare_rubric.py --generated {output_file} --human <評価CSV>")
+
+
 def run_batch_eval(api_url: str, reports_dir: Optional[pathlib.Path] = None, output_dir: Optional[pathlib.Path] = None):
     """バッチ生成を実行"""
     
@@ -91,23 +142,7 @@ def run_batch_eval(api_url: str, reports_dir: Optional[pathlib.Path] = None, out
                 continue
             
             # 結果を保存
-            results.append({
-                "report_file": report_path.name,
-                "report_name": report_name,
-                "report_length": len(report_text),
-                "ai_comment": result.get("ai_comment", ""),
-                "rubric_理解度": result.get("rubric", {}).get("理解度", 0),
-                "rubric_論理性": result.get("rubric", {}).get("論理性", 0),
-                "rubric_独自性": result.get("rubric", {}).get("独自性", 0),
-                "rubric_実践性": result.get("rubric", {}).get("実践性", 0),
-                "rubric_表現力": result.get("rubric", {}).get("表現力", 0),
-                "rubric_total": sum(result.get("rubric", {}).values()),
-                "llm_used": result.get("llm_used", False),
-                "llm_error": result.get("llm_error", ""),
-                "prompt_version": result.get("prompt_version", ""),
-                "model_version": result.get("model_version", ""),
-                "generated_at": datetime.now().isoformat(),
-            })
+            results.append(result_row(report_path, report_text, result))
             
             print("✅ 完了")
             time.sleep(0.5)  # API負荷軽減
@@ -121,26 +156,11 @@ def run_batch_eval(api_url: str, reports_dir: Optional[pathlib.Path] = None, out
         print("\n❌ 生成結果がありません")
         sys.exit(1)
     
-    output_file = output_dir / f"generated_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    
-    fieldnames = [
-        "report_file", "report_name", "report_length",
-        "ai_comment", "rubric_理解度", "rubric_論理性", "rubric_独自性", 
-        "rubric_実践性", "rubric_表現力", "rubric_total",
-        "llm_used", "llm_error", "prompt_version", "model_version", "generated_at"
-    ]
-    
-    with open(output_file, "w", newline="", encoding="utf-8-sig") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(results)
+    output_file = write_results_csv(results, output_dir)
     
     print(f"\n✅ 完了: {len(results)}件の結果を保存しました")
     print(f"📄 {output_file}")
-    print("\n次のステップ:")
-    print(f"  1. 生成結果を確認: {output_file}")
-    print(f"  2. 教授による手動評価: data/evaluation_sheet_template.csv をコピーして記入")
-    print(f"  3. 差分分析: python scripts/compare_rubric.py --generated {output_file} --human <評価CSV>")
+    print_next_steps(output_file)
 
 
 def main():